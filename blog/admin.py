@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Profile, Follow, Category, Post, Comment, PostView
+from .models import Profile, Follow, Category, Post, Comment, PostView, PostViewRollup, BackgroundJob
 
 @admin.register(Profile)
 class ProfileAdmin(admin.ModelAdmin):
@@ -23,3 +23,14 @@ class PostAdmin(admin.ModelAdmin):
 @admin.register(Comment)
 class CommentAdmin(admin.ModelAdmin):
     list_display = ('post', 'author', 'created_at', 'moderated')
+
+@admin.register(PostViewRollup)
+class PostViewRollupAdmin(admin.ModelAdmin):
+    list_display = ('post', 'period', 'bucket', 'views', 'visitors')
+    list_filter = ('period',)
+    exclude = ('sketch',)
+
+@admin.register(BackgroundJob)
+class BackgroundJobAdmin(admin.ModelAdmin):
+    list_display = ('task', 'status', 'attempts', 'run_at', 'locked_by')
+    list_filter = ('status', 'task')
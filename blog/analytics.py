@@ -0,0 +1,205 @@
+"""
+View analytics built from rollups.
+
+Raw PostView rows are only an intake log. ``rollup()`` folds each complete
+hour of them into a PostViewRollup per post (view count plus a HyperLogLog
+sketch of the visitors), merges the hours of every day it touched into a
+daily rollup, and ``prune()`` deletes raw rows once they are both rolled up
+and older than the retention window, whole hours at a time. Dashboard charts
+read the rollups only.
+
+Hours are rolled up once they are ``VIEW_ROLLUP_DELAY`` seconds in the past,
+so views still sitting in the write-behind buffer (blog/view_counter.py)
+have landed by then. Rolling up an hour again recomputes it from the raw
+rows, so a rerun over the same range is harmless: hours already pruned have
+no raw rows left and are skipped, and no hour is ever pruned in part.
+"""
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Max, Min
+from django.utils import timezone
+
+from .hyperloglog import HyperLogLog
+from .models import PostView, PostViewRollup
+
+HOUR = timedelta(hours=1)
+DAY = timedelta(days=1)
+CHART_DAYS = 30
+PRUNE_BATCH = 5000
+
+
+def rollup_delay():
+    return timedelta(seconds=getattr(settings, 'VIEW_ROLLUP_DELAY', 300))
+
+
+def retention():
+    return timedelta(days=getattr(settings, 'VIEW_ROLLUP_RETENTION_DAYS', 30))
+
+
+def floor_hour(moment):
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def floor_day(moment):
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def visitor_key(user_id, ip_address):
+    if user_id:
+        return f'user:{user_id}'
+    return f'ip:{ip_address or "unknown"}'
+
+
+def rolled_until():
+    """End of the last hour that has been rolled up, or None."""
+    last = PostViewRollup.objects.filter(period=PostViewRollup.HOUR).aggregate(last=Max('bucket'))['last']
+    return last + HOUR if last else None
+
+
+def next_view_hour(after, end):
+    """Start of the first hour in [after, end) holding raw views, or None."""
+    first = PostView.objects.filter(created_at__gte=after, created_at__lt=end).aggregate(first=Min('created_at'))['first']
+    return floor_hour(first) if first else None
+
+
+def rollup_hour(start):
+    """Build the hourly rollups of one hour from raw views."""
+    views = defaultdict(int)
+    sketches = defaultdict(HyperLogLog)
+    rows = (
+        PostView.objects.filter(created_at__gte=start, created_at__lt=start + HOUR)
+        .order_by().values_list('post_id', 'user_id', 'ip_address')
+    )
+    for post_id, user_id, ip_address in rows.iterator(chunk_size=2000):
+        views[post_id] += 1
+        sketches[post_id].add(visitor_key(user_id, ip_address))
+    rollups = [
+        PostViewRollup(
+            post_id=post_id, period=PostViewRollup.HOUR, bucket=start, views=count,
+            visitors=sketches[post_id].count(), sketch=sketches[post_id].to_bytes(),
+        )
+        for post_id, count in views.items()
+    ]
+    save_rollups(rollups)
+    return rollups
+
+
+def rollup_day(day):
+    """Merge the hourly rollups of one day into daily rollups."""
+    views = defaultdict(int)
+    sketches = defaultdict(HyperLogLog)
+    hours = PostViewRollup.objects.filter(
+        period=PostViewRollup.HOUR, bucket__gte=day, bucket__lt=day + DAY,
+    ).values_list('post_id', 'views', 'sketch')
+    for post_id, count, sketch in hours.iterator(chunk_size=500):
+        views[post_id] += count
+        sketches[post_id].update(HyperLogLog.from_bytes(sketch))
+    rollups = [
+        PostViewRollup(
+            post_id=post_id, period=PostViewRollup.DAY, bucket=day, views=count,
+            visitors=sketches[post_id].count(), sketch=sketches[post_id].to_bytes(),
+        )
+        for post_id, count in views.items()
+    ]
+    save_rollups(rollups)
+    return rollups
+
+
+def save_rollups(rollups):
+    PostViewRollup.objects.bulk_create(
+        rollups, batch_size=500, update_conflicts=True,
+        unique_fields=['post', 'period', 'bucket'], update_fields=['views', 'visitors', 'sketch'],
+    )
+
+
+def rollup(now=None, since=None):
+    """
+    Roll up every complete hour since the last run (or since `since`) and
+    refresh the days they fall in. Returns (hours, hourly rows, daily rows).
+    """
+    end = floor_hour((now or timezone.now()) - rollup_delay())
+    start = since or rolled_until() or PostView.objects.aggregate(first=Min('created_at'))['first']
+    hours = hourly = daily = 0
+    days = set()
+    # hours without views are skipped rather than scanned one by one
+    hour = next_view_hour(floor_hour(start), end) if start else None
+    while hour is not None:
+        with transaction.atomic():
+            hourly += len(rollup_hour(hour))
+        days.add(floor_day(hour))
+        hours += 1
+        hour = next_view_hour(hour + HOUR, end)
+    for day in sorted(days):
+        with transaction.atomic():
+            daily += len(rollup_day(day))
+    return hours, hourly, daily
+
+
+def prune(now=None, keep=None):
+    """
+    Delete raw views of the whole hours older than the retention window,
+    but never ones that have not been rolled up yet. Returns the number of
+    rows deleted.
+    """
+    now = now or timezone.now()
+    cutoff = now - (retention() if keep is None else keep)
+    done = rolled_until()
+    if done is None:
+        return 0
+    # an hour left half pruned would be rolled up again from the rest of it
+    cutoff = floor_hour(min(cutoff, done))
+    deleted = 0
+    while True:
+        # small batches keep each delete's locks and WAL short
+        batch = list(PostView.objects.filter(created_at__lt=cutoff).values_list('pk', flat=True)[:PRUNE_BATCH])
+        if not batch:
+            return deleted
+        deleted += PostView.objects.filter(pk__in=batch).delete()[0]
+
+
+def chart_key(user_id, post_id):
+    return f'dashboard:chart:{user_id}:{post_id or "all"}'
+
+
+def compute_view_chart(posts, days=CHART_DAYS, now=None):
+    """
+    Daily views and estimated unique visitors of the given posts over the
+    last `days` days, oldest first, from the daily rollups.
+    """
+    today = floor_day(now or timezone.now())
+    first = today - (days - 1) * DAY
+    views = defaultdict(int)
+    sketches = defaultdict(HyperLogLog)
+    rollups = PostViewRollup.objects.filter(
+        post__in=posts, period=PostViewRollup.DAY, bucket__gte=first,
+    ).values_list('bucket', 'views', 'sketch')
+    for bucket, count, sketch in rollups.iterator(chunk_size=500):
+        views[bucket] += count
+        # the same reader on two posts is one visitor of the author
+        sketches[bucket].update(HyperLogLog.from_bytes(sketch))
+    return [
+        {'day': day, 'views': views[day], 'visitors': sketches[day].count() if day in sketches else 0}
+        for day in (first + i * DAY for i in range(days))
+    ]
+
+
+def view_chart(user, post=None):
+    """Cached chart for the dashboard; rollups only change once an hour."""
+    key = chart_key(user.pk, post and post.pk)
+    chart = cache.get(key)
+    if chart is None:
+        posts = [post.pk] if post else user.posts.values('pk')
+        chart = compute_view_chart(posts)
+        cache.set(key, chart, getattr(settings, 'DASHBOARD_STATS_TIMEOUT', 300))
+    return chart
+
+
+def chart_totals(chart):
+    return {
+        'views': sum(day['views'] for day in chart),
+        'peak': max((day['views'] for day in chart), default=0),
+    }
@@ -0,0 +1,262 @@
+"""
+Async versions of the read-heavy pages and the AJAX endpoints, routed in
+place of their blog/views.py counterparts when ``ASYNC_VIEWS`` is set (the
+ASGI entry point, personal_blog/asgi.py, sets it).
+
+A view awaits Django's async ORM (``aget``, ``acount``, ``aexists``) instead
+of holding a thread for the whole request, and starts the queries that do
+not depend on each other together with ``asyncio.gather``. Django 5.0 still
+runs each query through the request's single database thread, so today they
+execute one after another; the view is written so that they overlap as soon
+as the backend driver is natively async. Template rendering, the page cache
+lookup and the conditional GET validators touch the session and caches
+synchronously, so each of those is one ``sync_to_async`` call; the pages
+read ``request.user`` as already loaded by the validators.
+
+Responses, cache tags and query counts match the synchronous views.
+"""
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.core.paginator import Paginator
+from django.http import Http404, JsonResponse
+from django.shortcuts import aget_object_or_404, render
+from django.utils.decorators import method_decorator
+from django.utils.html import strip_tags
+from django.views.decorators.http import require_POST
+from django.views.generic import View
+
+from . import conditional, page_cache, search
+from .conditional import conditional_page
+from .forms import CommentForm
+from .models import Comment, Follow, Post, Profile
+from .page_cache import cache_anonymous_page
+from .pagination import InvalidCursor, KeysetPaginator
+from .related import related_posts
+from .rendering import prefetch_rendered
+from .routers import replica_reads
+from .stats import acategory_counts, apublished_post_count, find_category
+from .suggestions import suggestions_for
+from .trending import leaderboard
+from .view_counter import view_counter
+from .views import COMMENT_ORDERING, comment_cursor, trending_limit
+
+arender = sync_to_async(render)
+
+
+async def alist(queryset):
+    return [row async for row in queryset]
+
+
+async def keyset_page(queryset, per_page, cursor, ordering=('-created_at', '-pk')):
+    try:
+        return await KeysetPaginator(queryset, per_page, ordering).apage(cursor)
+    except InvalidCursor:
+        raise Http404('Invalid cursor.')
+
+
+async def comments_page(post, per_page, cursor):
+    qs = Comment.objects.filter(post=post, moderated=False).select_related('author')
+    return await keyset_page(qs, per_page, cursor, COMMENT_ORDERING)
+
+
+async def is_following(user, author):
+    if not user.is_authenticated:
+        return False
+    return await Follow.objects.filter(follower=user, following=author).aexists()
+
+
+class AsyncView(View):
+    """
+    A view with async handlers. Its decorators must be passed to a single
+    method_decorator as a list: each of them picks its async path only if
+    what it wraps is a coroutine function, and method_decorator's own
+    wrapper is not one.
+    """
+
+    async def dispatch(self, request, *args, **kwargs):
+        return await super().dispatch(request, *args, **kwargs)
+
+
+@method_decorator([replica_reads, cache_anonymous_page, conditional_page(conditional.list_etag)], name='dispatch')
+class HomeView(AsyncView):
+    template_name = 'blog/home.html'
+    paginate_by = 10
+    sidebar = True  # the template lists the categories
+
+    def search_context(self, qs, q):
+        # ranked results keep numbered pages; this runs on the request's thread
+        qs = search.search_posts(qs, q)
+        paginator = Paginator(qs, self.paginate_by)
+        page = paginator.get_page(self.request.GET.get('page'))
+        return {'paginator': paginator, 'page_obj': page, 'is_paginated': page.has_other_pages(),
+                'object_list': page.object_list}
+
+    async def get(self, request, *args, **kwargs):
+        q = request.GET.get('q', '')
+        slug = request.GET.get('category')
+        categories, trending, total_posts = await asyncio.gather(
+            acategory_counts() if self.sidebar or slug else asyncio.sleep(0, []),
+            leaderboard.asidebar() if self.sidebar else asyncio.sleep(0, []),
+            apublished_post_count(),
+        )
+        category = find_category(categories, slug) if slug else None
+        if slug and category is None:
+            raise Http404('No such category.')
+        qs = Post.objects.filter(published=True).select_related('author', 'category')
+        if category:
+            qs = qs.filter(category_id=category['id'])
+        if q:
+            context = await sync_to_async(self.search_context)(qs, q)
+        else:
+            page = await keyset_page(qs, self.paginate_by, request.GET.get('cursor'))
+            context = {'paginator': None, 'page_obj': page, 'is_paginated': page.has_other_pages,
+                       'object_list': page.object_list}
+        context.update(
+            posts=context['object_list'], q=q, category=category, categories=categories if self.sidebar else [],
+            trending=trending, total_posts=total_posts, view=self,
+        )
+        page_cache.tag(request, 'post-list')
+        if self.sidebar:
+            page_cache.tag(request, 'trending')
+        await sync_to_async(prefetch_rendered)(context['object_list'])
+        return await arender(request, self.template_name, context)
+
+
+class SearchResultsView(HomeView):
+    template_name = 'blog/search_results.html'
+    sidebar = False
+
+
+@method_decorator([
+    replica_reads, cache_anonymous_page, conditional_page(conditional.post_etag, conditional.post_last_modified),
+], name='dispatch')
+class PostDetailView(AsyncView):
+    template_name = 'blog/post_detail.html'
+    comments_per_page = 20
+
+    async def get(self, request, slug, *args, **kwargs):
+        post = await aget_object_or_404(Post.objects.select_related('author'), slug=slug)
+        comments, following, related = await asyncio.gather(
+            comments_page(post, self.comments_per_page, None),
+            is_following(request.user, post.author),
+            alist(related_posts(post)),
+        )
+        page_cache.tag(request, f'post:{post.pk}')
+        return await arender(request, self.template_name, {
+            'post': post, 'object': post, 'view': self, 'comment_form': CommentForm(),
+            'is_following': following, 'stripped_content': strip_tags(post.content), 'comments': comments,
+            'related_posts': related,
+        })
+
+
+@method_decorator([cache_anonymous_page, conditional_page(conditional.author_etag)], name='dispatch')
+class AuthorProfileView(AsyncView):
+    template_name = 'blog/author_profile.html'
+    paginate_by = 20
+
+    async def get(self, request, username, *args, **kwargs):
+        # follower and following counts are columns of the profile joined here
+        author = await aget_object_or_404(User.objects.select_related('profile'), username=username)
+        signed_in = request.user.is_authenticated
+        posts, following, suggestions = await asyncio.gather(
+            keyset_page(Post.objects.filter(author=author, published=True), self.paginate_by, request.GET.get('cursor')),
+            is_following(request.user, author),
+            alist(suggestions_for(request.user, exclude=author)) if signed_in else asyncio.sleep(0, []),
+        )
+        page_cache.tag(request, f'author:{author.pk}')
+        return await arender(request, self.template_name, {
+            'author': author, 'posts': posts, 'page_obj': posts, 'followers': author.profile.followers_count,
+            'following': author.profile.following_count, 'is_following': following, 'suggestions': suggestions,
+        })
+
+
+# AJAX endpoints
+
+async def ajax_posts(request):
+    qs = Post.objects.filter(published=True).select_related('author')
+    username = request.GET.get('author')
+    if username:
+        qs = qs.filter(author__username=username)
+    page = await keyset_page(qs, HomeView.paginate_by, request.GET.get('cursor'))
+    await sync_to_async(prefetch_rendered)(page)
+    return JsonResponse({
+        'posts': [{
+            'title': post.title,
+            'url': post.get_absolute_url(),
+            'author': post.author.username,
+            'created_at': post.created_at.isoformat(),
+            'excerpt': post.rendered['excerpt'],
+        } for post in page],
+        'next_cursor': page.next_cursor,
+        'previous_cursor': page.previous_cursor,
+    })
+
+
+async def trending_posts(request):
+    limit = trending_limit(request)
+    if limit is None:
+        return JsonResponse({'error': 'invalid limit'}, status=400)
+    return JsonResponse({'posts': await leaderboard.atop(limit)})
+
+
+async def ajax_comments(request, slug):
+    post = await aget_object_or_404(Post.objects.only('pk'), slug=slug)
+    page = await comments_page(post, PostDetailView.comments_per_page, request.GET.get('after'))
+    return JsonResponse({
+        'comments': [comment.as_json() for comment in page],
+        'next': page.next_cursor,
+    })
+
+
+@require_POST
+async def toggle_follow(request):
+    user = await request.auser()
+    if not user.is_authenticated:
+        return JsonResponse({'error': 'login required'}, status=403)
+    target_username = request.POST.get('username')
+    if not target_username:
+        return JsonResponse({'error': 'username required'}, status=400)
+    target = await aget_object_or_404(User, username=target_username)
+    if target == user:
+        return JsonResponse({'error': "can't follow yourself"}, status=400)
+    obj, created = await Follow.objects.aget_or_create(follower=user, following=target)
+    if not created:
+        await obj.adelete()
+    followers_count = await Profile.objects.filter(user=target).values_list('followers_count', flat=True).afirst()
+    return JsonResponse({'status': 'followed' if created else 'unfollowed', 'followers_count': followers_count or 0})
+
+
+@require_POST
+async def increment_post_view(request):
+    slug = request.POST.get('slug')
+    if not slug:
+        return JsonResponse({'error': 'slug required'}, status=400)
+    user = await request.auser()
+    views = await sync_to_async(view_counter.record)(
+        slug,
+        user_id=(user.pk if user.is_authenticated else None),
+        ip=request.META.get('REMOTE_ADDR'),
+    )
+    if views is None:
+        raise Http404('No Post matches the given query.')
+    return JsonResponse({'views': views})
+
+
+@require_POST
+async def ajax_add_comment(request, slug):
+    user = await request.auser()
+    if not user.is_authenticated:
+        return JsonResponse({'error': 'login required'}, status=403)
+    post = await aget_object_or_404(Post, slug=slug)
+    body = request.POST.get('body', '').strip()
+    if not body:
+        return JsonResponse({'error': 'empty comment'}, status=400)
+    comment = await Comment.objects.acreate(post=post, author=user, body=body)
+    return JsonResponse({
+        'status': 'ok',
+        'comment': comment.as_json(),
+        'cursor': comment_cursor(comment),
+        'comments_count': post.comment_count + 1,
+    })
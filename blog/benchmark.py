@@ -0,0 +1,281 @@
+"""
+Benchmark harness for the hot endpoints.
+
+``generate`` fills the database with a synthetic blog: users with profiles,
+posts with CKEditor-style HTML spread over the past year, comments, follows
+and post views. Rows are bulk inserted, then the denormalized counters,
+search documents and timelines are built the way ``recount``,
+``rebuild_search_index`` and a follow would build them.
+
+``run`` drives each endpoint in-process through the test client, rotating
+over posts, authors and search terms, and reports requests/sec,
+p50/p95/p99 latency and queries per request. Results are plain dicts,
+saved as JSON by ``manage.py benchmark_endpoints`` so runs on two commits
+can be compared.
+"""
+import io
+import random
+import statistics
+import time
+from datetime import timedelta
+from contextlib import ExitStack
+from itertools import islice
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connections
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from . import search, timeline
+from .models import Category, Comment, Follow, Post, PostView
+from .view_counter import view_counter
+
+WORDS = (
+    'django query index cache latency server request response template render database python async '
+    'thread worker replica cursor page feed comment author follow post search rank token queue job '
+    'image upload static stream event metric sample budget memory batch write read lock signal model '
+    'view route middleware session cookie header browser client network proxy deploy release test'
+).split()
+CATEGORIES = ('Python', 'Django', 'Databases', 'Performance', 'Frontend', 'DevOps', 'Career', 'Notes')
+BATCH_SIZE = 1000
+ENDPOINTS = (
+    'home (anonymous)', 'home', 'post_detail (anonymous)', 'post_detail', 'search',
+    'increment_post_view', 'ajax_add_comment', 'toggle_follow',
+)
+
+
+def sentence(rng, words=(6, 16)):
+    text = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(*words)))
+    return text[0].upper() + text[1:] + '.'
+
+
+def paragraph(rng):
+    parts = []
+    for _ in range(rng.randint(2, 5)):
+        text = sentence(rng)
+        roll = rng.random()
+        if roll < 0.15:
+            word = rng.choice(WORDS)
+            text = text.replace(word, f'<strong>{word}</strong>', 1)
+        elif roll < 0.25:
+            word = rng.choice(WORDS)
+            text = text.replace(word, f'<a href="https://example.com/{word}" target="_blank">{word}</a>', 1)
+        elif roll < 0.3:
+            text = text.replace(' ', '&nbsp;', 1)
+        parts.append(text)
+    return f'<p>{" ".join(parts)}</p>'
+
+
+def post_html(rng):
+    """A post body shaped like CKEditor output: headings, lists, code, quotes and images."""
+    blocks = []
+    for i in range(rng.randint(4, 12)):
+        roll = rng.random()
+        if i and roll < 0.12:
+            blocks.append(f'<h2>{sentence(rng, (2, 6))[:-1]}</h2>')
+        elif roll < 0.22:
+            items = ''.join(f'<li>{sentence(rng, (3, 8))}</li>' for _ in range(rng.randint(2, 5)))
+            blocks.append(f'<ul>{items}</ul>')
+        elif roll < 0.28:
+            code = '\n'.join(f'{rng.choice(WORDS)} = {rng.choice(WORDS)}({rng.randint(0, 99)})' for _ in range(4))
+            blocks.append(f'<pre><code class="language-python">{code}</code></pre>')
+        elif roll < 0.32:
+            blocks.append(f'<blockquote><p>{sentence(rng)}</p></blockquote>')
+        elif roll < 0.36:
+            blocks.append(
+                f'<p><img alt="{rng.choice(WORDS)}" src="/media/uploads/{rng.randint(1, 500)}.jpg" '
+                f'style="height:{rng.randint(200, 600)}px; width:{rng.randint(300, 900)}px" /></p>'
+            )
+        else:
+            blocks.append(paragraph(rng))
+    return '\n\n'.join(blocks)
+
+
+def batched(iterable, size=BATCH_SIZE):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def generate(users=200, posts=2000, comments=10000, follows=2000, views=50000, seed=1, log=None):
+    """Insert a synthetic blog; returns the number of rows of each kind."""
+    rng = random.Random(seed)
+    log = log or (lambda message: None)
+    now = timezone.now()
+    password = make_password('benchmark')  # hashed once, not per user
+
+    categories = [
+        Category.objects.get_or_create(slug=name.lower(), defaults={'name': name})[0] for name in CATEGORIES
+    ]
+    # numbered on from earlier runs, so data can be generated more than once
+    first = User.objects.filter(username__startswith='bench').count()
+    people = User.objects.bulk_create(
+        [User(username=f'bench{i}', email=f'bench{i}@example.com', password=password)
+         for i in range(first, first + users)],
+        batch_size=BATCH_SIZE,
+    )
+    if people and people[0].pk is None:  # backends that return no ids from bulk inserts
+        people = list(User.objects.filter(username__startswith='bench').order_by('-pk')[:users][::-1])
+    # a few prolific authors write most posts
+    writers = people[:max(1, len(people) // 5)]
+    log(f'{len(people)} users')
+
+    rows = []
+    first = Post.objects.count()
+    for i in range(first, first + posts):
+        created = now - timedelta(seconds=rng.randint(0, 365 * 24 * 3600))
+        title = sentence(rng, (3, 9))[:-1]
+        rows.append(Post(
+            author=rng.choice(writers), title=title, slug=f'{title.lower().replace(" ", "-")[:200]}-{i}',
+            content=post_html(rng), category=rng.choice(categories), published=rng.random() < 0.9,
+            created_at=created, updated_at=created,
+        ))
+    dates = [post.created_at for post in rows]
+    for batch in batched(rows):
+        Post.objects.bulk_create(batch)
+    # auto_now_add and auto_now set every post's dates to now on insert
+    for post, created in zip(rows, dates):
+        post.created_at = post.updated_at = created
+    Post.objects.bulk_update(rows, ['created_at', 'updated_at'], batch_size=BATCH_SIZE)
+    published = [post for post in rows if post.published]
+    log(f'{len(rows)} posts')
+
+    Comment.objects.bulk_create(
+        (Comment(post=rng.choice(published), author=rng.choice(people), body=sentence(rng)) for _ in range(comments)),
+        batch_size=BATCH_SIZE,
+    )
+    log(f'{comments} comments')
+
+    pairs = set()
+    while len(pairs) < min(follows, len(writers) * (len(people) - 1)):
+        follower, following = rng.choice(people), rng.choice(writers)
+        if follower != following:
+            pairs.add((follower.pk, following.pk))
+    Follow.objects.bulk_create(
+        [Follow(follower_id=a, following_id=b) for a, b in pairs], batch_size=BATCH_SIZE,
+    )
+    log(f'{len(pairs)} follows')
+
+    # views skew towards a few popular posts
+    weights = [1 / (rank + 1) for rank in range(len(published))]
+    viewed = rng.choices(published, weights=weights, k=views) if published else []
+    for batch in batched(viewed):
+        PostView.objects.bulk_create([
+            PostView(post=post, user=rng.choice(people) if rng.random() < 0.3 else None,
+                     ip_address=f'10.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}')
+            for post in batch
+        ])
+    counts = {}
+    for post in viewed:
+        counts[post.pk] = counts.get(post.pk, 0) + 1
+    for post in published:
+        post.views = counts.get(post.pk, 0)
+    Post.objects.bulk_update(published, ['views'], batch_size=BATCH_SIZE)
+    log(f'{len(viewed)} post views')
+
+    # what signals would have maintained had the rows been saved one by one
+    call_command('recount', stdout=io.StringIO())
+    search.install()
+    for batch in batched(Post.objects.only('pk', 'title', 'content').order_by().iterator(chunk_size=BATCH_SIZE)):
+        search.index_posts(batch)
+    for follower_id, author_id in pairs:
+        timeline.follow_added(follower_id, author_id)
+    log('counters, search documents and timelines built')
+    return {'users': len(people), 'posts': len(rows), 'comments': comments, 'follows': len(pairs), 'views': len(viewed)}
+
+
+def percentile(timings, q):
+    """`q` of the sorted `timings`."""
+    return timings[min(len(timings) - 1, int(len(timings) * q))]
+
+
+def measure(call, requests, warmup=5):
+    """Time `requests` calls of `call(i)` after `warmup` untimed ones."""
+    for i in range(warmup):
+        call(i)
+    timings, queries, errors = [], [], 0
+
+    def count(execute, sql, params, many, context):
+        queries.append(1)
+        return execute(sql, params, many, context)
+
+    with ExitStack() as stack:
+        for alias in connections:
+            stack.enter_context(connections[alias].execute_wrapper(count))
+        started = time.perf_counter()
+        for i in range(warmup, warmup + requests):
+            request_started = time.perf_counter()
+            response = call(i)
+            timings.append((time.perf_counter() - request_started) * 1000)
+            errors += response.status_code >= 400
+        elapsed = time.perf_counter() - started
+    timings.sort()
+    return {
+        'requests': requests,
+        'errors': errors,
+        'rps': requests / elapsed,
+        'p50': statistics.median(timings),
+        'p95': percentile(timings, 0.95),
+        'p99': percentile(timings, 0.99),
+        'mean': statistics.fmean(timings),
+        'queries': len(queries) / requests,
+    }
+
+
+def endpoints(reader):
+    """name -> call(i) issuing the i-th request; a signed-in `reader` and an anonymous client."""
+    posts = list(Post.objects.filter(published=True).only('slug').order_by('-views')[:200])
+    authors = list(User.objects.filter(profile__published_posts_count__gt=0).exclude(pk=reader.pk)[:50])
+    if not posts or not authors:
+        raise ValueError('The database has no published posts by other authors; generate data first.')
+    terms = [' '.join(pair) for pair in zip(WORDS[::2], WORDS[1::2])] + WORDS[:20]
+    anonymous, signed_in = Client(), Client()
+    signed_in.force_login(reader)
+    home, search_url = reverse('blog:home'), reverse('blog:search')
+    post_view = reverse('blog:increment_post_view')
+    follow = reverse('blog:toggle_follow')
+
+    def pick(items, i):
+        return items[i % len(items)]
+
+    return {
+        # anonymous pages come from the page cache once warm
+        'home (anonymous)': lambda i: anonymous.get(home),
+        'home': lambda i: signed_in.get(home),
+        'post_detail (anonymous)': lambda i: anonymous.get(pick(posts, i).get_absolute_url()),
+        'post_detail': lambda i: signed_in.get(pick(posts, i).get_absolute_url()),
+        'search': lambda i: signed_in.get(search_url, {'q': pick(terms, i)}),
+        # a new visitor each time, so the dedupe filter lets every view through
+        'increment_post_view': lambda i: anonymous.post(
+            post_view, {'slug': pick(posts, i).slug}, REMOTE_ADDR=f'192.0.{i // 250 % 256}.{i % 250 + 1}',
+        ),
+        'ajax_add_comment': lambda i: signed_in.post(
+            reverse('blog:ajax_add_comment', args=[pick(posts, i).slug]), {'body': f'Benchmark comment {i}.'},
+        ),
+        # alternately follows and unfollows each author
+        'toggle_follow': lambda i: signed_in.post(follow, {'username': pick(authors, i).username}),
+    }
+
+
+def run(requests=200, names=None, reader=None, report=None):
+    """Benchmark each endpoint in turn; returns name -> results."""
+    if reader is None:
+        reader = User.objects.filter(username__startswith='bench').order_by('pk').last()
+    if reader is None:
+        raise ValueError('No benchmark user; generate data first.')
+    results = {}
+    # buffered views are counted in-process, without the background flush thread
+    with override_settings(VIEW_COUNTER_FLUSH_INTERVAL=None):
+        calls = endpoints(reader)
+        for name, call in calls.items():
+            if names and name not in names:
+                continue
+            results[name] = measure(call, requests)
+            view_counter.flush()
+            if report:
+                report(name, results[name])
+    return results
@@ -0,0 +1,155 @@
+"""
+HTTP validators for the public pages.
+
+ETags are built from a single metadata query per page (post and comment
+high-water marks, follower counters) rather than from the rendered output,
+so an unchanged page is answered with 304 before any template is rendered.
+Pages seen by a signed-in user carry that user in the ETag and are marked
+private; anonymous pages are public but must be revalidated.
+"""
+import hashlib
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.db.models import Count, Exists, Max, OuterRef, Q, Subquery
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.views.decorators.http import condition
+
+from .models import Follow, FollowSuggestion, Post, Profile, RelatedPost
+from .stats import category_counts
+from .trending import leaderboard
+
+
+def make_etag(*parts):
+    return hashlib.md5(repr(parts).encode()).hexdigest()
+
+
+def viewer_id(request):
+    return request.user.pk if request.user.is_authenticated else None
+
+
+def memoized(func):
+    """Run a metadata query once per request even if several validators need it."""
+    @wraps(func)
+    def wrapper(request, *args, **kwargs):
+        cache = request.__dict__.setdefault('_conditional_meta', {})
+        if func.__name__ not in cache:
+            cache[func.__name__] = func(request, *args, **kwargs)
+        return cache[func.__name__]
+    return wrapper
+
+
+def is_following(request, author_ref):
+    return Exists(Follow.objects.filter(follower_id=viewer_id(request), following=author_ref))
+
+
+@memoized
+def post_meta(request, slug, **kwargs):
+    # the related posts list is replaced whole, so its first row dates it
+    related_at = RelatedPost.objects.filter(post=OuterRef('pk'), rank=0).values('created_at')[:1]
+    # comment_count only counts visible comments, so moderation changes the ETag
+    qs = Post.objects.filter(slug=slug).annotate(
+        last_comment=Max('comments__created_at', filter=Q(comments__moderated=False)),
+        related_at=Subquery(related_at),
+    )
+    fields = ['pk', 'updated_at', 'comment_count', 'last_comment', 'related_at']
+    if viewer_id(request):
+        qs = qs.annotate(following=is_following(request, OuterRef('author')))
+        fields.append('following')
+    return qs.values(*fields).first()
+
+
+def post_etag(request, slug, **kwargs):
+    meta = post_meta(request, slug)
+    if meta is None:
+        return None
+    return make_etag('post', viewer_id(request), *meta.values())
+
+
+def post_last_modified(request, slug, **kwargs):
+    meta = post_meta(request, slug)
+    if meta is None:
+        return None
+    return max(filter(None, [meta['updated_at'], meta['last_comment'], meta['related_at']]))
+
+
+@memoized
+def list_meta(request, *args, **kwargs):
+    return Post.objects.filter(published=True).aggregate(
+        last_updated=Max('updated_at'), count=Count('*'),
+    )
+
+
+def list_etag(request, *args, **kwargs):
+    meta = list_meta(request)
+    trending = [entry['id'] for entry in leaderboard.sidebar()]
+    # the cached sidebar list, dropped whenever a category or its count changes
+    categories = [tuple(category.values()) for category in category_counts()]
+    return make_etag('list', viewer_id(request), meta['last_updated'], meta['count'], trending, categories)
+
+
+@memoized
+def author_meta(request, username, **kwargs):
+    last_post = (
+        Post.objects.filter(author=OuterRef('user'), published=True)
+        .order_by('-updated_at').values('updated_at')[:1]
+    )
+    qs = Profile.objects.filter(user__username=username).annotate(last_post=Subquery(last_post))
+    fields = ['user_id', 'bio', 'avatar', 'followers_count', 'following_count',
+              'published_posts_count', 'last_post']
+    if viewer_id(request):
+        # the viewer's suggestions: replaced whole, and filtered by whom they follow
+        suggested_at = FollowSuggestion.objects.filter(user_id=viewer_id(request), rank=0).values('created_at')[:1]
+        viewer_following = Profile.objects.filter(user_id=viewer_id(request)).values('following_count')[:1]
+        qs = qs.annotate(
+            following=is_following(request, OuterRef('user')),
+            suggested_at=Subquery(suggested_at), viewer_following=Subquery(viewer_following),
+        )
+        fields += ['following', 'suggested_at', 'viewer_following']
+    return qs.values(*fields).first()
+
+
+def author_etag(request, username, **kwargs):
+    meta = author_meta(request, username)
+    if meta is None:
+        return None
+    return make_etag('author', viewer_id(request), *meta.values())
+
+
+def conditional_page(etag_func, last_modified_func=None):
+    """
+    Answer conditional GETs with 304 using the given validators and set
+    Cache-Control/Vary for the anonymous or signed-in variant.
+    """
+    def validators(request, *args, **kwargs):
+        # the metadata queries are memoized, so condition() reuses these
+        etag_func(request, *args, **kwargs)
+        if last_modified_func:
+            last_modified_func(request, *args, **kwargs)
+
+    def decorator(view_func):
+        inner = condition(etag_func=etag_func, last_modified_func=last_modified_func)(view_func)
+
+        if iscoroutinefunction(view_func):
+            @wraps(view_func)
+            async def async_wrapper(request, *args, **kwargs):
+                # condition() calls the validators synchronously: run their
+                # query (and load request.user) on the request's thread first
+                await sync_to_async(validators)(request, *args, **kwargs)
+                return vary(request, await inner(request, *args, **kwargs))
+            return async_wrapper
+
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            return vary(request, inner(request, *args, **kwargs))
+        return wrapper
+    return decorator
+
+
+def vary(request, response):
+    patch_vary_headers(response, ['Cookie'])
+    if request.user.is_authenticated:
+        patch_cache_control(response, private=True, no_cache=True)
+    else:
+        patch_cache_control(response, public=True, max_age=0, must_revalidate=True)
+    return response
@@ -0,0 +1,52 @@
+"""
+HyperLogLog distinct-count sketches.
+
+A sketch estimates how many distinct values were added to it in a fixed
+1 KiB of registers (about 3% standard error), and two sketches merge into
+the sketch of the union. The view rollups (blog/analytics.py) store one per
+post and time bucket so unique visitors can be summed over days and posts
+without keeping the raw views.
+"""
+import hashlib
+import math
+
+PRECISION = 10
+REGISTERS = 1 << PRECISION
+HASH_BITS = 64
+
+
+class HyperLogLog:
+    def __init__(self, registers=None):
+        if registers is not None and len(registers) != REGISTERS:
+            raise ValueError(f'A sketch has {REGISTERS} registers, got {len(registers)}.')
+        self.registers = bytearray(registers if registers is not None else REGISTERS)
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(data)
+
+    def to_bytes(self):
+        return bytes(self.registers)
+
+    def add(self, value):
+        digest = hashlib.blake2b(str(value).encode(), digest_size=HASH_BITS // 8).digest()
+        h = int.from_bytes(digest, 'big')
+        index = h >> (HASH_BITS - PRECISION)
+        rest = h & ((1 << (HASH_BITS - PRECISION)) - 1)
+        rank = HASH_BITS - PRECISION - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, other):
+        """Merge another sketch into this one."""
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def count(self):
+        alpha = 0.7213 / (1 + 1.079 / REGISTERS)
+        estimate = alpha * REGISTERS * REGISTERS / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * REGISTERS and zeros:
+            # linear counting is far more accurate while most registers are empty
+            estimate = REGISTERS * math.log(REGISTERS / zeros)
+        return round(estimate)
@@ -0,0 +1,156 @@
+"""
+Responsive derivatives of uploaded images.
+
+For each post image and avatar, resized copies are generated at the widths
+in ``IMAGE_DERIVATIVE_WIDTHS`` (never wider than the original) as WebP and
+JPEG, and saved through the image field's own storage next to the original.
+What was built is recorded on the model in ``<field>_derivatives``:
+
+    {'source': <original file name>, 'width': ..., 'height': ...,
+     'files': {'webp': [[320, <name>], ...], 'jpeg': [...]}}
+
+so the ``responsive_image`` template tag can write ``srcset`` without any
+storage or database access. A record whose ``source`` is not the field's
+current file is stale and ignored.
+
+Uploads are processed by the job queue (blog/jobs.py); ``manage.py
+build_image_derivatives`` backfills existing images in a process pool.
+"""
+import os
+from io import BytesIO
+
+from django.apps import apps
+from django.conf import settings
+from django.core.files.base import ContentFile
+from PIL import Image, ImageOps
+
+from . import jobs
+
+FORMATS = {
+    # format: (Pillow format, extension, save options)
+    'webp': ('WEBP', 'webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', 'jpg', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+# model label -> image fields with derivatives
+IMAGE_FIELDS = {
+    'blog.post': ['featured_image'],
+    'blog.profile': ['avatar'],
+}
+
+
+def derivative_widths():
+    return sorted(getattr(settings, 'IMAGE_DERIVATIVE_WIDTHS', (320, 640, 960, 1280, 1920)))
+
+
+def meta_field(field_name):
+    return f'{field_name}_derivatives'
+
+
+def current_derivatives(file):
+    """The derivative record for a FieldFile, or None if missing or stale."""
+    if not file:
+        return None
+    meta = getattr(file.instance, meta_field(file.field.name), None) or {}
+    return meta if meta.get('source') == file.name else None
+
+
+def needs_derivatives(instance, field_name):
+    file = getattr(instance, field_name)
+    return bool(file) and current_derivatives(file) is None
+
+
+def target_widths(width):
+    widths = [w for w in derivative_widths() if w < width]
+    # the largest candidate is the original width, capped at the largest bucket
+    return widths + [min(width, derivative_widths()[-1])]
+
+
+def derivative_name(name, width, fmt):
+    base, _ = os.path.splitext(name)
+    return f'derivatives/{base}-{width}w.{FORMATS[fmt][1]}'
+
+
+def resize(image, width, fmt):
+    height = max(1, round(image.height * width / image.width))
+    resized = image.resize((width, height), Image.LANCZOS) if width != image.width else image
+    if fmt == 'jpeg' and resized.mode != 'RGB':
+        # JPEG has no alpha; flatten onto white
+        background = Image.new('RGB', resized.size, 'white')
+        background.paste(resized, mask=resized.getchannel('A') if 'A' in resized.getbands() else None)
+        resized = background
+    pil_format, _, options = FORMATS[fmt]
+    out = BytesIO()
+    resized.save(out, pil_format, **options)
+    return out.getvalue()
+
+
+def build_derivatives(model_label, field_name, name):
+    """
+    Read the image `name` from the field's storage, save its derivatives and
+    return their record. Runs in worker processes, so it takes plain values.
+    """
+    storage = apps.get_model(model_label)._meta.get_field(field_name).storage
+    with storage.open(name) as source:
+        image = Image.open(source)
+        image = ImageOps.exif_transpose(image)
+        image.load()
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+    files = {fmt: [] for fmt in FORMATS}
+    for width in target_widths(image.width):
+        for fmt in FORMATS:
+            saved = storage.save(derivative_name(name, width, fmt), ContentFile(resize(image, width, fmt)))
+            files[fmt].append([width, saved])
+    return {'source': name, 'width': image.width, 'height': image.height, 'files': files}
+
+
+def derivative_names(meta):
+    return [name for entries in (meta or {}).get('files', {}).values() for _, name in entries]
+
+
+def store_derivatives(model_label, pk, field_name, meta):
+    """
+    Record built derivatives on the instance if its image is still the one
+    they were built from; otherwise delete them. Returns True if recorded.
+    """
+    model = apps.get_model(model_label)
+    instance = model.objects.filter(pk=pk).first()
+    if instance is None or getattr(instance, field_name).name != meta['source']:
+        delete_files(model_label, field_name, derivative_names(meta))
+        return False
+    old = getattr(instance, meta_field(field_name))
+    setattr(instance, meta_field(field_name), meta)
+    instance.save(update_fields=[meta_field(field_name)])
+    stale = set(derivative_names(old)) - set(derivative_names(meta))
+    if stale:
+        queue_deletion(instance, field_name, stale)
+    return True
+
+
+def delete_files(model_label, field_name, names):
+    storage = apps.get_model(model_label)._meta.get_field(field_name).storage
+    for name in names:
+        storage.delete(name)
+
+
+def queue_derivatives(instance, field_name):
+    jobs.enqueue('images.derivatives', model=instance._meta.label_lower, pk=str(instance.pk), field=field_name)
+
+
+def queue_deletion(instance, field_name, names):
+    jobs.enqueue('images.delete', model=instance._meta.label_lower, field=field_name, names=sorted(names))
+
+
+@jobs.task('images.derivatives')
+def generate_derivatives(model, pk, field):
+    instance = apps.get_model(model).objects.filter(pk=pk).first()
+    if instance is None or not needs_derivatives(instance, field):
+        return
+    meta = build_derivatives(model, field, getattr(instance, field).name)
+    store_derivatives(model, pk, field, meta)
+
+
+@jobs.task('images.delete')
+def delete_derivatives(model, field, names):
+    delete_files(model, field, names)
@@ -0,0 +1,166 @@
+"""
+Database-backed background jobs.
+
+Work that must not hold up a request (calls to Cloudinary, media processing)
+is queued as a BackgroundJob row and run by ``manage.py run_jobs``. A job is
+inserted in the same transaction as the change that caused it, so it exists
+exactly when that change was committed and a worker never sees it earlier.
+
+Workers claim a due job with a conditional UPDATE, so several can poll the
+same table without a broker or row locks. A job that raises is retried with
+exponential backoff until ``max_attempts``, then left as ``failed`` with its
+traceback; a job whose worker died is picked up again once its lock is older
+than ``JOB_LOCK_TIMEOUT``. Finished jobs are deleted.
+
+Tasks are plain functions registered by name with ``@task`` and called with
+the job's JSON payload as keyword arguments.
+"""
+import logging
+import os
+import random
+import socket
+import traceback
+from datetime import timedelta
+from itertools import islice
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import BackgroundJob
+import cloudinary.uploader  # type: ignore
+
+logger = logging.getLogger(__name__)
+
+TASKS = {}
+
+
+def task(name):
+    """Register a function as the task `name`."""
+    def decorator(func):
+        TASKS[name] = func
+        return func
+    return decorator
+
+
+def enqueue(name, run_at=None, max_attempts=None, **payload):
+    if name not in TASKS:
+        raise KeyError(f'Unknown background task {name!r}.')
+    return BackgroundJob.objects.create(
+        task=name,
+        payload=payload,
+        run_at=run_at or timezone.now(),
+        max_attempts=max_attempts or getattr(settings, 'JOB_MAX_ATTEMPTS', 5),
+    )
+
+
+def enqueue_many(name, payloads, run_at=None, max_attempts=None, batch_size=1000):
+    """Queue `name` once for each payload dict, with bulk inserts. Returns the number queued."""
+    if name not in TASKS:
+        raise KeyError(f'Unknown background task {name!r}.')
+    run_at = run_at or timezone.now()
+    max_attempts = max_attempts or getattr(settings, 'JOB_MAX_ATTEMPTS', 5)
+    jobs = (BackgroundJob(task=name, payload=payload, run_at=run_at, max_attempts=max_attempts) for payload in payloads)
+    queued = 0
+    while batch := list(islice(jobs, batch_size)):
+        BackgroundJob.objects.bulk_create(batch)
+        queued += len(batch)
+    return queued
+
+
+def take_queued(name, now=None, limit=1000):
+    """
+    Remove the due, queued jobs of task `name` and return their payloads, so
+    a running job of that task can do their work in the same pass. Call it
+    from the task: if the task fails, its transaction rolls back and the
+    jobs stay queued.
+    """
+    now = now or timezone.now()
+    due = BackgroundJob.objects.filter(task=name, status=BackgroundJob.QUEUED, run_at__lte=now).order_by('run_at', 'pk')
+    taken = list(due.values_list('pk', 'payload')[:limit])
+    # a job another worker claims meanwhile is not deleted; its work is merely done twice
+    BackgroundJob.objects.filter(pk__in=[pk for pk, _ in taken], status=BackgroundJob.QUEUED).delete()
+    return [payload for _, payload in taken]
+
+
+def backoff(attempts):
+    """Delay before retry number `attempts`: doubling, capped, with jitter."""
+    base = getattr(settings, 'JOB_RETRY_DELAY', 30)
+    delay = min(base * 2 ** (attempts - 1), getattr(settings, 'JOB_MAX_RETRY_DELAY', 3600))
+    return timedelta(seconds=delay * random.uniform(0.8, 1.2))
+
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def requeue_abandoned(now=None):
+    """Put jobs whose worker stopped responding back in the queue."""
+    now = now or timezone.now()
+    cutoff = now - timedelta(seconds=getattr(settings, 'JOB_LOCK_TIMEOUT', 600))
+    return BackgroundJob.objects.filter(status=BackgroundJob.RUNNING, locked_at__lt=cutoff).update(
+        status=BackgroundJob.QUEUED, locked_at=None, locked_by='',
+    )
+
+
+def claim(worker, now=None, candidates=10):
+    """Claim the next due job for this worker, or return None."""
+    now = now or timezone.now()
+    due = BackgroundJob.objects.filter(status=BackgroundJob.QUEUED, run_at__lte=now).order_by('run_at', 'pk')
+    for pk in due.values_list('pk', flat=True)[:candidates]:
+        # only one worker's UPDATE can still match the queued row
+        claimed = BackgroundJob.objects.filter(pk=pk, status=BackgroundJob.QUEUED).update(
+            status=BackgroundJob.RUNNING, locked_at=now, locked_by=worker,
+        )
+        if claimed:
+            return BackgroundJob.objects.get(pk=pk)
+    return None
+
+
+def run_job(job):
+    """Run a claimed job; returns True if it succeeded."""
+    try:
+        func = TASKS[job.task]
+        with transaction.atomic():
+            func(**job.payload)
+    except Exception:
+        job.attempts += 1
+        job.last_error = traceback.format_exc()
+        job.locked_at, job.locked_by = None, ''
+        if job.attempts < job.max_attempts:
+            job.status = BackgroundJob.QUEUED
+            job.run_at = timezone.now() + backoff(job.attempts)
+            logger.warning('Job %s (%s) failed, retrying at %s', job.pk, job.task, job.run_at)
+        else:
+            job.status = BackgroundJob.FAILED
+            logger.error('Job %s (%s) failed for good after %s attempts', job.pk, job.task, job.attempts)
+        job.save(update_fields=['attempts', 'last_error', 'locked_at', 'locked_by', 'status', 'run_at'])
+        return False
+    job.delete()
+    return True
+
+
+def run_pending(worker=None, limit=None):
+    """Run due jobs until none are left (or `limit` ran). Returns (succeeded, failed)."""
+    worker = worker or worker_name()
+    requeue_abandoned()
+    succeeded = failed = 0
+    while limit is None or succeeded + failed < limit:
+        job = claim(worker)
+        if job is None:
+            break
+        if run_job(job):
+            succeeded += 1
+        else:
+            failed += 1
+    return succeeded, failed
+
+
+# Tasks
+
+@task('cloudinary.destroy')
+def destroy_cloudinary_image(public_id):
+    result = cloudinary.uploader.destroy(public_id)
+    # 'not found' means an earlier attempt already removed it
+    if result.get('result') not in ('ok', 'not found'):
+        raise RuntimeError(f'Cloudinary could not delete {public_id}: {result}')
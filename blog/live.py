@@ -0,0 +1,304 @@
+"""
+Live updates for open post pages, streamed as Server-Sent Events.
+
+A reader's page holds one ``EventSource`` connection to ``post_stream``,
+which subscribes it to the post's channel in the process-wide ``hub``.
+New comments are pushed as ``comment`` events once their transaction
+commits; view counts as ``views`` events after the view counter writes them
+(blog/view_counter.py), at most once per ``LIVE_VIEWS_INTERVAL`` per post.
+
+Messages go through a pluggable backend (``LIVE_BACKEND``):
+
+* ``LocalBackend`` delivers only to this process's readers: one ASGI
+  worker, or tests.
+* ``DatabaseBackend`` reaches every worker: publishing inserts a LiveEvent
+  row, and each process with readers polls for new rows every
+  ``LIVE_POLL_INTERVAL`` seconds, one query whatever its number of readers.
+  Publishers delete rows older than ``LIVE_EVENT_RETENTION`` seconds about
+  once a minute, so the table stays small whether or not anyone is reading.
+
+A subscriber is an in-memory queue of encoded events served by an async
+generator, so an idle reader costs no thread. Each process accepts at most
+``LIVE_MAX_CONNECTIONS`` readers (more get a 503 and EventSource retries
+later), and a reader whose unsent events exceed ``LIVE_SUBSCRIBER_BUFFER``
+bytes is disconnected rather than buffered without limit; its browser
+reconnects a few seconds later, without the events it missed.
+
+Streaming needs ASGI (``uvicorn personal_blog.asgi:application``); under
+WSGI the endpoint answers 204, which tells EventSource not to retry.
+"""
+import asyncio
+import json
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.dispatch import receiver
+from django.test.signals import setting_changed
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import LiveEvent
+
+logger = logging.getLogger(__name__)
+
+RETRY = b'retry: 5000\n\n'  # EventSource reconnect delay, milliseconds
+KEEPALIVE = b': keepalive\n\n'
+
+
+class TooManyConnections(Exception):
+    pass
+
+
+def post_channel(post_id):
+    return f'post:{post_id}'
+
+
+def encode(event, data):
+    return f'event: {event}\ndata: {json.dumps(data, separators=(",", ":"))}\n\n'
+
+
+class Subscription:
+    def __init__(self, channel, max_bytes):
+        self.channel = channel
+        self.max_bytes = max_bytes
+        self.queue = deque()
+        self.nbytes = 0
+        self.ready = asyncio.Event()
+        self.closed = False
+
+    def put(self, data):
+        """Queue an encoded event; runs on the event loop."""
+        if self.closed:
+            return
+        if self.nbytes + len(data) > self.max_bytes:
+            logger.info('Dropping a live reader of %s that fell %s bytes behind', self.channel, self.nbytes)
+            self.close()
+            return
+        self.queue.append(data)
+        self.nbytes += len(data)
+        self.ready.set()
+
+    def close(self):
+        self.closed = True
+        self.queue.clear()
+        self.nbytes = 0
+        self.ready.set()
+
+
+class Hub:
+    """This process's subscribers, by channel."""
+
+    def __init__(self):
+        self.channels = defaultdict(set)
+        self.count = 0
+        self.loop = None
+        self._backend = None
+        self._views_lock = threading.Lock()
+        self._views_due = {}  # post id -> views not pushed yet
+        self._views_sent = {}  # post id -> when views were last pushed
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            path = getattr(settings, 'LIVE_BACKEND', 'blog.live.LocalBackend')
+            self._backend = import_string(path)(self)
+        return self._backend
+
+    def has_room(self):
+        return self.count < getattr(settings, 'LIVE_MAX_CONNECTIONS', 5000)
+
+    def subscribe(self, channel):
+        """Add a subscriber; call on the event loop."""
+        if not self.has_room():
+            raise TooManyConnections(channel)
+        self.loop = asyncio.get_running_loop()
+        subscription = Subscription(channel, getattr(settings, 'LIVE_SUBSCRIBER_BUFFER', 64 * 1024))
+        self.channels[channel].add(subscription)
+        self.count += 1
+        self.backend.start()
+        return subscription
+
+    async def stream(self, channel, keepalive):
+        """
+        The response body: subscribe, then yield events as they arrive and
+        keepalives in between. Subscribing on first iteration means a
+        response that is never sent holds no subscription.
+        """
+        try:
+            subscription = self.subscribe(channel)
+        except TooManyConnections:
+            return
+        try:
+            yield RETRY
+            while not subscription.closed:
+                if not subscription.queue:
+                    subscription.ready.clear()
+                    try:
+                        await asyncio.wait_for(subscription.ready.wait(), keepalive)
+                    except asyncio.TimeoutError:
+                        # keeps proxies from timing out the idle connection
+                        yield KEEPALIVE
+                        continue
+                while subscription.queue:
+                    data = subscription.queue.popleft()
+                    subscription.nbytes -= len(data)
+                    yield data
+        finally:
+            self.unsubscribe(subscription)
+
+    def unsubscribe(self, subscription):
+        subscribers = self.channels.get(subscription.channel)
+        if subscribers and subscription in subscribers:
+            subscribers.discard(subscription)
+            self.count -= 1
+            if not subscribers:
+                del self.channels[subscription.channel]
+
+    def publish(self, channel, event, data):
+        """Send an event to the channel's readers in every process."""
+        self.backend.publish(channel, encode(event, data))
+
+    def deliver(self, channel, message):
+        """Hand a message to this process's readers; safe from any thread."""
+        loop = self.loop
+        if loop is None or channel not in self.channels:
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self._deliver(channel, message)
+            return
+        try:
+            loop.call_soon_threadsafe(self._deliver, channel, message)
+        except RuntimeError:
+            pass  # the loop has shut down
+
+    def _deliver(self, channel, message):
+        data = message.encode()  # shared by every reader of the channel
+        for subscription in list(self.channels.get(channel, ())):
+            subscription.put(data)
+
+    def publish_views(self, counts, now=None):
+        """
+        Push new view counts, each post at most once per LIVE_VIEWS_INTERVAL;
+        counts held back go out on a later call.
+        """
+        now = time.monotonic() if now is None else now
+        interval = getattr(settings, 'LIVE_VIEWS_INTERVAL', 5)
+        with self._views_lock:
+            self._views_due.update(counts)
+            ready = {
+                post_id: views for post_id, views in self._views_due.items()
+                if now - self._views_sent.get(post_id, float('-inf')) >= interval
+            }
+            for post_id in ready:
+                del self._views_due[post_id]
+                self._views_sent[post_id] = now
+            # forget posts that have been quiet for a while
+            self._views_sent = {k: t for k, t in self._views_sent.items() if now - t < interval}
+        for post_id, views in ready.items():
+            self.publish(post_channel(post_id), 'views', {'views': views})
+        return len(ready)
+
+
+class LocalBackend:
+    """Delivers within this process only."""
+
+    def __init__(self, hub):
+        self.hub = hub
+
+    def start(self):
+        pass
+
+    def publish(self, channel, message):
+        self.hub.deliver(channel, message)
+
+
+class DatabaseBackend:
+    """Delivers to every process through the LiveEvent table."""
+
+    PRUNE_INTERVAL = 60  # seconds between deletes of old events, per process
+    MAX_GAPS = 1000  # missing pks watched at once
+
+    def __init__(self, hub):
+        self.hub = hub
+        self.task = None
+        self.last = 0
+        self.gaps = {}  # pk skipped over -> when; its insert may not have committed yet
+        self.pruned_at = float('-inf')
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.poll())
+
+    def publish(self, channel, message):
+        LiveEvent.objects.create(channel=channel, message=message)
+        # prune here rather than in the pollers, which only run while readers are connected
+        now = time.monotonic()
+        if now - self.pruned_at >= self.PRUNE_INTERVAL:
+            self.pruned_at = now
+            self.prune()
+
+    async def poll(self):
+        interval = getattr(settings, 'LIVE_POLL_INTERVAL', 1)
+        self.last = (await LiveEvent.objects.order_by('-pk').values_list('pk', flat=True).afirst()) or 0
+        self.gaps = {}
+        while self.hub.count:
+            await asyncio.sleep(interval)
+            try:
+                await self.read()
+            except Exception:
+                logger.exception('Polling live events failed')
+
+    async def read(self, now=None):
+        """
+        Deliver the events published since the last read. Concurrent
+        publishers can commit out of pk order, so pks skipped over are read
+        again until they show up or LIVE_EVENT_LOOKBACK seconds pass
+        (rolled back inserts leave gaps for good).
+        """
+        now = time.monotonic() if now is None else now
+        lookback = getattr(settings, 'LIVE_EVENT_LOOKBACK', 10)
+        self.gaps = {pk: seen for pk, seen in self.gaps.items() if now - seen < lookback}
+        new = Q(pk__gt=self.last)
+        if self.gaps:
+            new |= Q(pk__in=list(self.gaps))
+        delivered = 0
+        async for pk, channel, message in (
+            LiveEvent.objects.filter(new).order_by('pk').values_list('pk', 'channel', 'message')
+        ):
+            if pk > self.last:
+                self.gaps.update(dict.fromkeys(range(max(self.last + 1, pk - self.MAX_GAPS), pk), now))
+                self.last = pk
+            else:
+                del self.gaps[pk]
+            self.hub.deliver(channel, message)
+            delivered += 1
+        if len(self.gaps) > self.MAX_GAPS:
+            self.gaps = dict(sorted(self.gaps.items())[-self.MAX_GAPS:])
+        return delivered
+
+    def prune(self):
+        # every poller has read an event long before this
+        keep = timedelta(seconds=getattr(settings, 'LIVE_EVENT_RETENTION', 300))
+        return LiveEvent.objects.filter(created_at__lt=timezone.now() - keep).delete()[0]
+
+
+hub = Hub()
+
+
+def publish_comment(comment):
+    hub.publish(post_channel(comment.post_id), 'comment', comment.as_json())
+
+
+@receiver(setting_changed)
+def reset_backend(setting, **kwargs):
+    if setting == 'LIVE_BACKEND':
+        hub._backend = None
@@ -0,0 +1,108 @@
+import json
+import platform
+import subprocess
+import time
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_databases, setup_test_environment, teardown_databases, teardown_test_environment
+from django.utils import timezone
+
+from blog import benchmark
+
+from .generate_blog_data import add_size_arguments, sizes
+
+METRICS = ('rps', 'p50', 'p95', 'p99', 'queries')
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def change(old, new):
+    return f'{(new - old) / old * 100:+.1f}%' if old else 'n/a'
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark the hot endpoints in-process on generated data: requests/sec, p50/p95/p99 latency '
+        'and queries per request. Runs on a throwaway test database unless --existing is given.'
+    )
+
+    def add_arguments(self, parser):
+        add_size_arguments(parser)
+        parser.add_argument('--requests', type=int, default=200, help='Timed requests per endpoint.')
+        parser.add_argument('--endpoint', action='append', dest='endpoints',
+                            help=f'Endpoint to run (repeatable): {", ".join(benchmark.ENDPOINTS)}.')
+        parser.add_argument('--existing', action='store_true',
+                            help='Use the configured database as it is (see generate_blog_data) '
+                                 'instead of a throwaway one; comments and follows are written to it.')
+        parser.add_argument('--output', help='Save the results to this JSON file.')
+        parser.add_argument('--compare', help='JSON file of an earlier run to compare with.')
+
+    def handle(self, *args, **options):
+        if options['requests'] < 1:
+            raise CommandError('--requests must be at least 1.')
+        unknown = set(options['endpoints'] or ()) - set(benchmark.ENDPOINTS)
+        if unknown:
+            raise CommandError(f'Unknown endpoints: {", ".join(sorted(unknown))}.')
+        baseline = None
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)['endpoints']
+
+        if options['existing']:
+            dataset, results = None, self.measure(options, baseline)
+        else:
+            setup_test_environment()
+            old_config = setup_databases(verbosity=0, interactive=False)
+            try:
+                started = time.monotonic()
+                dataset = benchmark.generate(**sizes(options))
+                self.stdout.write(
+                    f'Generated {", ".join(f"{n} {name}" for name, n in dataset.items())} '
+                    f'in {time.monotonic() - started:.1f}s.'
+                )
+                results = self.measure(options, baseline)
+            finally:
+                teardown_databases(old_config, verbosity=0)
+                teardown_test_environment()
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({
+                    'revision': git_revision(),
+                    'timestamp': timezone.now().isoformat(),
+                    'python': platform.python_version(),
+                    'django': django.get_version(),
+                    'database': connection.vendor,
+                    'dataset': dataset,
+                    'requests': options['requests'],
+                    'endpoints': results,
+                }, f, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'Saved results to {options["output"]}.'))
+
+    def measure(self, options, baseline):
+        def report(name, result):
+            line = (
+                f'{name:>24}: {result["rps"]:7.1f} req/s  p50 {result["p50"]:6.2f} ms  '
+                f'p95 {result["p95"]:6.2f} ms  p99 {result["p99"]:6.2f} ms  {result["queries"]:5.1f} queries'
+            )
+            if result['errors']:
+                line += f'  {result["errors"]} errors'
+            self.stdout.write(line)
+            old = (baseline or {}).get(name)
+            if old:
+                self.stdout.write(' ' * 26 + '  '.join(f'{m} {change(old[m], result[m])}' for m in METRICS))
+
+        try:
+            return benchmark.run(options['requests'], options['endpoints'], report=report)
+        except ValueError as e:
+            raise CommandError(str(e))
@@ -0,0 +1,137 @@
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+
+from blog.models import Post
+
+SERVERS = {
+    # the synchronous views on gunicorn's sync workers, as deployed today
+    'wsgi': lambda port, workers: [
+        sys.executable, '-m', 'gunicorn', 'personal_blog.wsgi:application',
+        '--bind', f'127.0.0.1:{port}', '--workers', str(workers), '--log-level', 'warning',
+    ],
+    # the async views (personal_blog/asgi.py turns on ASYNC_VIEWS)
+    'asgi': lambda port, workers: [
+        sys.executable, '-m', 'uvicorn', 'personal_blog.asgi:application',
+        '--port', str(port), '--workers', str(workers), '--no-access-log', '--log-level', 'warning',
+    ],
+}
+
+
+async def fetch(port, path, cookie):
+    """One GET on a fresh connection; returns the status code."""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        headers = f'GET {path} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n'
+        if cookie:
+            headers += f'Cookie: {cookie}\r\n'
+        writer.write((headers + '\r\n').encode())
+        await writer.drain()
+        response = await reader.read()
+    finally:
+        writer.close()
+    return int(response.split(b' ', 2)[1])
+
+
+class Command(BaseCommand):
+    help = 'Compare requests/sec and latency of the WSGI (gunicorn) and ASGI (uvicorn, async views) servers.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--servers', default='wsgi,asgi', help='Comma-separated: wsgi, asgi.')
+        parser.add_argument('--path', action='append', dest='paths',
+                            help='Path to request (repeatable; default: home, a post, its author, the JSON feed).')
+        parser.add_argument('--concurrency', type=int, default=16, help='Requests in flight at once.')
+        parser.add_argument('--duration', type=float, default=10, help='Seconds of load per server and path.')
+        parser.add_argument('--workers', type=int, default=2, help='Server worker processes.')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--page-cache', action='store_true',
+                            help='Let anonymous pages be served from the page cache (by default every '
+                                 'request carries a session cookie so the views run).')
+
+    def default_paths(self):
+        post = Post.objects.filter(published=True).select_related('author').order_by('-created_at').first()
+        if post is None:
+            raise CommandError('No published post; pass --path.')
+        return [
+            reverse('blog:home'), post.get_absolute_url(),
+            reverse('blog:author_profile', args=[post.author.username]), reverse('blog:ajax_posts'),
+        ]
+
+    def handle(self, *args, **options):
+        servers = [name.strip() for name in options['servers'].split(',')]
+        unknown = set(servers) - SERVERS.keys()
+        if unknown:
+            raise CommandError(f'Unknown servers: {", ".join(sorted(unknown))}.')
+        paths = options['paths'] or self.default_paths()
+        # an unknown session key: the page cache is skipped and the session lookup still runs
+        cookie = None if options['page_cache'] else f'{settings.SESSION_COOKIE_NAME}=benchmark'
+        self.stdout.write(
+            f'{options["concurrency"]} concurrent clients, {options["duration"]:g}s per path, '
+            f'{options["workers"]} workers, page cache {"on" if options["page_cache"] else "bypassed"}.'
+        )
+        for name in servers:
+            env = {**os.environ, 'ASYNC_VIEWS': str(name == 'asgi')}
+            env.setdefault('DJANGO_SETTINGS_MODULE', 'personal_blog.settings')
+            server = subprocess.Popen(SERVERS[name](options['port'], options['workers']), env=env)
+            try:
+                asyncio.run(self.wait_until_up(options['port'], paths[0], server))
+                for path in paths:
+                    result = asyncio.run(self.load(options, path, cookie))
+                    self.stdout.write(
+                        f'{name:>5} {path}: {result["rps"]:.0f} req/s  p50 {result["p50"]:.1f} ms  '
+                        f'p99 {result["p99"]:.1f} ms  ({result["requests"]} requests, {result["errors"]} errors)'
+                    )
+            finally:
+                server.terminate()
+                server.wait()
+
+    async def wait_until_up(self, port, path, server, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                raise CommandError(f'The server exited with status {server.returncode}.')
+            try:
+                await fetch(port, path, None)
+                return
+            except (OSError, IndexError, ValueError):
+                await asyncio.sleep(0.2)
+        raise CommandError(f'The server did not answer within {timeout}s.')
+
+    async def load(self, options, path, cookie):
+        port = options['port']
+        for _ in range(options['concurrency']):  # warm up every worker
+            await fetch(port, path, cookie)
+        timings, errors = [], 0
+        deadline = time.monotonic() + options['duration']
+
+        async def client():
+            nonlocal errors
+            while time.monotonic() < deadline:
+                started = time.perf_counter()
+                try:
+                    status = await fetch(port, path, cookie)
+                except (OSError, IndexError, ValueError):
+                    status = None
+                if status != 200:
+                    errors += 1
+                    continue
+                timings.append((time.perf_counter() - started) * 1000)
+
+        started = time.monotonic()
+        await asyncio.gather(*(client() for _ in range(options['concurrency'])))
+        elapsed = time.monotonic() - started
+        timings.sort()
+        return {
+            'requests': len(timings),
+            'errors': errors,
+            'rps': len(timings) / elapsed,
+            'p50': statistics.median(timings) if timings else 0,
+            'p99': timings[min(len(timings) - 1, int(len(timings) * 0.99))] if timings else 0,
+        }
@@ -0,0 +1,79 @@
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+
+from blog import timeline
+
+
+class Command(BaseCommand):
+    help = 'Compare timeline read latency (fan-out entries) with the naive Follow/Post join.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='Reader to benchmark (default: the one following the most authors).')
+        parser.add_argument('--iterations', type=int, default=50, help='Timed reads per variant.')
+        parser.add_argument('--pages', type=int, default=3, help='Pages walked per read.')
+        parser.add_argument('--per-page', type=int, default=10)
+
+    def reader(self, username):
+        if username:
+            try:
+                return User.objects.get(username=username)
+            except User.DoesNotExist:
+                raise CommandError(f'No user {username!r}.')
+        user = User.objects.annotate(n=Count('following_set')).filter(n__gt=0).order_by('-n').first()
+        if user is None:
+            raise CommandError('Nobody follows anyone yet.')
+        return user
+
+    def walk(self, read, user, pages, per_page):
+        cursor, rows = None, 0
+        for _ in range(pages):
+            page = read(user, per_page, cursor)
+            rows += len(page)
+            if not page.has_next:
+                break
+            cursor = page.next_cursor
+        return rows
+
+    def measure(self, read, user, options):
+        self.walk(read, user, options['pages'], options['per_page'])  # warm up
+        timings, queries = [], []
+
+        def count(execute, sql, params, many, context):
+            queries.append(1)
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count):
+            for _ in range(options['iterations']):
+                started = time.perf_counter()
+                rows = self.walk(read, user, options['pages'], options['per_page'])
+                timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        return {
+            'rows': rows,
+            'p50': statistics.median(timings),
+            'p95': timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+            'mean': statistics.fmean(timings),
+            'queries': len(queries) / options['iterations'],
+        }
+
+    def handle(self, *args, **options):
+        if options['iterations'] < 1:
+            raise CommandError('--iterations must be at least 1.')
+        user = self.reader(options['user'])
+        following = user.following_set.count()
+        self.stdout.write(
+            f'Reader {user.username} follows {following} authors '
+            f'({len(timeline.popular_following(user))} read live); '
+            f'{options["iterations"]} reads of {options["pages"]} pages.'
+        )
+        for label, read in (('timeline', timeline.timeline_page), ('naive join', timeline.naive_timeline_page)):
+            result = self.measure(read, user, options)
+            self.stdout.write(
+                f'{label:>10}: p50 {result["p50"]:.2f} ms  p95 {result["p95"]:.2f} ms  '
+                f'mean {result["mean"]:.2f} ms  {result["queries"]:.0f} queries/read  {result["rows"]} posts'
+            )
@@ -0,0 +1,92 @@
+import random
+import statistics
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test.utils import override_settings
+
+from blog.models import Post
+from blog.trending import Leaderboard
+
+BENCHMARK_CACHE = 'trending-benchmark'
+
+
+class Command(BaseCommand):
+    help = 'Measure the cost of trending score updates per event, of merging them and of reading the top list.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--events', type=int, default=100000, help='Events recorded one at a time.')
+        parser.add_argument('--flushes', type=int, default=20, help='Timed merges.')
+        parser.add_argument('--batch', type=int, default=1000, help='Events buffered before each merge.')
+        parser.add_argument('--reads', type=int, default=1000, help='Timed reads of the top list.')
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        if min(options['events'], options['flushes'], options['batch'], options['reads']) < 1:
+            raise CommandError('--events, --flushes, --batch and --reads must be at least 1.')
+        post_ids = list(Post.objects.filter(published=True).values_list('pk', flat=True))
+        if not post_ids:
+            raise CommandError('No published posts; generate data first (`manage.py generate_blog_data`).')
+        rng = random.Random(options['seed'])
+        # views skew towards a few popular posts, as in generated data
+        weights = [1 / (rank + 1) for rank in range(len(post_ids))]
+        caches = {**settings.CACHES, BENCHMARK_CACHE: {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': BENCHMARK_CACHE,
+        }}
+        # a private cache, and the checkpoints rolled back: the site's scores are left alone
+        with override_settings(CACHES=caches, TRENDING_CACHE=BENCHMARK_CACHE), transaction.atomic():
+            board = Leaderboard()
+            self.stdout.write(f'{len(post_ids)} published posts, capacity {getattr(settings, "TRENDING_CAPACITY", 1000)}.')
+            self.record(board, rng.choices(post_ids, weights=weights, k=options['events']))
+            self.merge(board, rng, post_ids, weights, options)
+            self.read(board, options['reads'])
+            transaction.set_rollback(True)
+
+    def record(self, board, events):
+        now = time.time()
+        started = time.perf_counter()
+        for post_id in events:
+            board.record(post_id, 1.0, now)
+        elapsed = time.perf_counter() - started
+        distinct = len(board._pending)
+        self.stdout.write(
+            f'    record: {elapsed / len(events) * 1e9:.0f} ns/event  '
+            f'({len(events)} events on {distinct} posts)'
+        )
+        started = time.perf_counter()
+        board.flush(now)
+        self.stdout.write(f'first merge: {(time.perf_counter() - started) * 1000:.2f} ms  (includes a checkpoint)')
+
+    def merge(self, board, rng, post_ids, weights, options):
+        timings = []
+        now = time.time()
+        for _ in range(options['flushes']):
+            now += 10  # a view counter drain every ten seconds
+            counts = {}
+            for post_id in rng.choices(post_ids, weights=weights, k=options['batch']):
+                counts[post_id] = counts.get(post_id, 0) + 1
+            started = time.perf_counter()
+            board.record_many(counts, now)
+            board.flush(now)
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        self.stdout.write(
+            f'     merge: p50 {statistics.median(timings):.2f} ms  max {timings[-1]:.2f} ms  '
+            f'{statistics.fmean(timings) * 1e6 / options["batch"]:.0f} ns/event  '
+            f'({options["batch"]} events per merge)'
+        )
+
+    def read(self, board, reads):
+        board.top()  # warm up
+        timings = []
+        for _ in range(reads):
+            started = time.perf_counter()
+            board.top()
+            timings.append((time.perf_counter() - started) * 1e6)
+        timings.sort()
+        self.stdout.write(
+            f'  top list: p50 {statistics.median(timings):.1f} µs  '
+            f'p95 {timings[min(len(timings) - 1, int(len(timings) * 0.95))]:.1f} µs  ({board.size} posts)'
+        )
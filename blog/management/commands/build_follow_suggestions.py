@@ -0,0 +1,28 @@
+import resource
+import time
+
+from django.core.management.base import BaseCommand
+
+from blog import suggestions
+
+
+class Command(BaseCommand):
+    help = 'Recompute "who to follow" suggestions for users whose follows changed (or everyone, with --all).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Refresh every user, not only stale ones.')
+        parser.add_argument('--batch-size', type=int, default=2000, help='Users claimed and stored at a time.')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        graph = suggestions.Graph.load()
+        self.stdout.write(
+            f'Loaded {graph.follows.nnz} follows between {len(graph)} users in {time.monotonic() - started:.1f}s; '
+            f'scoring {graph.block_size()} users at a time.'
+        )
+        total = suggestions.refresh(everyone=options['all'], graph=graph, batch_size=options['batch_size'])
+        # kilobytes on Linux
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        self.stdout.write(self.style.SUCCESS(
+            f'Refreshed suggestions for {total} users in {time.monotonic() - started:.1f}s (peak memory {peak:.0f} MB).'
+        ))
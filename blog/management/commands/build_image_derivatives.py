@@ -0,0 +1,77 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+# blog modules are imported inside functions: worker processes import this
+# module to find `build` before their app registry is set up
+
+
+def setup_worker():
+    # worker processes started by spawn/forkserver need their own app registry
+    django.setup()
+
+
+def build(item):
+    """Build one image's derivatives in a worker; errors are returned, not raised."""
+    from blog import images
+
+    label, pk, field_name, name = item
+    try:
+        return item, images.build_derivatives(label, field_name, name), None
+    except Exception as exc:
+        return item, None, f'{type(exc).__name__}: {exc}'
+
+
+class Command(BaseCommand):
+    help = 'Generate responsive derivatives for existing post images and avatars, using a process pool.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Worker processes (default: one per CPU; 1 runs in this process).')
+        parser.add_argument('--force', action='store_true', help='Rebuild images that already have derivatives.')
+
+    def pending(self, force):
+        from django.apps import apps
+
+        from blog import images
+
+        for label, field_names in images.IMAGE_FIELDS.items():
+            model = apps.get_model(label)
+            for field_name in field_names:
+                qs = model.objects.exclude(**{field_name: ''}).exclude(**{f'{field_name}__isnull': True})
+                for instance in qs.only('pk', field_name, images.meta_field(field_name)).iterator(chunk_size=500):
+                    if force or images.needs_derivatives(instance, field_name):
+                        yield label, str(instance.pk), field_name, getattr(instance, field_name).name
+
+    def handle(self, *args, **options):
+        from blog import images
+
+        started = time.monotonic()
+        items = list(self.pending(options['force']))
+        workers = max(1, min(options['workers'], len(items)))
+        if workers == 1:
+            results = map(build, items)
+        else:
+            # forked workers must not share the parent's database connections
+            connections.close_all()
+            pool = ProcessPoolExecutor(max_workers=workers, initializer=setup_worker)
+            results = pool.map(build, items, chunksize=4)
+        built = failed = 0
+        try:
+            for (label, pk, field_name, name), meta, error in results:
+                if error:
+                    failed += 1
+                    self.stderr.write(f'{label} {pk} {name}: {error}')
+                elif images.store_derivatives(label, pk, field_name, meta):
+                    built += 1
+        finally:
+            if workers > 1:
+                pool.shutdown()
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Built derivatives for {built} images ({failed} failed) with {workers} workers in {elapsed:.1f}s.'
+        ))
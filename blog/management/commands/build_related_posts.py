@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from blog import related
+
+
+class Command(BaseCommand):
+    help = 'Compute the related posts of every published post from their text and categories.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help='Posts read from the database at a time.')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        corpus = related.Corpus.load(chunk_size=options['chunk_size'])
+        self.stdout.write(
+            f'Vectorized {len(corpus)} posts ({corpus.matrix.shape[1]} terms) in {time.monotonic() - started:.1f}s; '
+            f'scoring {corpus.block_size()} posts at a time.'
+        )
+        total = related.rebuild(corpus)
+        self.stdout.write(self.style.SUCCESS(
+            f'Stored related posts for {total} posts in {time.monotonic() - started:.1f}s.'
+        ))
@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from blog import transfer
+
+
+class Command(BaseCommand):
+    help = 'Write every category, post, comment and follow as JSON Lines, streamed from the database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default='-', help='File to write; "-" (the default) for stdout.')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Rows read from the database at a time.')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        records = transfer.export_records(chunk_size=options['chunk_size'])
+        if options['path'] == '-':
+            counts = transfer.write_records(records, self.stdout)
+            report = self.stderr  # keep stdout for the data
+        else:
+            with open(options['path'], 'w', encoding='utf-8') as out:
+                counts = transfer.write_records(records, out)
+            report = self.stdout
+        elapsed = time.monotonic() - started
+        total = sum(counts.values())
+        report.write(self.style.SUCCESS(
+            f'Exported {", ".join(f"{counts[name]} {name}" for name in transfer.PLURALS.values())} '
+            f'in {elapsed:.1f}s ({total / max(elapsed, 1e-9):.0f} rows/s).'
+        ))
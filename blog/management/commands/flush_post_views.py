@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from blog.view_counter import view_counter
+
+
+class Command(BaseCommand):
+    help = 'Write buffered post views to the database now instead of waiting for the next periodic flush.'
+
+    def handle(self, *args, **options):
+        written = view_counter.flush()
+        if written is None:
+            raise CommandError('Another process is flushing post views; try again shortly.')
+        self.stdout.write(self.style.SUCCESS(f'Flushed {written} post views.'))
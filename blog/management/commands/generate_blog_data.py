@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from blog import benchmark
+
+
+def add_size_arguments(parser):
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--posts', type=int, default=2000)
+    parser.add_argument('--comments', type=int, default=10000)
+    parser.add_argument('--follows', type=int, default=2000)
+    parser.add_argument('--views', type=int, default=50000, help='PostView rows.')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed; the same seed gives the same data.')
+
+
+def sizes(options):
+    if options['users'] < 2:
+        raise CommandError('--users must be at least 2.')
+    return {name: options[name] for name in ('users', 'posts', 'comments', 'follows', 'views', 'seed')}
+
+
+class Command(BaseCommand):
+    help = 'Fill the database with synthetic users, posts, comments, follows and post views for benchmarking.'
+
+    def add_arguments(self, parser):
+        add_size_arguments(parser)
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        with transaction.atomic():
+            counts = benchmark.generate(**sizes(options), log=self.stdout.write)
+        self.stdout.write(self.style.SUCCESS(
+            f'Generated {", ".join(f"{n} {name}" for name, n in counts.items())} '
+            f'in {time.monotonic() - started:.1f}s.'
+        ))
@@ -0,0 +1,47 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from blog import transfer
+
+
+class Command(BaseCommand):
+    help = 'Load categories, posts, comments and follows from JSON Lines written by export_blog, in bulk batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File to read; "-" for stdin.')
+        parser.add_argument('--batch-size', type=int, default=transfer.BATCH_SIZE, help='Rows inserted at a time.')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1.')
+        started = time.monotonic()
+        lines = sys.stdin if options['path'] == '-' else open(options['path'], encoding='utf-8')
+        try:
+            # all or nothing: a bad line rolls back what was inserted before it
+            with transaction.atomic():
+                counts = transfer.import_records(
+                    transfer.read_records(lines), batch_size=options['batch_size'], log=self.stdout.write,
+                )
+        except (OSError, ValueError) as exc:
+            raise CommandError(str(exc))
+        finally:
+            if lines is not sys.stdin:
+                lines.close()
+        elapsed = time.monotonic() - started
+        skipped = {name: n for name, n in counts.items() if name.startswith('skipped') and n}
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {counts["categories"]} categories, {counts["posts"]} posts, {counts["comments"]} comments '
+            f'and {counts["follows"]} follows in {elapsed:.1f}s ({counts["records"] / max(elapsed, 1e-9):.0f} records/s).'
+        ))
+        if counts['users'] or counts['renamed'] or skipped:
+            self.stdout.write(
+                f'Created {counts["users"]} users; renamed {counts["renamed"]} clashing slugs; '
+                f'skipped {", ".join(f"{n} {name[8:]}" for name, n in skipped.items()) or "nothing"}.'
+            )
+        self.stdout.write(
+            'Timelines are refilled by queued jobs (`manage.py run_jobs`); '
+            'run `build_related_posts` and `build_follow_suggestions` to include the new rows.'
+        )
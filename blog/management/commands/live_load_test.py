@@ -0,0 +1,125 @@
+import asyncio
+import contextvars
+import time
+import tracemalloc
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+
+from blog import live
+from blog.models import Post
+
+
+class Reader:
+    """One simulated EventSource connection, driven straight through the ASGI app."""
+
+    def __init__(self, app, scope, events):
+        self.app = app
+        self.scope = scope
+        self.wanted = events
+        self.status = None
+        self.events = 0
+        self.requested = False
+        self.opened = asyncio.Event()
+        self.done = asyncio.Event()
+        self.hangup = asyncio.Event()
+
+    async def receive(self):
+        if not self.requested:
+            self.requested = True
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        await self.hangup.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(self, message):
+        if message['type'] == 'http.response.start':
+            self.status = message['status']
+        elif message['type'] == 'http.response.body':
+            if message.get('body') == live.RETRY:
+                self.opened.set()
+            elif message.get('body', b'').startswith(b'event: '):
+                self.events += 1
+                if self.events >= self.wanted:
+                    self.done.set()
+            if not message.get('more_body'):
+                # refused or dropped
+                self.opened.set()
+                self.done.set()
+
+    async def run(self):
+        await self.app(self.scope, self.receive, self.send)
+
+
+class Command(BaseCommand):
+    help = 'Hold many idle live streams in this process and time one event fanned out to all of them.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connections', type=int, default=2000)
+        parser.add_argument('--events', type=int, default=5, help='Events published once every stream is open.')
+        parser.add_argument('--slug', help='Post to stream (default: the newest published post).')
+        parser.add_argument('--timeout', type=float, default=60, help='Seconds to wait for each phase.')
+
+    def handle(self, *args, **options):
+        # async_to_sync keeps the ORM calls of the view on this thread's connection
+        async_to_sync(self.run)(options)
+
+    async def run(self, options):
+        qs = Post.objects.filter(published=True)
+        post = await (qs.filter(slug=options['slug']) if options['slug'] else qs.order_by('-created_at')).afirst()
+        if post is None:
+            raise CommandError('No published post to stream.')
+        path = reverse('blog:post_stream', args=[post.slug])
+        host = next((h for h in settings.ALLOWED_HOSTS if h not in ('*', '') and not h.startswith('.')), 'localhost')
+        app = ASGIHandler()
+        readers = []
+        for i in range(options['connections']):
+            scope = {
+                'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+                'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': b'', 'root_path': '',
+                'headers': [(b'host', host.encode()), (b'accept', b'text/event-stream')],
+                'client': ('127.0.0.1', 10000 + i % 50000), 'server': (host, 80),
+            }
+            readers.append(Reader(app, scope, options['events']))
+
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        # each connection starts from an empty context, as under a server, so
+        # the handler gives each its own thread for sync code
+        tasks = [asyncio.create_task(reader.run(), context=contextvars.Context()) for reader in readers]
+        try:
+            await asyncio.wait_for(asyncio.gather(*(r.opened.wait() for r in readers)), options['timeout'])
+            connect_time = time.perf_counter() - started
+            held = [r for r in readers if r.status == 200 and not r.done.is_set()]
+            per_stream = (tracemalloc.get_traced_memory()[0] - before) / max(1, len(held))
+            tracemalloc.stop()
+            self.stdout.write(
+                f'{len(held)} streams open, {len(readers) - len(held)} refused, in {connect_time:.2f}s; '
+                f'~{per_stream / 1024:.1f} KiB per stream, {live.hub.count} subscribers in the hub.'
+            )
+
+            started = time.perf_counter()
+            for n in range(options['events']):
+                await sync_to_async(live.hub.publish)(
+                    live.post_channel(post.pk), 'load-test', {'n': n, 'sent': time.time()},
+                )
+            await asyncio.wait_for(asyncio.gather(*(r.done.wait() for r in held)), options['timeout'])
+            elapsed = time.perf_counter() - started
+            delivered = sum(r.events for r in held)
+            self.stdout.write(self.style.SUCCESS(
+                f'Delivered {delivered} events ({options["events"]} x {len(held)} streams) in {elapsed:.3f}s.'
+            ))
+        finally:
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+            for reader in readers:
+                reader.hangup.set()
+            _, stuck = await asyncio.wait(tasks, timeout=options['timeout'])
+            for task in stuck:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if stuck:
+                self.stderr.write(f'{len(stuck)} streams did not close after the client hung up.')
@@ -0,0 +1,33 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from blog import search
+from blog.models import Post
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text search documents of every post, streaming posts in chunks.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        search.install()
+        started = time.monotonic()
+        total = 0
+        chunk = []
+        posts = Post.objects.only('pk', 'title', 'content').order_by().iterator(chunk_size=chunk_size)
+        for post in posts:
+            chunk.append(post)
+            if len(chunk) == chunk_size:
+                search.index_posts(chunk)
+                total += len(chunk)
+                chunk = []
+                self.stdout.write(f'Indexed {total} posts...')
+        search.index_posts(chunk)
+        total += len(chunk)
+        self.stdout.write(self.style.SUCCESS(
+            f'Indexed {total} posts in {time.monotonic() - started:.1f}s.'
+        ))
@@ -0,0 +1,35 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from blog.models import Comment, Follow, Post, Profile
+
+
+def count_of(queryset, group_by):
+    """Correlated COUNT(*) subquery grouped on one column."""
+    return Coalesce(Subquery(
+        queryset.order_by().values(group_by).annotate(n=Count('pk')).values('n')
+    ), 0)
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the denormalized comment, follower and post counters from scratch.'
+
+    def handle(self, *args, **options):
+        User = get_user_model()
+        with transaction.atomic():
+            missing = User.objects.filter(profile__isnull=True).values_list('pk', flat=True)
+            Profile.objects.bulk_create([Profile(user_id=pk) for pk in missing])
+            posts = Post.objects.update(
+                comment_count=count_of(Comment.objects.filter(post=OuterRef('pk'), moderated=False), 'post'),
+            )
+            profiles = Profile.objects.update(
+                followers_count=count_of(Follow.objects.filter(following=OuterRef('user')), 'following'),
+                following_count=count_of(Follow.objects.filter(follower=OuterRef('user')), 'follower'),
+                published_posts_count=count_of(
+                    Post.objects.filter(author=OuterRef('user'), published=True), 'author'
+                ),
+            )
+        self.stdout.write(self.style.SUCCESS(f'Recounted {posts} posts and {profiles} profiles.'))
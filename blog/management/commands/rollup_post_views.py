@@ -0,0 +1,30 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+
+from blog import analytics
+
+
+class Command(BaseCommand):
+    help = 'Roll raw post views up into hourly and daily rollups and prune raw views past retention.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help='Recompute rollups from this ISO datetime instead of the last run.')
+        parser.add_argument('--retention-days', type=int, default=None,
+                            help='Keep raw views this many days (default: VIEW_ROLLUP_RETENTION_DAYS).')
+        parser.add_argument('--no-prune', action='store_true', help='Do not delete raw views.')
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            since = parse_datetime(options['since'])
+            if since is None or since.tzinfo is None:
+                raise CommandError('--since must be an ISO datetime with a UTC offset.')
+        hours, hourly, daily = analytics.rollup(since=since)
+        self.stdout.write(f'Rolled up {hours} hours into {hourly} hourly and {daily} daily rollups.')
+        if not options['no_prune']:
+            keep = options['retention_days']
+            deleted = analytics.prune(keep=None if keep is None else timedelta(days=keep))
+            self.stdout.write(f'Pruned {deleted} raw views.')
+        self.stdout.write(self.style.SUCCESS('Done.'))
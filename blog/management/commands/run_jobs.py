@@ -0,0 +1,36 @@
+import signal
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from blog import jobs
+
+
+class Command(BaseCommand):
+    help = 'Run queued background jobs (image deletions and other media work).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Run the jobs that are due now, then exit.')
+        parser.add_argument('--sleep', type=float, default=5, help='Seconds to wait when the queue is empty.')
+        parser.add_argument('--worker', default=None, help='Name recorded on claimed jobs (default: host:pid).')
+
+    def handle(self, *args, **options):
+        worker = options['worker'] or jobs.worker_name()
+        if options['once']:
+            succeeded, failed = jobs.run_pending(worker)
+            self.stdout.write(self.style.SUCCESS(f'Ran {succeeded} jobs, {failed} failed.'))
+            return
+
+        stopping = []
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda *_: stopping.append(True))
+        self.stdout.write(f'Worker {worker} waiting for jobs.')
+        while not stopping:
+            close_old_connections()
+            # one job at a time so a stop request is honoured between jobs
+            succeeded, failed = jobs.run_pending(worker, limit=1)
+            if succeeded or failed:
+                continue
+            time.sleep(options['sleep'])
+        self.stdout.write('Worker stopped.')
@@ -0,0 +1,280 @@
+"""
+Request metrics, served in the Prometheus text format at ``/metrics``.
+
+``MetricsMiddleware`` times every request and counts it by view, method and
+status. A fraction of requests (``METRICS_SAMPLE_RATE``) is also
+instrumented in detail:
+
+* the number and total time of their SQL queries, through
+  ``connection.execute_wrapper`` on every database alias;
+* the time spent rendering each top-level template, through the
+  ``blog.metrics.DjangoTemplates`` template backend.
+
+Page cache results are counted from every response (its ``X-Page-Cache``
+header), render cache hits from ``prefetch_rendered`` (blog/rendering.py).
+
+A request slower than ``METRICS_SLOW_REQUEST`` seconds is logged on the
+``blog.metrics`` logger, with its queries if it was sampled; set the rate to
+1.0 while chasing a slow page.
+
+Each process keeps its own numbers and every ``METRICS_PUBLISH_INTERVAL``
+seconds publishes them to ``METRICS_CACHE``; ``/metrics`` adds up the
+snapshots of every process that published recently, so any worker can
+answer a scrape when that cache is shared.
+"""
+import contextvars
+import logging
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+from django.template import TemplateDoesNotExist
+from django.template.backends import django as django_backend
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+WORKERS_KEY = 'metrics:workers'
+
+# name -> (type, help, histogram buckets)
+METRICS = {
+    'blog_requests_total': ('counter', 'Requests by view, method and status code.', None),
+    'blog_request_duration_seconds': ('histogram', 'Request latency by view.', LATENCY_BUCKETS),
+    'blog_request_queries': ('histogram', 'SQL queries per sampled request, by view.', QUERY_COUNT_BUCKETS),
+    'blog_request_query_seconds': ('histogram', 'SQL time per sampled request, by view.', LATENCY_BUCKETS),
+    'blog_template_render_seconds': ('histogram', 'Template render time in sampled requests.', LATENCY_BUCKETS),
+    'blog_cache_requests_total': ('counter', 'Cache lookups by cache and result.', None),
+}
+
+
+def worker_key(pid):
+    return f'metrics:worker:{pid}'
+
+
+class Registry:
+    """This process's metrics: counters and histograms keyed by label tuples."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = defaultdict(dict)  # name -> {labels: value or [bucket counts..., sum]}
+        self._published = 0.0
+
+    def inc(self, name, labels, amount=1):
+        with self._lock:
+            values = self._values[name]
+            values[labels] = values.get(labels, 0) + amount
+
+    def observe(self, name, labels, value):
+        buckets = METRICS[name][2]
+        with self._lock:
+            series = self._values[name].get(labels)
+            if series is None:
+                series = self._values[name][labels] = [0] * (len(buckets) + 1) + [0.0]
+            # counts per bucket (not cumulative), then +Inf, then the sum
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    break
+            else:
+                i = len(buckets)
+            series[i] += 1
+            series[-1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return {name: {labels: (list(v) if isinstance(v, list) else v) for labels, v in values.items()}
+                    for name, values in self._values.items()}
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+            self._published = 0.0
+
+    def publish(self, force=False):
+        """Store this process's snapshot for /metrics, at most once per interval."""
+        interval = getattr(settings, 'METRICS_PUBLISH_INTERVAL', 15)
+        now = time.monotonic()
+        if not force and now - self._published < interval:
+            return False
+        self._published = now
+        cache = metrics_cache()
+        pid = os.getpid()
+        # kept a few intervals, so processes that exit drop out of the total
+        cache.set(worker_key(pid), self.snapshot(), timeout=interval * 4)
+        workers = cache.get(WORKERS_KEY) or []
+        if pid not in workers:
+            cache.set(WORKERS_KEY, [*workers[-255:], pid], timeout=None)
+        return True
+
+    def collect(self):
+        """Every live process's snapshot added up, this process's current one included."""
+        self.publish(force=True)
+        cache = metrics_cache()
+        pids = cache.get(WORKERS_KEY) or []
+        snapshots = cache.get_many([worker_key(pid) for pid in pids])
+        live = [pid for pid in pids if worker_key(pid) in snapshots]
+        if live != pids:
+            cache.set(WORKERS_KEY, live, timeout=None)
+        merged = defaultdict(dict)
+        for snapshot in snapshots.values():
+            for name, values in snapshot.items():
+                for labels, value in values.items():
+                    if isinstance(value, list):
+                        total = merged[name].setdefault(labels, [0] * len(value))
+                        merged[name][labels] = [a + b for a, b in zip(total, value)]
+                    else:
+                        merged[name][labels] = merged[name].get(labels, 0) + value
+        return merged
+
+
+registry = Registry()
+
+
+def metrics_cache():
+    return caches[getattr(settings, 'METRICS_CACHE', 'default')]
+
+
+def cache_result(cache, hits, misses):
+    if hits:
+        registry.inc('blog_cache_requests_total', (('cache', cache), ('result', 'hit')), hits)
+    if misses:
+        registry.inc('blog_cache_requests_total', (('cache', cache), ('result', 'miss')), misses)
+
+
+def escape_label(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def format_labels(labels, extra=()):
+    pairs = [*labels, *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in pairs) + '}'
+
+
+def render_prometheus(values):
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+        for labels, value in sorted(values.get(name, {}).items()):
+            if kind == 'counter':
+                lines.append(f'{name}{format_labels(labels)} {value}')
+                continue
+            cumulative = 0
+            for bound, count in zip([*buckets, '+Inf'], value):
+                cumulative += count
+                lines.append(f'{name}_bucket{format_labels(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{name}_sum{format_labels(labels)} {value[-1]}')
+            lines.append(f'{name}_count{format_labels(labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+class Sample:
+    """What one sampled request did."""
+
+    def __init__(self):
+        self.queries = []  # (sql, seconds)
+        self.templates = []  # (name, seconds)
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((sql, time.perf_counter() - started))
+
+
+_sample = contextvars.ContextVar('metrics_sample', default=None)
+
+
+class Template(django_backend.Template):
+    def render(self, context=None, request=None):
+        sample = _sample.get()
+        if sample is None:
+            return super().render(context, request)
+        started = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            sample.templates.append((self.origin.template_name, time.perf_counter() - started))
+
+
+class DjangoTemplates(django_backend.DjangoTemplates):
+    """The Django template backend, timing renders in sampled requests."""
+
+    def from_string(self, template_code):
+        return Template(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        try:
+            return Template(self.engine.get_template(template_name), self)
+        except TemplateDoesNotExist as exc:
+            django_backend.reraise(exc, self)
+
+
+def is_sampled():
+    rate = getattr(settings, 'METRICS_SAMPLE_RATE', 0.1)
+    return rate >= 1 or random.random() < rate
+
+
+def record(request, response, elapsed, sample):
+    match = getattr(request, 'resolver_match', None)
+    view = match.view_name if match else '<unresolved>'
+    registry.inc('blog_requests_total', (('view', view), ('method', request.method), ('status', response.status_code)))
+    registry.observe('blog_request_duration_seconds', (('view', view),), elapsed)
+    page_cache = response.get('X-Page-Cache')
+    if page_cache:
+        # a stale page is served from the cache too
+        cache_result('page', page_cache != 'miss', page_cache == 'miss')
+    if sample is not None:
+        registry.observe('blog_request_queries', (('view', view),), len(sample.queries))
+        registry.observe('blog_request_query_seconds', (('view', view),), sum(t for _, t in sample.queries))
+        for name, seconds in sample.templates:
+            registry.observe('blog_template_render_seconds', (('template', name),), seconds)
+    if elapsed >= getattr(settings, 'METRICS_SLOW_REQUEST', 1.0):
+        if sample is None:
+            logger.warning('Slow request: %s %s (%s) took %.3fs; not sampled', request.method, request.path, view, elapsed)
+        else:
+            logger.warning(
+                'Slow request: %s %s (%s) took %.3fs, %d queries in %.3fs:\n%s',
+                request.method, request.path, view, elapsed, len(sample.queries),
+                sum(t for _, t in sample.queries),
+                '\n'.join(f'  {seconds * 1000:8.2f} ms  {sql}' for sql, seconds in sample.queries),
+            )
+    try:
+        registry.publish()
+    except Exception:
+        logger.exception('Publishing metrics failed')
+
+
+class MetricsMiddleware:
+    # synchronous on purpose: under ASGI it runs on the thread that also runs
+    # the request's queries, so the execute_wrapper sees the async views' ORM calls
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not is_sampled():
+            started = time.perf_counter()
+            response = self.get_response(request)
+            record(request, response, time.perf_counter() - started, None)
+            return response
+        sample = Sample()
+        token = _sample.set(sample)
+        try:
+            with ExitStack() as stack:
+                for alias in connections:
+                    stack.enter_context(connections[alias].execute_wrapper(sample))
+                started = time.perf_counter()
+                response = self.get_response(request)
+                elapsed = time.perf_counter() - started
+        finally:
+            _sample.reset(token)
+        record(request, response, elapsed, sample)
+        return response
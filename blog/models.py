@@ -1,11 +1,15 @@
 from django.conf import settings
 from django.db import models
+from django.db.models import Q
 from django.contrib.auth.models import User
 from django.utils import timezone
 from django.urls import reverse
+from django.utils.functional import cached_property
+from django.contrib.postgres.search import SearchVectorField
 import uuid
 from ckeditor.fields import RichTextField # pyright: ignore[reportMissingImports]
 from ckeditor_uploader.fields import RichTextUploadingField # type: ignore
+from .rendering import get_rendered
 
 User = settings.AUTH_USER_MODEL if hasattr(settings, 'AUTH_USER_MODEL') else 'auth.User'
 
@@ -22,8 +26,21 @@ class Profile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='profile')
     bio = models.TextField(blank=True)
     avatar = models.ImageField(upload_to='avatars/', blank=True, null=True)
+    avatar_derivatives = models.JSONField(default=dict, blank=True, editable=False)  # see blog/images.py
     is_author = models.BooleanField(default=True)  # toggle to allow post creation
     created_at = models.DateTimeField(auto_now_add=True)
+    # denormalized counters, maintained by signals (see `manage.py recount`)
+    followers_count = models.PositiveIntegerField(default=0)
+    following_count = models.PositiveIntegerField(default=0)
+    published_posts_count = models.PositiveIntegerField(default=0)
+    # follows changed since the "who to follow" suggestions were computed (see blog/suggestions.py)
+    suggestions_stale = models.BooleanField(default=True)
+
+    class Meta:
+        indexes = [
+            # the batch job's queue of users to refresh
+            models.Index(fields=['user'], condition=Q(suggestions_stale=True), name='profile_stale_suggestions_idx'),
+        ]
 
     def __str__(self):
         return f'Profile: {self.user.username}'
@@ -39,6 +56,26 @@ class Follow(models.Model):
     def __str__(self):
         return f'{self.follower} -> {self.following}'
 
+class FollowSuggestion(models.Model):
+    # an author suggested to a user, computed in batch from the follow graph (see blog/suggestions.py)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='follow_suggestions')
+    suggested = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    score = models.FloatField()
+    mutual = models.PositiveIntegerField(default=0)  # authors the user follows who follow them
+    rank = models.PositiveSmallIntegerField()  # 0 for the best
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'suggested'], name='followsuggestion_unique_pair'),
+        ]
+        indexes = [
+            models.Index(fields=['user', 'rank'], name='followsuggestion_user_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.user} -> {self.suggested}?'
+
 class Category(models.Model):
     name = models.CharField(max_length=80, unique=True)
     slug = models.SlugField(max_length=100, unique=True)
@@ -46,30 +83,83 @@ class Category(models.Model):
     def __str__(self):
         return self.name
 
-class Post(models.Model):
+class LoadedValuesMixin:
+    """Remember the stored values so signals can tell what a save changed."""
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = {
+            name: value for name, value in zip(field_names, values) if value is not models.DEFERRED
+        }
+        return instance
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # post_save receivers have compared against the old values by now
+        update_fields = kwargs.get('update_fields')
+        fields = [f for f in self._meta.concrete_fields if not update_fields or f.name in update_fields]
+        self._loaded_values = {**getattr(self, '_loaded_values', {}), **{f.attname: getattr(self, f.attname) for f in fields}}
+
+class Post(LoadedValuesMixin, models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     author = models.ForeignKey(User, on_delete=models.CASCADE, related_name='posts')
     title = models.CharField(max_length=250)
     slug = models.SlugField(max_length=300, unique=True)
     content = RichTextUploadingField()  # Upload-enabled editor
     featured_image = models.ImageField(upload_to='posts/', blank=True, null=True)
+    featured_image_derivatives = models.JSONField(default=dict, blank=True, editable=False)  # see blog/images.py
     category = models.ForeignKey(Category, on_delete=models.SET_NULL, null=True, blank=True, related_name='posts')
     published = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     views = models.PositiveIntegerField(default=0)  # quick count
+    comment_count = models.PositiveIntegerField(default=0)  # visible (not moderated) comments, maintained by signals
     # optional fields: tags, summary, reading_time, etc.
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # keyset pagination of the public feed (blog/pagination.py); partial,
+            # since the public pages never read drafts
+            models.Index(fields=['-created_at', '-id'], condition=Q(published=True), name='post_feed_idx'),
+            # the same feed filtered by category (?category=<slug>)
+            models.Index(fields=['category', '-created_at', '-id'], condition=Q(published=True),
+                         name='post_category_feed_idx'),
+            # covering index for the published count and the feed's latest-change
+            # validator (blog/stats.py, blog/conditional.py)
+            models.Index(fields=['published', 'updated_at'], name='post_updated_idx'),
+            # an author's posts, newest first: the profile (published only,
+            # filtered in the scan) and the dashboard (drafts included)
+            models.Index(fields=['author', '-created_at', '-id'], name='post_author_idx'),
+        ]
 
     def __str__(self):
         return self.title
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self.__dict__.pop('rendered', None)
+
+    @cached_property
+    def rendered(self):
+        # sanitized body, excerpt and reading time (blog/rendering.py)
+        return get_rendered(self)
+
     def get_absolute_url(self):
         return reverse('blog:post_detail', kwargs={'slug': self.slug})
 
-class Comment(models.Model):
+class PostSearchDocument(models.Model):
+    # HTML-stripped copy of a post used for full-text search (see blog/search.py)
+    post = models.OneToOneField(Post, on_delete=models.CASCADE, related_name='search_document')
+    title = models.CharField(max_length=250)
+    body = models.TextField()
+    vector = SearchVectorField(null=True)  # weighted title/body vector, PostgreSQL only
+
+    def __str__(self):
+        return f'Search document: {self.title}'
+
+class Comment(LoadedValuesMixin, models.Model):
     post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='comments')
     author = models.ForeignKey(User, on_delete=models.CASCADE, related_name='comments')
     body = models.TextField()
@@ -78,10 +168,22 @@ class Comment(models.Model):
 
     class Meta:
         ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['post', 'created_at'], name='comment_post_idx'),
+        ]
 
     def __str__(self):
         return f'Comment by {self.author} on {self.post}'
 
+    def as_json(self):
+        # the comments API and live updates (blog/live.py)
+        return {
+            'id': self.pk,
+            'author': self.author.username,
+            'body': self.body,
+            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M'),
+        }
+
 class PostView(models.Model):
     post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='post_views')
     user = models.ForeignKey(User, on_delete=models.CASCADE, blank=True, null=True)
@@ -90,4 +192,121 @@ class PostView(models.Model):
 
     class Meta:
         # optional: prevent duplicate view entries for same user in some time window
-        ordering = ['-created_at']
\ No newline at end of file
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['post', 'created_at'], name='postview_post_idx'),
+            # rollup and retention pruning scan raw views by time (blog/analytics.py)
+            models.Index(fields=['created_at'], name='postview_created_idx'),
+        ]
+
+class PostViewRollup(models.Model):
+    # views per post and hour/day, built from PostView by `manage.py rollup_post_views`
+    HOUR = 'hour'
+    DAY = 'day'
+    PERIOD_CHOICES = [(HOUR, 'Hour'), (DAY, 'Day')]
+
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='view_rollups')
+    period = models.CharField(max_length=4, choices=PERIOD_CHOICES)
+    bucket = models.DateTimeField()  # start of the hour or day, UTC
+    views = models.PositiveIntegerField(default=0)
+    visitors = models.PositiveIntegerField(default=0)  # estimated from the sketch
+    sketch = models.BinaryField()  # HyperLogLog registers of the visitors (blog/hyperloglog.py)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['post', 'period', 'bucket'], name='postviewrollup_unique_bucket'),
+        ]
+        indexes = [
+            models.Index(fields=['period', 'bucket'], name='postviewrollup_bucket_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.post} {self.period} {self.bucket:%Y-%m-%d %H:00}: {self.views} views'
+
+class TrendingScore(models.Model):
+    # checkpoint of a post's decayed popularity, reloaded when the cache loses it (see blog/trending.py)
+    post = models.OneToOneField(Post, on_delete=models.CASCADE, primary_key=True, related_name='trending')
+    score = models.FloatField()  # log of the forward-decayed sum of event weights
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.post}: {self.score:.2f}'
+
+class RelatedPost(models.Model):
+    # a post similar to another, computed offline from their text (see blog/related.py)
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='related_posts')
+    related = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='+')
+    score = models.FloatField()  # cosine similarity, plus a bonus for a shared category
+    rank = models.PositiveSmallIntegerField()  # 0 for the most similar
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['post', 'related'], name='relatedpost_unique_pair'),
+        ]
+        indexes = [
+            # the detail page's list, best first
+            models.Index(fields=['post', 'rank'], name='relatedpost_post_idx'),
+            # the lists naming a post, refilled when it changes
+            models.Index(fields=['related'], name='relatedpost_related_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.post} ~ {self.related} ({self.score:.2f})'
+
+class TimelineEntry(models.Model):
+    # a followed author's post in a reader's timeline, written on publish (see blog/timeline.py)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='timeline_entries')
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='timeline_entries')
+    author = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')  # for unfollow cleanup
+    created_at = models.DateTimeField()  # the post's, so entries sort like the feed
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'post'], name='timeline_unique_post'),
+        ]
+        indexes = [
+            # a reader's timeline, newest first (keyset pagination)
+            models.Index(fields=['user', '-created_at', '-post'], name='timeline_user_idx'),
+            models.Index(fields=['user', 'author'], name='timeline_author_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.user}: {self.post}'
+
+class LiveEvent(models.Model):
+    # a live update on its way to other worker processes (blog/live.py, DatabaseBackend)
+    channel = models.CharField(max_length=100)
+    message = models.TextField()  # encoded Server-Sent Event
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return f'{self.channel}: {self.message[:50]}'
+
+class BackgroundJob(models.Model):
+    # work done outside the request by `manage.py run_jobs` (see blog/jobs.py)
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(QUEUED, 'Queued'), (RUNNING, 'Running'), (FAILED, 'Failed')]
+
+    task = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_at = models.DateTimeField(default=timezone.now)
+    locked_at = models.DateTimeField(blank=True, null=True)
+    locked_by = models.CharField(max_length=100, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['run_at']
+        indexes = [
+            # the worker's poll: due jobs in the order they are due
+            models.Index(fields=['status', 'run_at'], name='job_due_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.task} ({self.status}, attempt {self.attempts})'
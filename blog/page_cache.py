@@ -0,0 +1,192 @@
+"""
+Whole-page cache for anonymous readers.
+
+Views wrapped with ``cache_anonymous_page`` store their rendered response,
+keyed on the path plus the query parameters that change the page, for
+visitors without a session cookie. Responses that set cookies, modify the
+session or use a CSRF token are never stored.
+
+While rendering, a view tags the page with what it shows (``tag(request,
+'post:<id>')``). Each tag has a version token in the cache; ``invalidate``
+replaces the token, which marks every page carrying that tag as stale. A
+stale page keeps being served while a single worker, holding a short lock,
+renders its replacement, so a popular page never stampedes the database.
+Async views are wrapped the same way, with the cache lookup and the store
+each run in one call to the request's thread.
+"""
+import hashlib
+import time
+from functools import wraps
+from urllib.parse import urlencode
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import parse_http_date_safe
+
+KEY_PARAMS = ('page', 'q', 'category', 'cursor')
+LOCK_TIMEOUT = 30
+
+
+def page_cache():
+    return caches[getattr(settings, 'PAGE_CACHE_ALIAS', 'default')]
+
+
+def fresh_for():
+    return getattr(settings, 'PAGE_CACHE_TIMEOUT', 300)
+
+
+def kept_for():
+    # stale pages stay around this much longer so they can be served during regeneration
+    return fresh_for() + getattr(settings, 'PAGE_CACHE_STALE_TIMEOUT', 3600)
+
+
+def tag_key(tag):
+    return f'pagecache:tag:{tag}'
+
+
+def page_key(request):
+    params = sorted((name, request.GET.get(name)) for name in KEY_PARAMS if name in request.GET)
+    raw = f'{request.path}?{urlencode(params)}'
+    return 'pagecache:page:' + hashlib.md5(raw.encode()).hexdigest()
+
+
+def tag(request, *tags):
+    """Record what the page being rendered depends on."""
+    request._page_cache_tags = getattr(request, '_page_cache_tags', set()) | set(tags)
+
+
+def tag_versions(tags):
+    cache = page_cache()
+    keys = {tag_key(t): t for t in tags}
+    versions = cache.get_many(list(keys))
+    for key in keys.keys() - versions.keys():
+        # an unknown (or evicted) tag gets a fresh version, so any page still
+        # holding an older one is treated as stale; it is negative so it is
+        # not mistaken for an invalidation made during a render
+        cache.add(key, -time.time_ns(), timeout=None)
+        versions[key] = cache.get(key)
+    return {keys[key]: version for key, version in versions.items()}
+
+
+def invalidate(*tags):
+    page_cache().set_many({tag_key(t): time.time_ns() for t in tags}, timeout=None)
+
+
+def is_anonymous(request):
+    if settings.SESSION_COOKIE_NAME in request.COOKIES:
+        return False
+    return not request.user.is_authenticated
+
+
+def is_storable(request, response):
+    session = getattr(request, 'session', None)
+    return (
+        response.status_code == 200
+        and not response.streaming
+        and not response.cookies
+        and not request.META.get('CSRF_COOKIE_NEEDS_UPDATE')
+        and not (session is not None and session.modified)
+        and 'private' not in response.get('Cache-Control', '')
+    )
+
+
+def from_entry(request, entry, state):
+    response = HttpResponse(entry['content'], status=entry['status'])
+    for name, value in entry['headers']:
+        response[name] = value
+    response['X-Page-Cache'] = state
+    # answer conditional requests from the stored validators (blog/conditional.py)
+    return get_conditional_response(
+        request,
+        etag=response.get('ETag'),
+        last_modified=parse_http_date_safe(response.get('Last-Modified')),
+        response=response,
+    )
+
+
+def lock_key(key):
+    return f'{key}:lock'
+
+
+def lookup(request):
+    """
+    The first half of the wrapper. Returns (response, key): a cached page to
+    send, or None and the key to store the fresh page under, in which case
+    this request holds the key's regeneration lock. Both are None when the
+    page is not cached and is rendered without being stored.
+    """
+    if request.method not in ('GET', 'HEAD') or not is_anonymous(request):
+        return None, None
+    cache = page_cache()
+    key = page_key(request)
+    entry = cache.get(key)
+    if entry is not None:
+        fresh = (
+            time.time() - entry['stored_at'] < fresh_for()
+            and tag_versions(entry['tags']) == entry['tags']
+        )
+        if fresh:
+            return from_entry(request, entry, 'hit'), None
+    if not cache.add(lock_key(key), 1, timeout=LOCK_TIMEOUT):
+        if entry is not None:
+            return from_entry(request, entry, 'stale'), None
+        return None, None
+    return None, key
+
+
+def store(request, key, response, started):
+    """The second half: store the page rendered since `started` (ns)."""
+    if hasattr(response, 'render') and callable(response.render):
+        response.render()
+    versions = tag_versions(getattr(request, '_page_cache_tags', set()))
+    # a tag invalidated while we were rendering may not be reflected
+    # in this content, so store the page as already stale for it
+    versions = {t: (None if v is None or v > started else v) for t, v in versions.items()}
+    if is_storable(request, response):
+        page_cache().set(key, {
+            'content': response.content,
+            'status': response.status_code,
+            'headers': [(k, v) for k, v in response.items() if k.lower() != 'set-cookie'],
+            'tags': versions,
+            'stored_at': time.time(),
+        }, timeout=kept_for())
+    response['X-Page-Cache'] = 'miss'
+    return response
+
+
+def cache_anonymous_page(view_func):
+    if iscoroutinefunction(view_func):
+        @wraps(view_func)
+        async def async_wrapper(request, *args, **kwargs):
+            # the lookup reads the session and the cache: one trip to the
+            # request's thread rather than one per call
+            response, key = await sync_to_async(lookup)(request)
+            if response is not None:
+                return response
+            if key is None:
+                return await view_func(request, *args, **kwargs)
+            try:
+                started = time.time_ns()
+                response = await view_func(request, *args, **kwargs)
+                return await sync_to_async(store)(request, key, response, started)
+            finally:
+                await page_cache().adelete(lock_key(key))
+        return async_wrapper
+
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        response, key = lookup(request)
+        if response is not None:
+            return response
+        if key is None:
+            return view_func(request, *args, **kwargs)
+        try:
+            started = time.time_ns()
+            response = view_func(request, *args, **kwargs)
+            return store(request, key, response, started)
+        finally:
+            page_cache().delete(lock_key(key))
+    return wrapper
@@ -0,0 +1,185 @@
+"""
+Keyset (cursor) pagination.
+
+Instead of OFFSET, each page is fetched with a WHERE on the ordering columns
+of the row it continues from, so every page is the same short index range
+scan and no COUNT(*) is needed. Cursors are opaque url-safe tokens.
+"""
+import base64
+import binascii
+import json
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+def _value(row, name):
+    if isinstance(row, dict):
+        return row[name]
+    return getattr(row, name)
+
+
+class KeysetPage:
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    @property
+    def has_other_pages(self):
+        return self.has_next or self.has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+
+class KeysetPaginator:
+    """
+    Paginate a queryset on a unique ordering, e.g. ('-created_at', '-pk').
+    The ordering must end in a unique column so the position is exact.
+    """
+
+    def __init__(self, queryset, per_page, ordering=('-created_at', '-pk')):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.ordering = tuple(ordering)
+        self.fields = [name.lstrip('-') for name in self.ordering]
+
+    def encode_cursor(self, row, direction):
+        values = [_value(row, name) for name in self.fields]
+        payload = json.dumps([direction, [v if isinstance(v, (int, float)) else str(v) for v in values]])
+        return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+    def decode_cursor(self, cursor):
+        try:
+            padded = cursor + '=' * (-len(cursor) % 4)
+            direction, raw = json.loads(base64.urlsafe_b64decode(padded.encode()))
+            if direction not in ('next', 'prev') or len(raw) != len(self.fields):
+                raise ValueError
+            opts = self.queryset.model._meta
+            values = [
+                (opts.pk if name == 'pk' else opts.get_field(name)).to_python(value)
+                for name, value in zip(self.fields, raw)
+            ]
+        except (ValueError, TypeError, binascii.Error, ValidationError) as exc:
+            raise InvalidCursor(cursor) from exc
+        return direction, values
+
+    def _beyond(self, values, reverse):
+        """Q matching rows that sort after `values` (before them if reverse)."""
+        condition = Q()
+        equal = {}
+        for spec, name, value in zip(self.ordering, self.fields, values):
+            descending = spec.startswith('-') != reverse
+            condition |= Q(**equal, **{f'{name}__{"lt" if descending else "gt"}': value})
+            equal[name] = value
+        return condition
+
+    def rows_beyond(self, direction, values, limit):
+        """Queryset of up to `limit` rows beyond `values` in `direction`, nearest first."""
+        reverse = direction == 'prev'
+        qs = self.queryset
+        if values is not None:
+            qs = qs.filter(self._beyond(values, reverse))
+        if reverse:
+            qs = qs.order_by(*[name[1:] if name.startswith('-') else '-' + name for name in self.ordering])
+        else:
+            qs = qs.order_by(*self.ordering)
+        return qs[:limit]
+
+    def fetch(self, direction, values, limit):
+        return list(self.rows_beyond(direction, values, limit))
+
+    async def afetch(self, direction, values, limit):
+        return [row async for row in self.rows_beyond(direction, values, limit)]
+
+    def position(self, cursor):
+        if not cursor:
+            return 'next', None
+        return self.decode_cursor(cursor)
+
+    def page(self, cursor=None):
+        direction, values = self.position(cursor)
+        rows = self.fetch(direction, values, self.per_page + 1)
+        return make_page(self, rows, direction, values, self.per_page)
+
+    async def apage(self, cursor=None):
+        direction, values = self.position(cursor)
+        rows = await self.afetch(direction, values, self.per_page + 1)
+        return make_page(self, rows, direction, values, self.per_page)
+
+
+def make_page(paginator, rows, direction, values, per_page):
+    """Build a page from up to per_page + 1 rows fetched nearest first."""
+    reverse = direction == 'prev'
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if reverse:
+        rows.reverse()
+    if not rows:
+        return KeysetPage(rows)
+    has_next = more if not reverse else True
+    has_previous = more if reverse else values is not None
+    return KeysetPage(
+        rows,
+        next_cursor=paginator.encode_cursor(rows[-1], 'next') if has_next else None,
+        previous_cursor=paginator.encode_cursor(rows[0], 'prev') if has_previous else None,
+    )
+
+
+class MergedKeysetPaginator:
+    """
+    Keyset-paginate the union of several querysets sorted the same way, e.g.
+    a materialized list and a live query. Each source is read with its own
+    index range scan of at most per_page + 1 rows and the results are merged;
+    rows whose ordering values are equal are taken to be the same row and
+    shown once. Orderings must name their own columns (say
+    ('-created_at', '-post_id') and ('-created_at', '-pk')) but hold
+    comparable values, all ascending or all descending.
+    """
+
+    def __init__(self, sources, per_page):
+        self.paginators = [KeysetPaginator(qs, per_page, ordering) for qs, ordering in sources]
+        self.per_page = per_page
+        descending = {name.startswith('-') for p in self.paginators for name in p.ordering}
+        if len(descending) != 1:
+            raise ValueError('Merged orderings must all sort the same way.')
+        self.descending = descending.pop()
+
+    def key(self, paginator, row):
+        return tuple(_value(row, name) for name in paginator.fields)
+
+    def encode_cursor(self, row, direction):
+        paginator, row = row
+        return paginator.encode_cursor(row, direction)
+
+    def page(self, cursor=None):
+        direction, values = self.paginators[0].position(cursor)
+        merged = {}
+        for paginator in self.paginators:
+            for row in paginator.fetch(direction, values, self.per_page + 1):
+                merged.setdefault(self.key(paginator, row), (paginator, row))
+        # nearest first: the fetch order of a single source
+        reverse = self.descending != (direction == 'prev')
+        rows = [merged[key] for key in sorted(merged, reverse=reverse)]
+        page = make_page(self, rows[:self.per_page + 1], direction, values, self.per_page)
+        page.object_list = [row for _, row in page.object_list]
+        return page
@@ -0,0 +1,237 @@
+"""
+Related posts, precomputed from the text of every published post.
+
+Each post's title and HTML-stripped body (``search.document_text``, the text
+the search documents hold) is turned into a TF-IDF vector: sublinear term
+frequencies weighted by inverse document frequency, L2-normalized, as rows
+of one sparse matrix. Two posts' similarity is the cosine of their vectors
+plus ``RELATED_POSTS_CATEGORY_WEIGHT`` when they share a category.
+
+Neighbours are found a block of rows at a time: the block times the whole
+matrix transposed gives a dense block x posts slice of scores, sized so it
+stays under ``RELATED_POSTS_MEMORY`` bytes, and the best
+``RELATED_POSTS_COUNT`` of each row are picked with ``argpartition``. They
+are stored as RelatedPost rows, so the detail page reads them in one query
+on ``relatedpost_post_idx``.
+
+``manage.py build_related_posts`` computes every post's list. Afterwards a
+published, edited or unpublished post queues ``related.update``
+(blog/signals.py), which recomputes only the lists that can change: the
+post's own, those that list it, and those it now beats the weakest entry
+of. Storing is cheap, but each run still reads and tokenizes every
+published post to rebuild the vocabulary, IDF weights and matrix, and
+scores the changed posts against all of them; so a run takes over every
+``related.update`` queued meanwhile, and a burst of edits costs one corpus
+load rather than one per edit. Document frequencies shift a little with
+each post, so rebuild in full from time to time (nightly, say).
+
+NumPy and SciPy are imported by the functions that compute, since web
+processes only queue jobs and read rows.
+"""
+import re
+from collections import Counter
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Min
+
+from . import jobs, page_cache
+from .models import Post, RelatedPost
+from .search import document_text
+
+TOKEN_RE = re.compile(r'[^\W\d_]{2,}')
+STOP_WORDS = frozenset(
+    'about above after again all also am an and any are as at be because been before being below between both '
+    'but by can could did do does doing down during each few for from further had has have having he her here '
+    'hers him his how if in into is it its just me more most my no nor not now of off on once only or other our '
+    'ours out over own same she should so some such than that the their theirs them then there these they this '
+    'those through to too under until up very was we were what when where which while who whom why will with '
+    'would you your yours'.split()
+)
+
+
+def related_count():
+    return getattr(settings, 'RELATED_POSTS_COUNT', 5)
+
+
+def tokens(title, content):
+    # the title counts twice: it says what the post is about
+    text = f'{title} {title} {document_text(content)}'.lower()
+    return [word for word in TOKEN_RE.findall(text) if word not in STOP_WORDS]
+
+
+class Corpus:
+    """The TF-IDF matrix of the published posts, one row per post."""
+
+    def __init__(self, ids, categories, matrix):
+        self.ids = ids  # row -> post id
+        self.rows = {post_id: row for row, post_id in enumerate(ids)}
+        self.categories = categories  # row -> category id, -1 for none
+        self.matrix = matrix
+
+    @classmethod
+    def load(cls, chunk_size=500):
+        import numpy as np
+        from scipy import sparse
+
+        vocabulary, ids, categories = {}, [], []
+        indptr, indices, counts = [0], [], []
+        posts = Post.objects.filter(published=True).only('pk', 'title', 'content', 'category_id').order_by('pk')
+        for post in posts.iterator(chunk_size=chunk_size):
+            for term, n in Counter(tokens(post.title, post.content)).items():
+                indices.append(vocabulary.setdefault(term, len(vocabulary)))
+                counts.append(n)
+            indptr.append(len(indices))
+            ids.append(post.pk)
+            categories.append(post.category_id or -1)
+        matrix = sparse.csr_matrix(
+            (np.array(counts, dtype=np.float32), np.array(indices, dtype=np.int32), np.array(indptr, dtype=np.int64)),
+            shape=(len(ids), len(vocabulary)),
+        )
+        df = np.bincount(matrix.indices, minlength=len(vocabulary))
+        idf = (np.log((1 + len(ids)) / (1 + df)) + 1).astype(np.float32)
+        matrix.data = (1 + np.log(matrix.data)) * idf[matrix.indices]
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        matrix = sparse.diags((1 / norms).astype(np.float32)) @ matrix
+        return cls(ids, np.array(categories, dtype=np.int64), matrix.tocsr())
+
+    def __len__(self):
+        return len(self.ids)
+
+    def block_size(self):
+        """Rows scored at once: a dense block of float32 scores plus the sparse product it comes from."""
+        budget = getattr(settings, 'RELATED_POSTS_MEMORY', 64 * 1024 * 1024)
+        return max(1, budget // (max(1, len(self)) * 16))
+
+    def scores(self, rows):
+        """Similarity of each of `rows` to every post, as a dense len(rows) x posts array."""
+        import numpy as np
+
+        scores = (self.matrix[rows] @ self.matrix.T).toarray()
+        weight = getattr(settings, 'RELATED_POSTS_CATEGORY_WEIGHT', 0.1)
+        if weight:
+            block = self.categories[rows][:, None]
+            scores += weight * ((block == self.categories[None, :]) & (block >= 0))
+        scores[np.arange(len(rows)), rows] = -np.inf  # a post is not related to itself
+        return scores
+
+    def neighbours(self, rows):
+        """Yield (post id, [(related id, score), ...] best first) for each of `rows`."""
+        import numpy as np
+
+        k = min(related_count(), len(self) - 1)
+        min_score = getattr(settings, 'RELATED_POSTS_MIN_SCORE', 0.05)
+        size = self.block_size()
+        for start in range(0, len(rows), size):
+            block = np.asarray(rows[start:start + size])
+            if k <= 0:
+                yield from ((self.ids[row], []) for row in block)
+                continue
+            scores = self.scores(block)
+            best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            for row, columns, values in zip(block, best, np.take_along_axis(scores, best, axis=1)):
+                order = np.argsort(-values)
+                yield self.ids[row], [
+                    (self.ids[column], float(value))
+                    for column, value in zip(columns[order], values[order]) if value > min_score
+                ]
+
+
+def store(results, batch_size=1000):
+    """Replace the lists of the posts in `results`, a batch at a time; returns the number of posts."""
+    total, batch = 0, []
+    for item in results:
+        batch.append(item)
+        if len(batch) == batch_size:
+            total += store_batch(batch)
+            batch = []
+    if batch:
+        total += store_batch(batch)
+    return total
+
+
+def store_batch(batch):
+    post_ids = [post_id for post_id, _ in batch]
+    with transaction.atomic():
+        RelatedPost.objects.filter(post_id__in=post_ids).delete()
+        RelatedPost.objects.bulk_create([
+            RelatedPost(post_id=post_id, related_id=related_id, score=score, rank=rank)
+            for post_id, related in batch for rank, (related_id, score) in enumerate(related)
+        ])
+    page_cache.invalidate(*(f'post:{post_id}' for post_id in post_ids))
+    return len(batch)
+
+
+def rebuild(corpus=None):
+    """Compute every published post's list; returns the number of posts."""
+    corpus = corpus or Corpus.load()
+    total = store(corpus.neighbours(list(range(len(corpus)))))
+    # drafts keep no list
+    RelatedPost.objects.filter(post__published=False).delete()
+    return total
+
+
+def stale_rows(corpus, changed):
+    """Rows of the posts whose lists may change now that the `changed` rows did."""
+    import numpy as np
+
+    changed_ids = [corpus.ids[row] for row in changed]
+    stale = set(changed)
+    # lists that name a changed post, whose score moved
+    listing = RelatedPost.objects.filter(related_id__in=changed_ids).values_list('post_id', flat=True)
+    stale.update(corpus.rows[post_id] for post_id in listing if post_id in corpus.rows)
+    # lists a changed post now gets into: it beats their weakest entry, or they are short
+    weakest = np.full(len(corpus), getattr(settings, 'RELATED_POSTS_MIN_SCORE', 0.05), dtype=np.float32)
+    lists = RelatedPost.objects.values('post_id').annotate(n=Count('*'), low=Min('score')).order_by()
+    for row in lists.filter(n__gte=related_count()).values_list('post_id', 'low'):
+        if row[0] in corpus.rows:
+            weakest[corpus.rows[row[0]]] = max(weakest[corpus.rows[row[0]]], row[1])
+    size = corpus.block_size()
+    for start in range(0, len(changed), size):
+        block = np.asarray(changed[start:start + size])
+        # similarity is symmetric: row r's score for a post is that post's score for r
+        beaten = (corpus.scores(block) > weakest[None, :]).any(axis=0)
+        stale.update(np.flatnonzero(beaten).tolist())
+    return sorted(stale)
+
+
+def update(post_ids):
+    """Recompute the lists that posts `post_ids` (new, edited or unpublished) can change."""
+    corpus = Corpus.load()
+    post_ids = [post_id for post_id in Post.objects.filter(pk__in=post_ids).values_list('pk', flat=True)]
+    changed = [corpus.rows[post_id] for post_id in post_ids if post_id in corpus.rows]
+    gone = [post_id for post_id in post_ids if post_id not in corpus.rows]
+    if gone:
+        # unpublished: its list goes, and the lists that named it are refilled
+        listing = set(RelatedPost.objects.filter(related_id__in=gone).values_list('post_id', flat=True))
+        RelatedPost.objects.filter(post_id__in=gone).delete()
+        page_cache.invalidate(*(f'post:{post_id}' for post_id in gone))
+        changed += [corpus.rows[post_id] for post_id in listing if post_id in corpus.rows]
+    if not changed:
+        return 0
+    return store(corpus.neighbours(stale_rows(corpus, changed)))
+
+
+def related_posts(post):
+    """The stored list of `post`, published posts only; one query on relatedpost_post_idx."""
+    return (
+        RelatedPost.objects.filter(post=post, related__published=True)
+        .select_related('related').only('score', 'related__title', 'related__slug', 'related__created_at')
+        .order_by('rank')
+    )
+
+
+def post_changed(post):
+    posts_changed([post.pk])
+
+
+def posts_changed(post_ids):
+    jobs.enqueue('related.update', post_ids=[str(post_id) for post_id in post_ids])
+
+
+@jobs.task('related.update')
+def update_related_posts(post_ids):
+    # one corpus load serves every change queued since
+    queued = jobs.take_queued('related.update')
+    update([*post_ids, *(post_id for payload in queued for post_id in payload['post_ids'])])
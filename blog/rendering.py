@@ -0,0 +1,172 @@
+"""
+Cached rendering of post bodies.
+
+Rendering a post means sanitizing its CKEditor HTML, deriving a plain-text
+excerpt and estimating the reading time. The result is stored in the
+``POST_RENDER_CACHE`` cache under the post id and ``updated_at``, computed
+when the post is saved (see blog/signals.py) and fetched in bulk for list
+pages, so templates never run filters over the raw HTML.
+"""
+import math
+import re
+from html import escape, unescape
+from html.parser import HTMLParser
+from urllib.parse import urlparse
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.text import Truncator
+
+from . import metrics
+
+EXCERPT_LENGTH = 140
+WORDS_PER_MINUTE = 200
+
+ALLOWED_TAGS = {
+    'a', 'abbr', 'b', 'blockquote', 'br', 'caption', 'code', 'del', 'div', 'em', 'figcaption',
+    'figure', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'i', 'img', 'ins', 'li', 'ol', 'p', 'pre',
+    's', 'small', 'span', 'strike', 'strong', 'sub', 'sup', 'table', 'tbody', 'td', 'tfoot', 'th',
+    'thead', 'tr', 'u', 'ul',
+}
+VOID_TAGS = {'br', 'hr', 'img'}
+# tags whose content is dropped along with the tag
+DROP_CONTENT_TAGS = {'script', 'style', 'iframe', 'object', 'embed', 'template', 'noscript'}
+ALLOWED_ATTRIBUTES = {
+    '*': {'class', 'style', 'title', 'dir', 'lang'},
+    'a': {'href', 'name', 'target', 'rel'},
+    'img': {'src', 'alt', 'width', 'height'},
+    'td': {'colspan', 'rowspan', 'align', 'valign'},
+    'th': {'colspan', 'rowspan', 'align', 'valign', 'scope'},
+    'table': {'border', 'cellpadding', 'cellspacing', 'summary'},
+    'ol': {'start', 'type'},
+}
+URL_ATTRIBUTES = {'href', 'src'}
+ALLOWED_SCHEMES = {'', 'http', 'https', 'mailto'}
+UNSAFE_STYLE = re.compile(r'expression|url\s*\(|javascript:|@import|behavior', re.IGNORECASE)
+
+
+class Sanitizer(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.out = []
+        self.text = []
+        self.open_tags = []
+        self.dropping = 0
+
+    def allowed_attrs(self, tag, attrs):
+        allowed = ALLOWED_ATTRIBUTES['*'] | ALLOWED_ATTRIBUTES.get(tag, set())
+        for name, value in attrs:
+            if name not in allowed or value is None:
+                continue
+            if name in URL_ATTRIBUTES and urlparse(value.strip()).scheme.lower() not in ALLOWED_SCHEMES:
+                continue
+            if name == 'style' and UNSAFE_STYLE.search(value):
+                continue
+            yield f' {name}="{escape(value)}"'
+
+    def handle_starttag(self, tag, attrs):
+        if tag in DROP_CONTENT_TAGS:
+            self.dropping += 1
+            return
+        if self.dropping or tag not in ALLOWED_TAGS:
+            return
+        self.out.append(f'<{tag}{"".join(self.allowed_attrs(tag, attrs))}>')
+        if tag in VOID_TAGS:
+            self.text.append(' ')
+        else:
+            self.open_tags.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_TAGS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag in DROP_CONTENT_TAGS:
+            self.dropping = max(self.dropping - 1, 0)
+            return
+        if self.dropping or tag not in self.open_tags:
+            return
+        # close anything left open inside this element
+        while self.open_tags:
+            inner = self.open_tags.pop()
+            self.out.append(f'</{inner}>')
+            if inner == tag:
+                break
+        self.text.append(' ')
+
+    def handle_data(self, data):
+        if not self.dropping:
+            self.out.append(escape(data, quote=False))
+            self.text.append(data)
+
+    def handle_entityref(self, name):
+        self.handle_ref(f'&{name};')
+
+    def handle_charref(self, name):
+        self.handle_ref(f'&#{name};')
+
+    def handle_ref(self, ref):
+        if not self.dropping:
+            self.out.append(ref)
+            self.text.append(unescape(ref))
+
+    def close(self):
+        super().close()
+        while self.open_tags:
+            self.out.append(f'</{self.open_tags.pop()}>')
+
+
+def sanitize(content):
+    """Return (safe HTML, plain text) for a post body."""
+    parser = Sanitizer()
+    parser.feed(content or '')
+    parser.close()
+    text = re.sub(r'\s+', ' ', ''.join(parser.text)).strip()
+    return ''.join(parser.out), text
+
+
+def render_post(post):
+    body_html, text = sanitize(post.content)
+    return {
+        'body_html': body_html,
+        'excerpt': Truncator(text).chars(EXCERPT_LENGTH),
+        'reading_time': max(1, math.ceil(len(text.split()) / WORDS_PER_MINUTE)),
+    }
+
+
+def render_cache():
+    return caches[getattr(settings, 'POST_RENDER_CACHE', 'default')]
+
+
+def render_key(post_id, updated_at):
+    return f'post-render:{post_id}:{updated_at.timestamp() if updated_at else 0}'
+
+
+def get_rendered(post):
+    key = render_key(post.pk, post.updated_at)
+    rendered = render_cache().get(key)
+    if rendered is None:
+        rendered = store_rendered(post)
+    return rendered
+
+
+def store_rendered(post):
+    rendered = render_post(post)
+    render_cache().set(render_key(post.pk, post.updated_at), rendered)
+    return rendered
+
+
+def prefetch_rendered(posts):
+    """Load the renders of many posts with one cache round trip."""
+    posts = [post for post in posts if 'rendered' not in post.__dict__]
+    keys = {render_key(post.pk, post.updated_at): post for post in posts}
+    found = render_cache().get_many(list(keys))
+    metrics.cache_result('render', len(found), len(keys) - len(found))
+    for key, post in keys.items():
+        post.__dict__['rendered'] = found[key] if key in found else store_rendered(post)
+    return posts
+
+
+def invalidate_rendered(post_id, updated_at):
+    render_cache().delete(render_key(post_id, updated_at))
@@ -0,0 +1,125 @@
+"""
+Routing between the primary database and an optional read replica.
+
+Nothing reads from the replica unless asked to: views wrapped with
+``replica_reads`` (the home page, search and post pages) send their
+reads there (page cache and conditional GET lookups included), and
+everything else (writes, forms, the job queue, management commands) stays on
+the primary. Sessions are always read from the primary.
+
+A replica lags behind the primary, so reads after a write go to the primary:
+
+* within a request, once anything has been written;
+* for the client that wrote, for ``DATABASE_REPLICA_LAG`` seconds afterwards.
+  ``PrimaryAfterWriteMiddleware`` notes the write in a short-lived cookie,
+  so the post or comment a reader just submitted is on the page they are
+  sent to next.
+
+Without a ``replica`` alias in DATABASES every read goes to the primary.
+"""
+import contextvars
+from contextlib import contextmanager
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.utils.decorators import sync_and_async_middleware
+
+REPLICA = 'replica'
+PRIMARY_COOKIE = 'db_primary'
+# read from the primary even in replica views
+PRIMARY_APPS = {'sessions'}
+
+
+class RoutingState:
+    def __init__(self, replica=False):
+        self.replica = replica
+        self.wrote = False
+
+
+_state = contextvars.ContextVar('db_routing', default=None)
+
+
+def replica_alias():
+    return REPLICA if REPLICA in settings.DATABASES else None
+
+
+@contextmanager
+def routing(replica=False):
+    """Route the reads of the enclosed code; yields its RoutingState."""
+    state = RoutingState(replica)
+    token = _state.set(state)
+    try:
+        yield state
+    finally:
+        _state.reset(token)
+
+
+def wants_primary(request):
+    return PRIMARY_COOKIE in request.COOKIES
+
+
+def replica_reads(view_func):
+    """Send the view's reads to the replica unless this client wrote recently."""
+    def enable(request):
+        state = _state.get()
+        if state is not None and not wants_primary(request):
+            state.replica = True
+
+    if iscoroutinefunction(view_func):
+        @wraps(view_func)
+        async def async_wrapper(request, *args, **kwargs):
+            enable(request)
+            return await view_func(request, *args, **kwargs)
+        return async_wrapper
+
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        enable(request)
+        return view_func(request, *args, **kwargs)
+    return wrapper
+
+
+def pin_to_primary(state, response):
+    if state.wrote:
+        response.set_cookie(
+            PRIMARY_COOKIE, '1', max_age=getattr(settings, 'DATABASE_REPLICA_LAG', 5),
+            httponly=True, samesite='Lax',
+        )
+    return response
+
+
+@sync_and_async_middleware
+def PrimaryAfterWriteMiddleware(get_response):
+    """Give each request its routing state and pin clients that wrote to the primary."""
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            with routing() as state:
+                return pin_to_primary(state, await get_response(request))
+        return middleware
+
+    def middleware(request):
+        with routing() as state:
+            return pin_to_primary(state, get_response(request))
+    return middleware
+
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if state is None or not state.replica or state.wrote or model._meta.app_label in PRIMARY_APPS:
+            return None
+        return replica_alias()
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            state.wrote = True
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replica holds the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db != REPLICA
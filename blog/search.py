@@ -0,0 +1,168 @@
+"""
+Full-text search over posts.
+
+Every post has a PostSearchDocument holding its title and HTML-stripped body.
+On PostgreSQL the document carries a weighted tsvector (title 'A', body 'B')
+behind a GIN index; on SQLite an external-content FTS5 table mirrors the
+documents through triggers. Both rank matches and return a highlighted
+snippet; other databases fall back to icontains over the stripped text.
+"""
+import html
+import re
+
+from django.conf import settings
+from django.contrib.postgres.search import SearchHeadline, SearchQuery, SearchRank, SearchVector
+from django.db import connections
+from django.db.models import F, FloatField, Q, TextField, Value
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Substr
+from django.utils.html import strip_tags
+
+from .models import PostSearchDocument
+
+# snippets are marked with control characters and turned into <mark> tags by
+# the `highlight` template filter once the surrounding text has been escaped
+MARK_START = '\x02'
+MARK_STOP = '\x03'
+
+FTS_TABLE = 'blog_post_fts'
+
+
+def search_config():
+    return getattr(settings, 'SEARCH_CONFIG', 'english')
+
+
+def document_text(content):
+    """Plain text of a post body as stored in the search document."""
+    text = html.unescape(strip_tags(content or ''))
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+class PostgresSearchBackend:
+    def install(self, connection):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'CREATE INDEX IF NOT EXISTS blog_postsearchdocument_vector_gin '
+                'ON blog_postsearchdocument USING gin (vector)'
+            )
+
+    def index(self, post_ids):
+        config = search_config()
+        PostSearchDocument.objects.filter(post_id__in=post_ids).update(
+            vector=SearchVector('title', weight='A', config=config)
+            + SearchVector('body', weight='B', config=config)
+        )
+
+    def search(self, queryset, q):
+        config = search_config()
+        query = SearchQuery(q, search_type='websearch', config=config)
+        return queryset.filter(search_document__vector=query).annotate(
+            rank=SearchRank(F('search_document__vector'), query),
+            headline=SearchHeadline(
+                'search_document__body', query, config=config,
+                start_sel=MARK_START, stop_sel=MARK_STOP, max_words=35, min_words=15,
+            ),
+        )
+
+
+class SQLiteSearchBackend:
+    # the FTS table reads its text from blog_postsearchdocument and is kept in
+    # step with it by triggers, so index() has nothing to do
+    install_sql = [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+        f"title, body, content='blog_postsearchdocument', content_rowid='id')",
+        f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON blog_postsearchdocument BEGIN "
+        f"INSERT INTO {FTS_TABLE}(rowid, title, body) VALUES (new.id, new.title, new.body); END",
+        f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON blog_postsearchdocument BEGIN "
+        f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, title, body) VALUES ('delete', old.id, old.title, old.body); END",
+        f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE ON blog_postsearchdocument BEGIN "
+        f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, title, body) VALUES ('delete', old.id, old.title, old.body); "
+        f"INSERT INTO {FTS_TABLE}(rowid, title, body) VALUES (new.id, new.title, new.body); END",
+    ]
+
+    def install(self, connection):
+        with connection.cursor() as cursor:
+            for sql in self.install_sql:
+                cursor.execute(sql)
+
+    def index(self, post_ids):
+        pass
+
+    def match_expression(self, q):
+        terms = re.findall(r'\w+', q)
+        return ' '.join('"%s"' % term for term in terms)
+
+    def search(self, queryset, q):
+        match = self.match_expression(q)
+        if not match:
+            return queryset.none()
+        # restrict the FTS lookup to the outer row's document so each rank and
+        # snippet is a rowid probe rather than a scan of every match
+        row = (
+            f'{FTS_TABLE} MATCH %s AND {FTS_TABLE}.rowid = '
+            f'(SELECT id FROM blog_postsearchdocument WHERE post_id = blog_post.id)'
+        )
+        return queryset.filter(
+            pk__in=RawSQL(
+                f'SELECT d.post_id FROM {FTS_TABLE} '
+                f'JOIN blog_postsearchdocument d ON d.id = {FTS_TABLE}.rowid '
+                f'WHERE {FTS_TABLE} MATCH %s',
+                [match],
+            )
+        ).annotate(
+            rank=RawSQL(f'SELECT -bm25({FTS_TABLE}, 10.0, 1.0) FROM {FTS_TABLE} WHERE {row}',
+                        [match], output_field=FloatField()),
+            headline=RawSQL(
+                f"SELECT snippet({FTS_TABLE}, 1, %s, %s, '...', 35) FROM {FTS_TABLE} WHERE {row}",
+                [MARK_START, MARK_STOP, match], output_field=TextField(),
+            ),
+        )
+
+
+class FallbackSearchBackend:
+    def install(self, connection):
+        pass
+
+    def index(self, post_ids):
+        pass
+
+    def search(self, queryset, q):
+        return queryset.filter(
+            Q(search_document__title__icontains=q) | Q(search_document__body__icontains=q)
+        ).annotate(
+            rank=Value(0.0, output_field=FloatField()),
+            headline=Substr('search_document__body', 1, 200),
+        )
+
+
+BACKENDS = {
+    'postgresql': PostgresSearchBackend,
+    'sqlite': SQLiteSearchBackend,
+}
+
+
+def get_backend(using='default'):
+    return BACKENDS.get(connections[using].vendor, FallbackSearchBackend)()
+
+
+def install(using='default'):
+    """Create the GIN index or FTS table; run after migrate."""
+    get_backend(using).install(connections[using])
+
+
+def index_posts(posts):
+    """Create or refresh the search documents of the given posts."""
+    posts = list(posts)
+    if not posts:
+        return
+    PostSearchDocument.objects.bulk_create(
+        [PostSearchDocument(post_id=post.pk, title=post.title, body=document_text(post.content))
+         for post in posts],
+        update_conflicts=True, unique_fields=['post'], update_fields=['title', 'body'],
+    )
+    get_backend().index([post.pk for post in posts])
+
+
+def search_posts(queryset, q):
+    """Filter a Post queryset to matches for q, best first."""
+    return get_backend().search(queryset, q).order_by('-rank', '-created_at')
@@ -1,9 +1,24 @@
 # signals.py
-from django.db.models.signals import post_save, pre_delete, pre_save
+from django.db.models.signals import post_save, pre_delete, pre_save, post_migrate, post_delete
 from django.dispatch import receiver
 from django.contrib.auth import get_user_model
-from .models import Profile, Post
-import cloudinary.uploader #type: ignore
+from django.db.models import F
+from django.db import transaction
+from django.db.models.functions import Greatest
+from .models import Profile, Post, Comment, Follow, Category, RelatedPost
+from . import search
+from .stats import invalidate_category_counts, invalidate_dashboard_stats, invalidate_published_post_count
+from .rendering import invalidate_rendered, store_rendered
+from . import page_cache
+from . import jobs
+from . import images
+from . import timeline
+from . import live
+from . import related
+from . import suggestions
+from .trending import leaderboard
+from .view_counter import view_counter
+from functools import partial
 from urllib.parse import urlparse
 
 User = get_user_model()
@@ -16,8 +31,11 @@ def create_profile(sender, instance, created, **kwargs):
 
 def get_public_id(file_field):
     """
-    Extract public_id from a CloudinaryField or ImageField URL.
+    Extract public_id from a CloudinaryField or ImageField URL, or from a
+    stored file name.
     """
+    if isinstance(file_field, str):
+        return file_field.split("/")[-1].split(".")[0] or None
     if hasattr(file_field, 'public_id'):
         return file_field.public_id
     elif file_field and hasattr(file_field, 'url'):
@@ -29,27 +47,343 @@ def get_public_id(file_field):
 @receiver(pre_delete, sender=Post)
 def delete_post_image_from_cloudinary(sender, instance, **kwargs):
     """
-    Delete image from Cloudinary when post is deleted.
+    Queue deletion of the post's image from Cloudinary; the job commits with
+    the delete and runs in `manage.py run_jobs`.
     """
-    public_id = get_public_id(instance.featured_image)
+    public_id = get_public_id(instance.featured_image.name or '')
     if public_id:
-        cloudinary.uploader.destroy(public_id)
+        jobs.enqueue('cloudinary.destroy', public_id=public_id)
+    drop_image_derivatives(instance, 'featured_image', instance.featured_image.name)
+
+
+def saves_image(instance, update_fields):
+    return not instance._state.adding and (not update_fields or 'featured_image' in update_fields)
 
 
 @receiver(pre_save, sender=Post)
-def delete_old_image_on_update(sender, instance, **kwargs):
+def load_old_image(sender, instance, update_fields=None, **kwargs):
     """
-    Delete old image from Cloudinary if image is cleared or replaced.
+    Make sure the stored image name is known before an image change is
+    saved. Posts loaded normally already carry it in `_loaded_values`; only
+    a deferred image costs a (single column) query, and saves that leave
+    the image alone cost none.
     """
-    if not instance.pk:  # New object, skip
+    loaded = getattr(instance, '_loaded_values', None)
+    if not saves_image(instance, update_fields) or (loaded and 'featured_image' in loaded):
         return
+    old_name = Post.objects.filter(pk=instance.pk).values_list('featured_image', flat=True).first()
+    instance._loaded_values = {**(loaded or {}), 'featured_image': old_name}
 
-    try:
-        old_instance = Post.objects.get(pk=instance.pk)
-    except Post.DoesNotExist:
-        return
 
-    if old_instance.featured_image and old_instance.featured_image != instance.featured_image:
-        public_id = get_public_id(old_instance.featured_image)
+@receiver(post_save, sender=Post)
+def delete_old_image_on_update(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Queue deletion of the old image from Cloudinary if it was cleared or
+    replaced; the job commits with the save.
+    """
+    if created or (update_fields and 'featured_image' not in update_fields):
+        return
+    old_name = getattr(instance, '_loaded_values', {}).get('featured_image')
+    if old_name and old_name != instance.featured_image.name:
+        public_id = get_public_id(old_name)
         if public_id:
-            cloudinary.uploader.destroy(public_id)
\ No newline at end of file
+            jobs.enqueue('cloudinary.destroy', public_id=public_id)
+        drop_image_derivatives(instance, 'featured_image', old_name)
+
+
+def drop_image_derivatives(instance, field_name, source):
+    """Queue deletion of the derivatives built from an image that is going away."""
+    meta = getattr(instance, images.meta_field(field_name)) or {}
+    names = images.derivative_names(meta)
+    if names and meta.get('source') == source:
+        images.queue_deletion(instance, field_name, names)
+
+
+@receiver(post_save, sender=Post)
+@receiver(post_save, sender=Profile)
+def queue_image_derivatives(sender, instance, update_fields=None, **kwargs):
+    """
+    Queue resized copies of a new or replaced image (blog/images.py). Saves
+    that keep an image known from `_loaded_values` queue nothing, even if
+    its derivatives are still missing; the backfill command covers those.
+    """
+    loaded = getattr(instance, '_loaded_values', {})
+    for field_name in images.IMAGE_FIELDS[instance._meta.label_lower]:
+        if update_fields and field_name not in update_fields:
+            continue
+        if loaded.get(field_name) == getattr(instance, field_name).name:
+            continue
+        if images.needs_derivatives(instance, field_name):
+            images.queue_derivatives(instance, field_name)
+
+
+@receiver(post_save, sender=Post)
+def update_search_document(sender, instance, update_fields=None, **kwargs):
+    """
+    Keep the post's search document in step with its title and content.
+    """
+    if update_fields and not {'title', 'content'} & set(update_fields):
+        return
+    search.index_posts([instance])
+
+
+@receiver(post_migrate)
+def install_search_backend(sender, using, **kwargs):
+    """
+    Create the full-text index (GIN on PostgreSQL, FTS5 on SQLite).
+    """
+    if sender.name == 'blog':
+        search.install(using)
+
+
+def bump(queryset, field, delta):
+    """
+    Atomically add delta to a counter column without letting it go negative.
+    """
+    queryset.update(**{field: Greatest(F(field) + delta, 0)})
+
+
+def was_moderated(instance, created):
+    return instance.moderated if created else getattr(instance, '_loaded_values', {}).get('moderated', instance.moderated)
+
+
+@receiver(post_save, sender=Comment)
+def comment_created(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Count the comment on its post while it is visible: when it is created
+    unmoderated, and when moderation hides or shows it again.
+    """
+    if update_fields and 'moderated' not in update_fields:
+        return
+    if created and not instance.moderated:
+        bump(Post.objects.filter(pk=instance.post_id), 'comment_count', 1)
+    elif not created and instance.moderated != was_moderated(instance, created):
+        bump(Post.objects.filter(pk=instance.post_id), 'comment_count', -1 if instance.moderated else 1)
+
+
+@receiver(post_save, sender=Comment)
+def push_new_comment(sender, instance, created, **kwargs):
+    """Send a new comment to the post's open pages once it is committed."""
+    if created and not instance.moderated:
+        transaction.on_commit(partial(live.publish_comment, instance))
+
+
+@receiver(post_save, sender=Comment)
+def comment_trending(sender, instance, created, **kwargs):
+    if created and not instance.moderated:
+        transaction.on_commit(partial(comment_committed, instance.post_id))
+
+
+def comment_committed(post_id):
+    leaderboard.comment_added(post_id)
+    # the view counter's periodic flush publishes the trending scores
+    view_counter.ensure_started()
+
+
+@receiver([post_save, post_delete], sender=Post)
+def post_changed_trending(sender, instance, update_fields=None, **kwargs):
+    # the trending list shows the title and url, and only published posts
+    if update_fields and not {'title', 'slug', 'published'} & set(update_fields):
+        return
+    transaction.on_commit(partial(leaderboard.post_changed, instance.pk))
+
+
+@receiver(post_delete, sender=Comment)
+def comment_deleted(sender, instance, origin=None, **kwargs):
+    if isinstance(origin, Post) and origin.pk == instance.post_id:
+        return  # the post itself is going away
+    if not was_moderated(instance, False):
+        bump(Post.objects.filter(pk=instance.post_id), 'comment_count', -1)
+
+
+@receiver(post_save, sender=Follow)
+def follow_created(sender, instance, created, **kwargs):
+    if created:
+        bump(Profile.objects.filter(user_id=instance.following_id), 'followers_count', 1)
+        bump(Profile.objects.filter(user_id=instance.follower_id), 'following_count', 1)
+
+
+@receiver(post_delete, sender=Follow)
+def follow_deleted(sender, instance, **kwargs):
+    bump(Profile.objects.filter(user_id=instance.following_id), 'followers_count', -1)
+    bump(Profile.objects.filter(user_id=instance.follower_id), 'following_count', -1)
+
+
+@receiver(post_save, sender=Follow)
+@receiver(post_delete, sender=Follow)
+def follow_changed_suggestions(sender, instance, created=True, **kwargs):
+    if created:
+        suggestions.mark_stale(instance.follower_id)
+
+
+@receiver(post_save, sender=Follow)
+def follow_created_timeline(sender, instance, created, **kwargs):
+    # after the counters above, so the author's popularity is current
+    if created:
+        timeline.follow_added(instance.follower_id, instance.following_id)
+
+
+@receiver(post_delete, sender=Follow)
+def follow_deleted_timeline(sender, instance, **kwargs):
+    timeline.follow_removed(instance.follower_id, instance.following_id)
+
+
+@receiver(post_save, sender=Post)
+def update_published_posts_count(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Count the post for its author when it is created published or changes
+    published state.
+    """
+    if update_fields and 'published' not in update_fields:
+        return
+    loaded = getattr(instance, '_loaded_values', {})
+    was_published = False if created else loaded.get('published', instance.published)
+    if instance.published != was_published:
+        bump(Profile.objects.filter(user_id=instance.author_id), 'published_posts_count',
+             1 if instance.published else -1)
+        invalidate_published_post_count()
+
+
+@receiver(post_save, sender=Post)
+def post_changed_category_counts(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Drop the cached category list when the post changes published state or,
+    being published, moves to another category. Drafts never count.
+    """
+    if update_fields and not {'published', 'category'} & set(update_fields):
+        return
+    loaded = getattr(instance, '_loaded_values', {})
+    was_published = False if created else loaded.get('published', instance.published)
+    old_category = instance.category_id if created else loaded.get('category_id', instance.category_id)
+    if instance.published != was_published or (instance.published and old_category != instance.category_id):
+        invalidate_category_counts()
+
+
+@receiver(post_save, sender=Post)
+def fan_out_published_post(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Copy a newly published post into its author's followers' timelines, or
+    take an unpublished one out again (blog/timeline.py). Deleted posts
+    lose their entries by cascade.
+    """
+    if update_fields and 'published' not in update_fields:
+        return
+    loaded = getattr(instance, '_loaded_values', {})
+    was_published = False if created else loaded.get('published', instance.published)
+    if instance.published and not was_published:
+        timeline.post_published(instance)
+    elif was_published and not instance.published:
+        timeline.post_unpublished(instance)
+
+
+RELATED_FIELDS = ('title', 'content', 'category_id', 'published')
+
+
+@receiver(post_save, sender=Post)
+def queue_related_posts(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Queue a related-posts update (blog/related.py) when a post is published,
+    unpublished, or changes text or category while published.
+    """
+    if update_fields and not {'title', 'content', 'category', 'published'} & set(update_fields):
+        return
+    loaded = getattr(instance, '_loaded_values', {})
+    was_published = False if created else loaded.get('published', instance.published)
+    if not (instance.published or was_published):
+        return  # drafts are not compared
+    if created or any(loaded.get(name, getattr(instance, name)) != getattr(instance, name) for name in RELATED_FIELDS):
+        related.post_changed(instance)
+
+
+@receiver(pre_delete, sender=Post)
+def refill_related_posts(sender, instance, **kwargs):
+    # the lists naming the post lose a row by cascade; the update refills them
+    listing = list(RelatedPost.objects.filter(related=instance).values_list('post_id', flat=True))
+    if listing:
+        related.posts_changed(listing)
+
+
+@receiver(post_delete, sender=Post)
+def post_deleted(sender, instance, **kwargs):
+    if getattr(instance, '_loaded_values', {}).get('published', instance.published):
+        bump(Profile.objects.filter(user_id=instance.author_id), 'published_posts_count', -1)
+        invalidate_published_post_count()
+        invalidate_category_counts()
+
+
+@receiver([post_save, post_delete], sender=Post)
+def post_changed_dashboard(sender, instance, **kwargs):
+    invalidate_dashboard_stats(instance.author_id)
+
+
+@receiver([post_save, post_delete], sender=Comment)
+def comment_changed_dashboard(sender, instance, created=True, origin=None, **kwargs):
+    # edits leave the totals alone unless moderation flips; post_delete sends no `created`
+    if (created or instance.moderated != was_moderated(instance, created)) and not isinstance(origin, Post):
+        invalidate_dashboard_stats(instance.post.author_id)
+
+
+@receiver([post_save, post_delete], sender=Follow)
+def follow_changed_dashboard(sender, instance, created=True, **kwargs):
+    if created:
+        invalidate_dashboard_stats(instance.following_id)
+
+
+@receiver(post_save, sender=Post)
+def render_post_on_save(sender, instance, update_fields=None, **kwargs):
+    """
+    Render the saved body into the cache and drop the render of the
+    previous version.
+    """
+    if update_fields and 'content' not in update_fields:
+        return
+    previous = getattr(instance, '_loaded_values', {}).get('updated_at')
+    if previous and previous != instance.updated_at:
+        invalidate_rendered(instance.pk, previous)
+    store_rendered(instance)
+
+
+@receiver(pre_delete, sender=Post)
+def drop_rendered_post(sender, instance, **kwargs):
+    invalidate_rendered(instance.pk, instance.updated_at)
+
+
+@receiver(post_save, sender=Post)
+def post_slug_changed(sender, instance, created, **kwargs):
+    """Stop counting views of a renamed post's old slug, or of a reused one, against a cached id."""
+    previous = getattr(instance, '_loaded_values', {}).get('slug')
+    if created or previous != instance.slug:
+        view_counter.forget(*filter(None, [previous, instance.slug]))
+
+
+@receiver(post_delete, sender=Post)
+def post_deleted_view_counter(sender, instance, **kwargs):
+    view_counter.forget(instance.slug)
+
+
+# Anonymous page cache invalidation; see the tags set in blog/views.py
+
+@receiver([post_save, post_delete], sender=Post)
+def post_changed_pages(sender, instance, **kwargs):
+    page_cache.invalidate('post-list', f'post:{instance.pk}', f'author:{instance.author_id}')
+
+
+@receiver([post_save, post_delete], sender=Comment)
+def comment_changed_pages(sender, instance, **kwargs):
+    page_cache.invalidate(f'post:{instance.post_id}')
+
+
+@receiver([post_save, post_delete], sender=Follow)
+def follow_changed_pages(sender, instance, **kwargs):
+    page_cache.invalidate(f'author:{instance.following_id}', f'author:{instance.follower_id}')
+
+
+@receiver([post_save, post_delete], sender=Category)
+def category_changed_pages(sender, instance, **kwargs):
+    invalidate_category_counts()
+    page_cache.invalidate('post-list')
+
+
+@receiver(post_save, sender=Profile)
+def profile_changed_pages(sender, instance, **kwargs):
+    page_cache.invalidate(f'author:{instance.user_id}')
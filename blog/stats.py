@@ -0,0 +1,110 @@
+"""
+Cached site and dashboard statistics.
+
+Totals for an author are computed in one aggregate query over the author's
+posts (using the denormalized view and comment counters) joined to their
+profile, and cached per author until a post, comment or follow touching
+them changes (see blog/signals.py). The published post count shown on the
+feed is cached the same way and dropped when a post is published or
+unpublished; ``apublished_post_count`` reads it from async views.
+
+The feed's category list is one annotated query (each category with its
+number of published posts), cached as a whole and dropped only when a post
+is published or unpublished, a published post moves to another category,
+or a category itself changes.
+"""
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import Coalesce
+
+from .models import Category, Post
+
+PUBLISHED_COUNT_KEY = 'posts:published-count'
+CATEGORY_COUNTS_KEY = 'posts:category-counts'
+
+
+def stats_key(user_id):
+    return f'dashboard:stats:{user_id}'
+
+
+def compute_dashboard_stats(user_id):
+    User = get_user_model()
+    return (
+        User.objects.filter(pk=user_id)
+        .annotate(
+            total_posts=Count('posts'),
+            total_views=Coalesce(Sum('posts__views'), 0),
+            total_comments=Coalesce(Sum('posts__comment_count'), 0),
+        )
+        .values('total_posts', 'total_views', 'total_comments', total_followers=Coalesce('profile__followers_count', 0))
+        .get()
+    )
+
+
+def dashboard_stats(user):
+    key = stats_key(user.pk)
+    stats = cache.get(key)
+    if stats is None:
+        stats = compute_dashboard_stats(user.pk)
+        # views are written in batches without signals, so they only refresh on expiry
+        cache.set(key, stats, getattr(settings, 'DASHBOARD_STATS_TIMEOUT', 300))
+    return stats
+
+
+def invalidate_dashboard_stats(*user_ids):
+    cache.delete_many([stats_key(user_id) for user_id in user_ids if user_id])
+
+
+def published_post_count():
+    """Number of published posts, cached rather than counted on every page."""
+    return cache.get_or_set(
+        PUBLISHED_COUNT_KEY,
+        lambda: Post.objects.filter(published=True).count(),
+        getattr(settings, 'PUBLISHED_COUNT_TIMEOUT', 300),
+    )
+
+
+def invalidate_published_post_count():
+    cache.delete(PUBLISHED_COUNT_KEY)
+
+
+async def apublished_post_count():
+    count = await cache.aget(PUBLISHED_COUNT_KEY)
+    if count is None:
+        count = await Post.objects.filter(published=True).acount()
+        await cache.aset(PUBLISHED_COUNT_KEY, count, getattr(settings, 'PUBLISHED_COUNT_TIMEOUT', 300))
+    return count
+
+
+def category_counts_query():
+    return (
+        Category.objects.annotate(post_count=Count('posts', filter=Q(posts__published=True)))
+        .order_by('name').values('id', 'name', 'slug', 'post_count')
+    )
+
+
+def category_counts():
+    """Every category with its number of published posts, ordered by name."""
+    return cache.get_or_set(
+        CATEGORY_COUNTS_KEY, lambda: list(category_counts_query()),
+        getattr(settings, 'CATEGORY_COUNTS_TIMEOUT', 3600),
+    )
+
+
+def invalidate_category_counts():
+    cache.delete(CATEGORY_COUNTS_KEY)
+
+
+async def acategory_counts():
+    categories = await cache.aget(CATEGORY_COUNTS_KEY)
+    if categories is None:
+        categories = [row async for row in category_counts_query()]
+        await cache.aset(CATEGORY_COUNTS_KEY, categories, getattr(settings, 'CATEGORY_COUNTS_TIMEOUT', 3600))
+    return categories
+
+
+def find_category(categories, slug):
+    """The entry of `categories` with `slug`, or None."""
+    return next((category for category in categories if category['slug'] == slug), None)
@@ -0,0 +1,258 @@
+"""
+"Who to follow": author suggestions computed in batch from the Follow graph.
+
+A candidate author is scored for a reader by
+
+* friends of friends: how many of the authors the reader follows follow
+  the candidate;
+* co-follower overlap: the ``FOLLOW_SUGGESTIONS_NEIGHBOURS`` readers whose
+  followed sets are most like the reader's (by cosine) follow the
+  candidate too, weighted by that cosine and scaled by
+  ``FOLLOW_SUGGESTIONS_CO_FOLLOWER_WEIGHT``;
+* a small popularity term, so readers who follow nobody yet still get the
+  most followed authors.
+
+``manage.py build_follow_suggestions`` loads the edge list into two int32
+arrays (8 bytes an edge; a million edges take 8 MB) and a sparse follower x
+author matrix, then scores the readers a block at a time with sparse
+products. Each block's score matrices are bounded by
+``FOLLOW_SUGGESTIONS_MEMORY``. The best ``FOLLOW_SUGGESTIONS_COUNT`` per reader
+are stored as FollowSuggestion rows and read in one query.
+
+Only readers whose suggestions may have changed are refreshed. Following or
+unfollowing marks the reader and the reader's followers stale
+(``Profile.suggestions_stale``, blog/signals.py), since their friends of
+friends changed. The flag is cleared in the transaction that stores the
+reader's new list, so a run that fails or is killed leaves the rest stale
+for the next one. Co-follower scores of other readers drift until their
+next refresh; ``--all`` recomputes everyone.
+
+NumPy and SciPy are imported by the functions that compute, since web
+processes only read the stored rows.
+"""
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+
+from .models import Follow, FollowSuggestion, Profile
+
+
+def suggestion_count():
+    return getattr(settings, 'FOLLOW_SUGGESTIONS_COUNT', 10)
+
+
+class Graph:
+    """The follow graph as a sparse matrix over compact node numbers."""
+
+    def __init__(self, users, follows):
+        import numpy as np
+
+        self.users = users  # node -> user id, sorted
+        self.follows = follows  # node x node, 1 where the row follows the column
+        self.following = np.diff(follows.indptr)  # out-degree per node
+        self.followers = np.bincount(follows.indices, minlength=len(users))  # in-degree per node
+
+    @classmethod
+    def load(cls, chunk_size=100000):
+        import numpy as np
+        from scipy import sparse
+
+        edges = Follow.objects.values_list('follower_id', 'following_id').order_by()
+        sources, targets = [], []
+        chunk = []
+        for edge in edges.iterator(chunk_size=chunk_size):
+            chunk.append(edge)
+            if len(chunk) == chunk_size:
+                block = np.array(chunk, dtype=np.int32)
+                sources.append(block[:, 0])
+                targets.append(block[:, 1])
+                chunk = []
+        if chunk:
+            block = np.array(chunk, dtype=np.int32)
+            sources.append(block[:, 0])
+            targets.append(block[:, 1])
+        sources = np.concatenate(sources) if sources else np.zeros(0, dtype=np.int32)
+        targets = np.concatenate(targets) if targets else np.zeros(0, dtype=np.int32)
+        # user ids -> 0..n-1
+        users, nodes = np.unique(np.concatenate([sources, targets]), return_inverse=True)
+        n = len(users)
+        follows = sparse.csr_matrix(
+            (np.ones(len(sources), dtype=np.float32), (nodes[:len(sources)], nodes[len(sources):])), shape=(n, n),
+        )
+        follows.sum_duplicates()
+        return cls(users, follows)
+
+    def __len__(self):
+        return len(self.users)
+
+    def nodes(self, user_ids):
+        """Node of each user id; -1 for users with no follows either way."""
+        import numpy as np
+
+        user_ids = np.asarray(user_ids, dtype=np.int32)
+        if not len(self.users):
+            return np.full(len(user_ids), -1)
+        nodes = np.minimum(np.searchsorted(self.users, user_ids), len(self.users) - 1)
+        return np.where(self.users[nodes] == user_ids, nodes, -1)
+
+    def block_size(self):
+        """
+        Readers scored at once: three dense float32 matrices (friends of
+        friends, co-follows, scores) and the reader similarities, which
+        popular authors make nearly dense too; about 32 bytes a cell, measured.
+        """
+        budget = getattr(settings, 'FOLLOW_SUGGESTIONS_MEMORY', 256 * 1024 * 1024)
+        return max(1, budget // (max(1, len(self)) * 32))
+
+    def popularity(self):
+        import numpy as np
+
+        # well below one mutual follow, so it only breaks ties and fills empty lists
+        return (0.01 * np.log1p(self.followers) / max(1.0, np.log1p(self.followers.max(initial=0)))).astype(np.float32)
+
+    def scores(self, nodes):
+        """(scores, friends-of-friends counts) of every candidate for each of `nodes`, as dense arrays."""
+        import numpy as np
+
+        rows = self.follows[nodes]
+        mutual = (rows @ self.follows).toarray()
+        # reader similarity: shared followed authors over the geometric mean of their counts
+        shared = rows @ self.follows.T
+        reader = np.repeat(nodes, np.diff(shared.indptr))
+        degree = np.maximum(self.following, 1).astype(np.float32)
+        shared.data /= np.sqrt(degree[reader] * degree[shared.indices])
+        shared.data[reader == shared.indices] = 0  # not oneself
+        weight = getattr(settings, 'FOLLOW_SUGGESTIONS_CO_FOLLOWER_WEIGHT', 1.0)
+        co_followed = (self.most_similar(shared) @ self.follows).toarray()
+        scores = mutual + weight * co_followed + self.popularity()[None, :]
+        # not oneself, nor anyone already followed
+        scores[np.arange(len(nodes)), nodes] = -np.inf
+        scores[rows.nonzero()] = -np.inf
+        return scores, mutual
+
+    def most_similar(self, shared):
+        """
+        Each row of `shared` cut to its FOLLOW_SUGGESTIONS_NEIGHBOURS highest
+        entries. Anyone following a popular author shares it with most
+        readers; summing all of their follows would cost a full row each.
+        """
+        import numpy as np
+        from scipy import sparse
+
+        keep = getattr(settings, 'FOLLOW_SUGGESTIONS_NEIGHBOURS', 50)
+        indptr, indices, data = [0], [], []
+        for i in range(shared.shape[0]):
+            start, end = shared.indptr[i], shared.indptr[i + 1]
+            row = shared.data[start:end]
+            picked = np.argpartition(-row, keep - 1)[:keep] if len(row) > keep else np.arange(len(row))
+            indices.append(shared.indices[start:end][picked])
+            data.append(row[picked])
+            indptr.append(indptr[-1] + len(picked))
+        return sparse.csr_matrix(
+            (np.concatenate(data) if data else [], np.concatenate(indices) if indices else [], indptr),
+            shape=shared.shape,
+        )
+
+    def suggest(self, nodes):
+        """Yield [(user id, score, mutual), ...] best first for each of `nodes`."""
+        import numpy as np
+
+        count = min(suggestion_count(), len(self))
+        for start in range(0, len(nodes), self.block_size()):
+            block = np.asarray(nodes[start:start + self.block_size()])
+            if count == 0:
+                yield from ([] for _ in block)
+                continue
+            scores, mutual = self.scores(block)
+            best = np.argpartition(-scores, count - 1, axis=1)[:, :count]
+            for i, (columns, values) in enumerate(zip(best, np.take_along_axis(scores, best, axis=1))):
+                order = np.argsort(-values)
+                yield [
+                    (int(self.users[column]), float(value), int(mutual[i, column]))
+                    for column, value in zip(columns[order], values[order]) if value > 0
+                ]
+
+    def popular(self):
+        """The most followed users, for readers outside the graph."""
+        import numpy as np
+
+        order = np.argsort(-self.followers, kind='stable')
+        popularity = self.popularity()
+        picked = []
+        for node in order:
+            if self.followers[node] == 0 or len(picked) == suggestion_count():
+                break
+            picked.append((int(self.users[node]), float(popularity[node]), 0))
+        return picked
+
+
+def stale_users(after, limit):
+    """The next `limit` stale users after user id `after`."""
+    stale = Profile.objects.filter(suggestions_stale=True, user_id__gt=after).order_by('user_id')
+    return list(stale.values_list('user_id', flat=True)[:limit])
+
+
+def store(user_ids, results, batch_size=1000):
+    """Replace the suggestions of `user_ids` with `results`, a batch at a time."""
+    batch = []
+    for user_id, suggestions in zip(user_ids, results):
+        batch.append((user_id, suggestions))
+        if len(batch) == batch_size:
+            store_batch(batch)
+            batch = []
+    if batch:
+        store_batch(batch)
+
+
+def store_batch(batch):
+    user_ids = [user_id for user_id, _ in batch]
+    with transaction.atomic():
+        FollowSuggestion.objects.filter(user_id__in=user_ids).delete()
+        FollowSuggestion.objects.bulk_create([
+            FollowSuggestion(user_id=user_id, suggested_id=suggested_id, score=score, mutual=mutual, rank=rank)
+            for user_id, suggestions in batch for rank, (suggested_id, score, mutual) in enumerate(suggestions)
+        ])
+        # fresh only once stored: users of a batch that fails stay stale for the next run
+        Profile.objects.filter(user_id__in=user_ids).update(suggestions_stale=False)
+
+
+def refresh(everyone=False, graph=None, batch_size=2000):
+    """Recompute the suggestions of stale users (or of everyone); returns the number of users."""
+    if everyone:
+        Profile.objects.filter(suggestions_stale=False).update(suggestions_stale=True)
+    total, last = 0, 0
+    # in user id order, so users marked again behind the current batch wait for the next run
+    while user_ids := stale_users(last, batch_size):
+        if graph is None:
+            graph = Graph.load()
+        nodes = graph.nodes(user_ids)
+        store([user_id for user_id, node in zip(user_ids, nodes) if node >= 0], graph.suggest(nodes[nodes >= 0]))
+        outside = [user_id for user_id, node in zip(user_ids, nodes) if node < 0]
+        popular = graph.popular() if outside else []
+        store(outside, ([entry for entry in popular if entry[0] != user_id] for user_id in outside))
+        total += len(user_ids)
+        last = user_ids[-1]
+    return total
+
+
+def mark_stale(*user_ids):
+    """The users' friends of friends changed, and so did those of everyone following them."""
+    if not user_ids:
+        return
+    followers = Follow.objects.filter(following_id__in=user_ids).values('follower_id')
+    Profile.objects.filter(Q(user_id__in=user_ids) | Q(user_id__in=followers), suggestions_stale=False).update(
+        suggestions_stale=True,
+    )
+
+
+def suggestions_for(user, exclude=None, limit=None):
+    """The stored suggestions of `user`, minus anyone followed since; one query on followsuggestion_user_idx."""
+    qs = (
+        FollowSuggestion.objects.filter(user=user)
+        .exclude(Exists(Follow.objects.filter(follower=user, following=OuterRef('suggested'))))
+        .select_related('suggested').only('mutual', 'suggested__username')
+        .order_by('rank')
+    )
+    if exclude is not None:
+        qs = qs.exclude(suggested=exclude)
+    return qs[:limit or getattr(settings, 'FOLLOW_SUGGESTIONS_SHOWN', 5)]
@@ -0,0 +1,46 @@
+from django import template
+from django.forms.utils import flatatt
+from django.utils.html import escape, format_html
+from django.utils.safestring import mark_safe
+
+from blog.images import current_derivatives
+from blog.search import MARK_START, MARK_STOP
+
+register = template.Library()
+
+
+@register.filter
+def highlight(snippet):
+    """Escape a search snippet and wrap the matched terms in <mark> tags."""
+    if not snippet:
+        return ''
+    return mark_safe(escape(snippet).replace(MARK_START, '<mark>').replace(MARK_STOP, '</mark>'))
+
+
+@register.simple_tag
+def responsive_image(file, sizes='100vw', alt='', loading='lazy', **attrs):
+    """
+    <img> for an image field using its resized derivatives (blog/images.py):
+    WebP and JPEG srcsets with the given `sizes`, lazily loaded. Falls back
+    to the original file until the derivatives exist.
+    """
+    if not file:
+        return ''
+    meta = current_derivatives(file)
+    extra = flatatt(attrs)
+    if meta is None:
+        return format_html(
+            '<img src="{}" alt="{}" loading="{}" decoding="async"{}>', file.url, alt, loading, extra,
+        )
+
+    def srcset(fmt):
+        return ', '.join(f'{file.storage.url(name)} {width}w' for width, name in meta['files'][fmt])
+
+    return format_html(
+        '<picture><source type="image/webp" srcset="{}" sizes="{}">'
+        '<img src="{}" srcset="{}" sizes="{}" width="{}" height="{}" alt="{}" loading="{}" decoding="async"{}>'
+        '</picture>',
+        srcset('webp'), sizes,
+        file.storage.url(meta['files']['jpeg'][-1][1]), srcset('jpeg'), sizes,
+        meta['width'], meta['height'], alt, loading, extra,
+    )
@@ -1,3 +1,2133 @@
-from django.test import TestCase
+import asyncio
+import json
+import re
+import shutil
+import tempfile
+import threading
+import uuid
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone as dt_timezone
+from unittest import mock, skipUnless
+from io import BytesIO, StringIO
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.sessions.models import Session
+from django.core.cache import cache, caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db.models import Count
+from django.template import Context, Template
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import include, path, reverse
+from django.utils import timezone
+from PIL import Image
+
+from personal_blog import urls as project_urls
+from personal_blog.database import database_config
+
+from . import (
+    analytics, async_views, benchmark, images, jobs, live, metrics, page_cache, related, routers, stats, suggestions,
+    timeline, transfer, trending,
+)
+from . import urls as blog_urls
+from .hyperloglog import HyperLogLog
+from .management.commands.build_image_derivatives import build as build_in_worker
+from .models import (
+    BackgroundJob, Category, Comment, Follow, FollowSuggestion, LiveEvent, Post, PostSearchDocument, PostView,
+    PostViewRollup, Profile, RelatedPost, TimelineEntry, TrendingScore,
+)
+from .pagination import InvalidCursor, KeysetPaginator
+from .rendering import render_key, sanitize
+from .routers import PrimaryReplicaRouter
+from .search import search_posts
+from .stats import dashboard_stats, published_post_count
+from .templatetags.blog_tags import highlight
+from .view_counter import ViewCounterBuffer
+from .view_dedupe import BloomFilter, SeenSet
+
+# rendering pages must not depend on `collectstatic` having been run
+plain_static = override_settings(
+    STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+)
+
+
+def make_post(author, title='Hello world', **kwargs):
+    kwargs.setdefault('slug', title.lower().replace(' ', '-'))
+    kwargs.setdefault('content', '<p>Some <strong>content</strong></p>')
+    kwargs.setdefault('published', True)
+    return Post.objects.create(author=author, title=title, **kwargs)
+
+
+# these count repeat views by the same visitor; dedupe is covered by ViewDedupeTests
+@override_settings(VIEW_COUNTER_FLUSH_INTERVAL=None, VIEW_DEDUPE_WINDOW=None)
+class ViewCounterTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.author = User.objects.create_user('author', password='pw')
+        self.post = make_post(self.author)
+        self.other = make_post(self.author, title='Other post')
+        self.buffer = ViewCounterBuffer()
+
+    def test_record_does_not_write(self):
+        self.buffer.record(self.post.slug)
+        with self.assertNumQueries(0):
+            views = self.buffer.record(self.post.slug, ip='127.0.0.1')
+        self.assertEqual(views, 2)
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.views, 0)
+        self.assertFalse(PostView.objects.exists())
+
+    def test_unknown_slug(self):
+        self.assertIsNone(self.buffer.record('missing'))
+
+    def test_flush_writes_grouped_updates(self):
+        for _ in range(3):
+            self.buffer.record(self.post.slug)
+        for _ in range(2):
+            self.buffer.record(self.other.slug, user_id=self.author.pk)
+        self.assertEqual(self.buffer.flush(), 5)
+        self.post.refresh_from_db()
+        self.other.refresh_from_db()
+        self.assertEqual((self.post.views, self.other.views), (3, 2))
+        self.assertEqual(PostView.objects.filter(post=self.other, user=self.author).count(), 2)
+        self.assertEqual(self.buffer.flush(), 0)
+
+    def test_views_of_deleted_posts_are_dropped(self):
+        self.buffer.record(self.post.slug)
+        self.buffer.record(self.other.slug)
+        self.other.delete()
+        self.assertEqual(self.buffer.flush(), 1)
+        self.assertEqual(PostView.objects.count(), 1)
+
+    def test_renamed_deleted_and_reused_slugs(self):
+        old_slug = self.post.slug
+        self.buffer.record(old_slug)
+        self.buffer.record(self.other.slug)
+        with mock.patch('blog.signals.view_counter', self.buffer):
+            self.post.slug = 'renamed'
+            self.post.save()
+            self.other.delete()
+            reused = make_post(self.author, title='Reused', slug=old_slug)
+        self.assertEqual(self.buffer.record(old_slug), 1)
+        self.assertIsNone(self.buffer.record(self.other.slug))
+        self.buffer.flush()
+        reused.refresh_from_db()
+        self.assertEqual(reused.views, 1)
+
+    def test_slugs_renamed_by_another_worker(self):
+        self.buffer.record(self.post.slug)
+        Post.objects.filter(pk=self.post.pk).update(slug='renamed')  # another process, no signal here
+        self.buffer.flush()
+        self.assertIsNone(self.buffer.record(self.post.slug))
+        self.assertEqual(self.buffer.record('renamed'), 2)
+
+    def test_no_views_lost_on_shutdown(self):
+        self.buffer.record(self.post.slug)
+
+        def hit():
+            for _ in range(250):
+                self.buffer.record(self.post.slug)
+
+        threads = [threading.Thread(target=hit) for _ in range(4)]
+        for t in threads:
+            t.start()
+        self.buffer.publish()
+        for t in threads:
+            t.join()
+        self.buffer.shutdown()
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.views, 1001)
+        self.assertEqual(PostView.objects.filter(post=self.post).count(), 1001)
+
+    def test_batches_published_by_other_workers_are_drained(self):
+        worker = ViewCounterBuffer()
+        worker.record(self.post.slug)
+        worker.publish()
+        self.buffer.record(self.post.slug)
+        call_command('flush_post_views', stdout=StringIO())
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.views, 1)
+        self.assertEqual(self.buffer.flush(), 1)
+
+    def test_endpoint(self):
+        url = reverse('blog:increment_post_view')
+        response = self.client.post(url, {'slug': self.post.slug})
+        self.assertEqual(response.json(), {'views': 1})
+        self.assertEqual(self.client.post(url, {'slug': 'missing'}).status_code, 404)
+        self.assertEqual(self.client.post(url).status_code, 400)
+
+
+class FakeClock:
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@override_settings(VIEW_COUNTER_FLUSH_INTERVAL=None, VIEW_DEDUPE_WINDOW=600)
+class ViewDedupeTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.author = User.objects.create_user('author', password='pw')
+        self.post = make_post(self.author)
+        self.buffer = ViewCounterBuffer()
+
+    def test_repeats_are_not_counted(self):
+        self.assertEqual(self.buffer.record(self.post.slug, ip='10.0.0.1'), 1)
+        self.assertEqual(self.buffer.record(self.post.slug, ip='10.0.0.1'), 1)
+        self.assertEqual(self.buffer.record(self.post.slug, user_id=self.author.pk, ip='10.0.0.1'), 2)
+        self.assertEqual(self.buffer.record(self.post.slug, user_id=self.author.pk, ip='10.0.0.2'), 2)
+        self.assertEqual(self.buffer.flush(), 2)
+        self.assertEqual(PostView.objects.count(), 2)
+
+    def test_repeats_seen_by_another_worker(self):
+        worker = ViewCounterBuffer()
+        worker.record(self.post.slug, ip='10.0.0.1')
+        worker.publish()
+        self.buffer.publish()
+        self.buffer.record(self.post.slug, ip='10.0.0.1')
+        self.buffer.record(self.post.slug, ip='10.0.0.2')
+        self.assertEqual(self.buffer.flush(), 2)
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.views, 2)
+
+    def test_window_expiry(self):
+        clock = FakeClock()
+        seen = SeenSet(600, buckets=6, capacity=100, clock=clock)
+        self.assertFalse(seen.seen('post:visitor'))
+        clock.now = 599
+        self.assertTrue(seen.seen('post:visitor'))
+        # remembered for the window and at most one more slice
+        clock.now = 700
+        self.assertFalse(seen.seen('post:visitor'))
+        self.assertTrue(seen.seen('post:visitor'))
+
+    def test_memory_bound_under_a_million_visitors(self):
+        clock = FakeClock()
+        seen = SeenSet(60, buckets=3, capacity=50000, error_rate=0.01, clock=clock)
+        slice_bytes = BloomFilter(50000, 0.01).nbytes
+        largest = repeats = 0
+        for i in range(1_000_000):
+            clock.now = i / 1000
+            repeats += seen.seen(f'visitor-{i}')
+            if i % 10000 == 0:
+                largest = max(largest, seen.nbytes)
+        self.assertLessEqual(largest, 4 * slice_bytes)
+        # full slices stop filtering instead of mistaking new visitors for repeats
+        self.assertLess(repeats, 1_000_000 * 0.01)
+        self.assertTrue(seen.seen('visitor-999999'))
+
+    def test_endpoint_ignores_reloads(self):
+        url = reverse('blog:increment_post_view')
+        first = self.client.post(url, {'slug': self.post.slug}, REMOTE_ADDR='10.9.9.9').json()
+        again = self.client.post(url, {'slug': self.post.slug}, REMOTE_ADDR='10.9.9.9').json()
+        self.assertEqual(first, again)
+
+
+@plain_static
+class SearchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.author = User.objects.create_user('author', password='pw')
+
+    def search(self, q):
+        return list(search_posts(Post.objects.all(), q))
+
+    def test_documents_are_html_stripped(self):
+        post = make_post(self.author, content='<p>Caf&eacute; <strong>espresso</strong> guide</p>')
+        document = PostSearchDocument.objects.get(post=post)
+        self.assertEqual(document.body, 'Café espresso guide')
+        self.assertEqual(self.search('espresso'), [post])
+        self.assertEqual(self.search('strong'), [])
+
+    def test_title_matches_rank_first(self):
+        body_match = make_post(self.author, title='Brewing notes', content='<p>All about django.</p>')
+        title_match = make_post(self.author, title='Django tips', content='<p>Short.</p>')
+        self.assertEqual(self.search('django'), [title_match, body_match])
+
+    def test_document_follows_edits(self):
+        post = make_post(self.author, content='<p>old words</p>')
+        post.content = '<p>new words</p>'
+        post.save()
+        self.assertEqual(self.search('old'), [])
+        self.assertEqual(self.search('new'), [post])
+        post.delete()
+        self.assertEqual(self.search('new'), [])
+
+    def test_highlighted_snippet(self):
+        make_post(self.author, content='<p>The quick <em>brown</em> fox & friends</p>')
+        post = search_posts(Post.objects.all(), 'brown').get()
+        self.assertEqual(highlight(post.headline), 'The quick <mark>brown</mark> fox &amp; friends')
+
+    def test_search_view(self):
+        make_post(self.author, title='Searchable', content='<p>needle</p>')
+        make_post(self.author, title='Unpublished', content='<p>needle</p>', published=False)
+        response = self.client.get(reverse('blog:search'), {'q': 'needle'})
+        self.assertEqual([p.title for p in response.context['posts']], ['Searchable'])
+        self.assertContains(response, '<mark>needle</mark>')
+
+    def test_rebuild_search_index(self):
+        posts = [make_post(self.author, title=f'Post {i}', content=f'<p>body {i}</p>') for i in range(5)]
+        PostSearchDocument.objects.all().delete()
+        call_command('rebuild_search_index', chunk_size=2, stdout=StringIO())
+        self.assertEqual(PostSearchDocument.objects.count(), 5)
+        self.assertEqual(self.search('body'), posts[::-1])
+
+
+@override_settings(VIEW_COUNTER_FLUSH_INTERVAL=None)
+@plain_static
+class CounterTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.author = User.objects.create_user('author', password='pw')
+        self.reader = User.objects.create_user('reader', password='pw')
+        self.post = make_post(self.author)
+
+    def profile(self, user):
+        return Profile.objects.get(user=user)
+
+    def test_comment_count(self):
+        comment = Comment.objects.create(post=self.post, author=self.reader, body='hi')
+        Comment.objects.create(post=self.post, author=self.reader, body='again')
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.comment_count, 2)
+        comment.delete()
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.comment_count, 1)
+
+    def test_moderated_comments_are_not_counted(self):
+        comment = Comment.objects.create(post=self.post, author=self.reader, body='hi')
+        Comment.objects.create(post=self.post, author=self.reader, body='hidden', moderated=True)
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.comment_count, 1)
+        comment.moderated = True
+        comment.save()
+        comment.save()
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.comment_count, 0)
+        comment = Comment.objects.get(pk=comment.pk)
+        comment.moderated = False
+        comment.save(update_fields=['moderated'])
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.comment_count, 1)
+        Comment.objects.filter(moderated=True).get().delete()
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.comment_count, 1)
+        Post.objects.update(comment_count=7)
+        call_command('recount', stdout=StringIO())
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.comment_count, 1)
+
+    def test_follow_counts(self):
+        follow = Follow.objects.create(follower=self.reader, following=self.author)
+        self.assertEqual(self.profile(self.author).followers_count, 1)
+        self.assertEqual(self.profile(self.reader).following_count, 1)
+        follow.delete()
+        self.assertEqual(self.profile(self.author).followers_count, 0)
+        self.assertEqual(self.profile(self.reader).following_count, 0)
+
+    def test_published_posts_count(self):
+        self.assertEqual(self.profile(self.author).published_posts_count, 1)
+        draft = make_post(self.author, title='Draft', published=False)
+        self.assertEqual(self.profile(self.author).published_posts_count, 1)
+        draft = Post.objects.get(pk=draft.pk)
+        draft.published = True
+        draft.save()
+        draft.save()
+        self.assertEqual(self.profile(self.author).published_posts_count, 2)
+        draft.delete()
+        self.post.views = 5
+        self.post.save(update_fields=['views'])
+        self.assertEqual(self.profile(self.author).published_posts_count, 1)
+
+    def test_recount(self):
+        Comment.objects.create(post=self.post, author=self.reader, body='hi')
+        Follow.objects.create(follower=self.reader, following=self.author)
+        Post.objects.update(comment_count=7)
+        Profile.objects.update(followers_count=3, following_count=3, published_posts_count=0)
+        call_command('recount', stdout=StringIO())
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.comment_count, 1)
+        self.assertEqual(self.profile(self.author).followers_count, 1)
+        self.assertEqual(self.profile(self.author).published_posts_count, 1)
+        self.assertEqual(self.profile(self.reader).following_count, 1)
+
+    def test_ajax_endpoints_read_stored_counts(self):
+        self.client.force_login(self.reader)
+        response = self.client.post(reverse('blog:toggle_follow'), {'username': 'author'})
+        self.assertEqual(response.json(), {'status': 'followed', 'followers_count': 1})
+        response = self.client.post(reverse('blog:ajax_add_comment', args=[self.post.slug]), {'body': 'hi'})
+        self.assertEqual(response.json()['comments_count'], 1)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('blog:author_profile', args=['author']))
+            self.client.get(self.post.get_absolute_url())
+        self.assertFalse([q for q in queries if 'COUNT(' in q['sql']])
+
+
+class KeysetPaginatorTests(TestCase):
+    def setUp(self):
+        author = User.objects.create_user('author', password='pw')
+        self.posts = [make_post(author, title=f'Post {i}') for i in range(7)]
+        self.posts.sort(key=lambda p: (p.created_at, p.pk), reverse=True)
+
+    def test_walk_forward_and_back(self):
+        paginator = KeysetPaginator(Post.objects.all(), 3)
+        first = paginator.page()
+        second = paginator.page(first.next_cursor)
+        third = paginator.page(second.next_cursor)
+        self.assertEqual(list(first) + list(second) + list(third), self.posts)
+        self.assertFalse(first.has_previous)
+        self.assertFalse(third.has_next)
+        self.assertEqual(list(paginator.page(third.previous_cursor)), list(second))
+        self.assertEqual(list(paginator.page(second.previous_cursor)), list(first))
+
+    def test_invalid_cursor(self):
+        paginator = KeysetPaginator(Post.objects.all(), 3)
+        for cursor in ('garbage', 'WyJuZXh0IiwgWzFdXQ'):
+            with self.assertRaises(InvalidCursor):
+                paginator.page(cursor)
+
+
+@plain_static
+class CommentApiTests(TestCase):
+    def setUp(self):
+        self.author = User.objects.create_user('author', password='pw')
+        self.post = make_post(self.author)
+        self.comments = Comment.objects.bulk_create([
+            Comment(post=self.post, author=self.author, body=f'Comment {i}', moderated=i == 3) for i in range(45)
+        ])
+        self.url = reverse('blog:ajax_comments', args=[self.post.slug])
+
+    def comments_cursor(self, index):
+        return KeysetPaginator(Comment.objects.all(), 1, ('created_at', 'pk')).encode_cursor(self.comments[index], 'next')
+
+    def test_pages_of_visible_comments(self):
+        response = self.client.get(self.post.get_absolute_url())
+        self.assertContains(response, 'Comment 20')
+        self.assertNotContains(response, 'Comment 21')
+        self.assertNotContains(response, 'Comment 3<')
+        bodies, cursor = [], response.context['comments'].next_cursor
+        while cursor:
+            data = self.client.get(self.url, {'after': cursor}).json()
+            bodies += [c['body'] for c in data['comments']]
+            cursor = data['next']
+        self.assertEqual(bodies, [f'Comment {i}' for i in range(21, 45)])
+        self.assertEqual(set(data['comments'][0]), {'id', 'author', 'body', 'created_at'})
+
+    def test_bad_cursor_and_missing_post(self):
+        self.assertEqual(self.client.get(self.url, {'after': 'garbage'}).status_code, 404)
+        self.assertEqual(self.client.get(reverse('blog:ajax_comments', args=['missing'])).status_code, 404)
+
+    def test_new_comment_returns_its_cursor(self):
+        self.client.force_login(self.author)
+        response = self.client.post(reverse('blog:ajax_add_comment', args=[self.post.slug]), {'body': 'Latest'})
+        data = response.json()
+        self.assertEqual(data['comment']['body'], 'Latest')
+        self.assertEqual(self.client.get(self.url, {'after': data['cursor']}).json(), {'comments': [], 'next': None})
+        last = self.client.get(self.url, {'after': self.comments_cursor(43)}).json()
+        self.assertEqual([c['body'] for c in last['comments']], ['Comment 44', 'Latest'])
+
+
+@plain_static
+class FeedPaginationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.author = User.objects.create_user('author', password='pw')
+        self.posts = [make_post(self.author, title=f'Post {i}') for i in range(25)]
+        self.posts.sort(key=lambda p: (p.created_at, p.pk), reverse=True)
+
+    def test_home_pages_by_cursor(self):
+        home = reverse('blog:home')
+        first = self.client.get(home)
+        self.assertEqual(list(first.context['posts']), self.posts[:10])
+        self.assertEqual(first.context['total_posts'], 25)
+        cursor = first.context['page_obj'].next_cursor
+        self.assertContains(first, f'?cursor={cursor}')
+        second = self.client.get(home, {'cursor': cursor})
+        self.assertEqual(list(second.context['posts']), self.posts[10:20])
+        self.assertTrue(second.context['page_obj'].has_previous)
+
+    def test_author_posts_page_by_cursor(self):
+        url = reverse('blog:author_profile', args=['author'])
+        first = self.client.get(url)
+        self.assertEqual(len(first.context['posts']), 20)
+        second = self.client.get(url, {'cursor': first.context['page_obj'].next_cursor})
+        self.assertEqual(list(second.context['posts']), self.posts[20:])
+        self.assertFalse(second.context['page_obj'].has_next)
+
+    def test_json_feed(self):
+        url = reverse('blog:ajax_posts')
+        data = self.client.get(url).json()
+        self.assertEqual([p['title'] for p in data['posts']], [p.title for p in self.posts[:10]])
+        self.assertIsNone(data['previous_cursor'])
+        data = self.client.get(url, {'cursor': data['next_cursor'], 'author': 'author'}).json()
+        self.assertEqual([p['title'] for p in data['posts']], [p.title for p in self.posts[10:20]])
+        self.assertEqual(self.client.get(url, {'author': 'nobody'}).json()['posts'], [])
+
+    def test_invalid_cursor_is_404(self):
+        for url in (reverse('blog:home'), reverse('blog:ajax_posts')):
+            self.assertEqual(self.client.get(url, {'cursor': 'garbage'}).status_code, 404)
+
+    def test_published_count_is_cached_and_invalidated(self):
+        self.assertEqual(published_post_count(), 25)
+        with self.assertNumQueries(0):
+            published_post_count()
+        self.posts[0].published = False
+        self.posts[0].save()
+        self.assertEqual(published_post_count(), 24)
+
+
+@plain_static
+class DashboardTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.author = User.objects.create_user('author', password='pw')
+        self.reader = User.objects.create_user('reader', password='pw')
+        self.post = make_post(self.author, views=10)
+        self.other = make_post(self.author, title='Other', views=5)
+        Comment.objects.create(post=self.post, author=self.reader, body='one')
+        Comment.objects.create(post=self.other, author=self.reader, body='two')
+        Follow.objects.create(follower=self.reader, following=self.author)
+
+    def test_stats_in_one_query(self):
+        with self.assertNumQueries(1):
+            stats = dashboard_stats(self.author)
+        self.assertEqual(stats, {
+            'total_posts': 2, 'total_views': 15, 'total_comments': 2, 'total_followers': 1,
+        })
+        with self.assertNumQueries(0):
+            dashboard_stats(self.author)
+
+    def test_stats_for_author_without_posts(self):
+        self.assertEqual(dashboard_stats(self.reader), {
+            'total_posts': 0, 'total_views': 0, 'total_comments': 0, 'total_followers': 0,
+        })
+
+    def test_invalidation(self):
+        dashboard_stats(self.author)
+        Comment.objects.create(post=self.post, author=self.reader, body='three')
+        self.assertEqual(dashboard_stats(self.author)['total_comments'], 3)
+        Follow.objects.get().delete()
+        self.assertEqual(dashboard_stats(self.author)['total_followers'], 0)
+        self.other.delete()
+        self.assertEqual(dashboard_stats(self.author)['total_posts'], 1)
+
+    def test_view_query_count(self):
+        self.client.force_login(self.author)
+        self.client.get(reverse('blog:dashboard'))
+        # session, user, first page of posts, suggestions; totals come from the cache
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('blog:dashboard'))
+        self.assertEqual(response.context['total_views'], 15)
+        self.assertContains(response, '10 views · 1 comments')
+
+
+@plain_static
+class QueryPlanTests(TestCase):
+    """Query counts and index use of the public and dashboard pages on a seeded database."""
+
+    # small lookup tables that are read whole
+    SCANNED_TABLES = {'blog_category', 'blog_trendingscore'}
+
+    @classmethod
+    def setUpTestData(cls):
+        authors = [User.objects.create_user(f'author{i}', password='pw') for i in range(5)]
+        categories = Category.objects.bulk_create([Category(name=f'Cat {i}', slug=f'cat-{i}') for i in range(8)])
+        posts = Post.objects.bulk_create([
+            Post(author=authors[i % 5], title=f'Post {i}', slug=f'post-{i}', content='<p>Body</p>',
+                 category=categories[i % 8], published=i % 10 != 0)
+            for i in range(400)
+        ])
+        Comment.objects.bulk_create([
+            Comment(post=posts[i % 40], author=authors[i % 5], body=f'Comment {i}') for i in range(1000)
+        ])
+        PostView.objects.bulk_create([PostView(post=posts[i % 400], ip_address='10.0.0.1') for i in range(5000)])
+        Profile.objects.update(published_posts_count=72, followers_count=3)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        cls.author = authors[0]
+        cls.post = posts[1]
+
+    def setUp(self):
+        cache.clear()
+
+    def full_scans(self, queries):
+        """Tables read without an index by the given SELECTs (SQLite plans)."""
+        scans = set()
+        for query in queries:
+            if not query['sql'].startswith('SELECT'):
+                continue
+            with connection.cursor() as cursor:
+                cursor.execute('EXPLAIN QUERY PLAN ' + query['sql'])
+                plan = [row[-1] for row in cursor.fetchall()]
+            for line in plan:
+                match = re.match(r'SCAN (\w+)$', line)
+                if match and match.group(1) not in self.SCANNED_TABLES:
+                    scans.add((match.group(1), query['sql']))
+        return scans
+
+    def check(self, url, num_queries, **params):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(ctx), num_queries, [q['sql'] for q in ctx])
+        if connection.vendor == 'sqlite':
+            self.assertEqual(self.full_scans(ctx.captured_queries), set())
+        return response
+
+    def test_home(self):
+        # the trending list is read from its checkpoint once after the cache was cleared
+        response = self.check(reverse('blog:home'), 5)
+        # later pages need no count and reuse the cached total, categories and trending list
+        self.check(reverse('blog:home'), 2, cursor=response.context['page_obj'].next_cursor)
+
+    def test_category(self):
+        response = self.check(reverse('blog:home'), 5, category='cat-3')
+        self.assertEqual({post.category.slug for post in response.context['posts']}, {'cat-3'})
+        self.assertEqual(len(response.context['categories']), 8)
+        self.check(reverse('blog:home'), 2, category='cat-3', cursor=response.context['page_obj'].next_cursor)
+
+    def test_post_detail(self):
+        # validator metadata, the post, its first comments and its related posts
+        response = self.check(self.post.get_absolute_url(), 4)
+        # first page only; the post has 25
+        self.assertEqual(len(response.context['comments']), 20)
+
+    def test_ajax_comments(self):
+        first = self.client.get(reverse('blog:ajax_comments', args=[self.post.slug])).json()
+        response = self.check(reverse('blog:ajax_comments', args=[self.post.slug]), 2, after=first['next'])
+        self.assertEqual(len(response.json()['comments']), 5)
+
+    def test_author_profile(self):
+        self.check(reverse('blog:author_profile', args=[self.author.username]), 3)
+
+    def test_ajax_posts(self):
+        self.check(reverse('blog:ajax_posts'), 1, author=self.author.username)
+
+    def test_dashboard(self):
+        self.client.force_login(self.author)
+        # session, user, totals, first page of posts, view chart, who to follow
+        self.check(reverse('blog:dashboard'), 6)
+
+    @skipUnless(connection.vendor == 'sqlite', 'SQLite query plans')
+    def test_hot_queries_use_indexes(self):
+        plans = {
+            'post_feed_idx': Post.objects.filter(published=True).order_by('-created_at', '-pk')[:11],
+            'post_category_feed_idx': Post.objects.filter(published=True, category__slug='cat-3')
+                .order_by('-created_at', '-pk')[:11],
+            'post_author_idx': Post.objects.filter(author=self.author).order_by('-created_at', '-pk')[:21],
+            'comment_post_idx': Comment.objects.filter(post=self.post),
+            'postview_post_idx': PostView.objects.filter(post=self.post, created_at__gte=self.post.created_at),
+            'relatedpost_post_idx': related.related_posts(self.post),
+            'followsuggestion_user_idx': suggestions.suggestions_for(self.author),
+        }
+        for index, queryset in plans.items():
+            with self.subTest(index=index):
+                plan = queryset.explain()
+                self.assertIn(f'USING INDEX {index}', plan)
+                self.assertNotIn('TEMP B-TREE', plan)
+
+
+class HyperLogLogTests(TestCase):
+    def test_estimates_distinct_values(self):
+        sketch = HyperLogLog()
+        for i in range(20000):
+            sketch.add(f'visitor-{i % 10000}')
+        # about 3% standard error; allow three of them
+        self.assertAlmostEqual(sketch.count(), 10000, delta=1000)
+        small = HyperLogLog()
+        for value in ('a', 'b', 'c', 'a'):
+            small.add(value)
+        self.assertEqual(small.count(), 3)
+
+    def test_merge_is_union(self):
+        a, b = HyperLogLog(), HyperLogLog()
+        for i in range(3000):
+            a.add(i)
+            b.add(i + 1500)
+        merged = HyperLogLog.from_bytes(a.to_bytes()).update(b)
+        self.assertAlmostEqual(merged.count(), 4500, delta=450)
+
+
+@plain_static
+@override_settings(VIEW_ROLLUP_DELAY=0, VIEW_ROLLUP_RETENTION_DAYS=2)
+class AnalyticsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.author = User.objects.create_user('author', password='pw')
+        self.reader = User.objects.create_user('reader', password='pw')
+        self.post = make_post(self.author)
+        self.other = make_post(self.author, title='Other')
+        self.now = datetime(2024, 5, 10, 12, 30, tzinfo=dt_timezone.utc)
+
+    def views(self, post, at, *visitors):
+        created = PostView.objects.bulk_create([
+            PostView(post=post, user=visitor if isinstance(visitor, User) else None,
+                     ip_address=None if isinstance(visitor, User) else visitor)
+            for visitor in visitors
+        ])
+        PostView.objects.filter(pk__in=[view.pk for view in created]).update(created_at=at)
+
+    def test_hourly_and_daily_rollups(self):
+        self.views(self.post, self.now - timedelta(hours=3), self.reader, self.reader, '10.0.0.1')
+        self.views(self.post, self.now - timedelta(hours=2), self.reader, '10.0.0.2')
+        self.views(self.other, self.now - timedelta(hours=2), '10.0.0.1')
+        # the current hour is not complete yet
+        self.views(self.post, self.now, '10.0.0.3')
+        self.assertEqual(analytics.rollup(now=self.now), (2, 3, 2))
+        hourly = PostViewRollup.objects.filter(post=self.post, period='hour').order_by('bucket')
+        self.assertEqual([(r.views, r.visitors) for r in hourly], [(3, 2), (2, 2)])
+        daily = PostViewRollup.objects.get(post=self.post, period='day')
+        self.assertEqual((daily.bucket, daily.views, daily.visitors),
+                         (datetime(2024, 5, 10, tzinfo=dt_timezone.utc), 5, 3))
+        # nothing new to roll up, and rerunning a range gives the same result
+        self.assertEqual(analytics.rollup(now=self.now), (0, 0, 0))
+        analytics.rollup(now=self.now, since=self.now - timedelta(days=1))
+        self.assertEqual(PostViewRollup.objects.get(post=self.post, period='day').views, 5)
+
+    def test_prune_keeps_retention_and_unrolled_views(self):
+        self.views(self.post, self.now - timedelta(days=4), self.reader)
+        self.assertEqual(analytics.prune(now=self.now), 0)
+        analytics.rollup(now=self.now - timedelta(days=4) + timedelta(hours=1))
+        self.views(self.post, self.now - timedelta(days=3), self.reader)
+        self.views(self.post, self.now - timedelta(hours=1), self.reader)
+        # past retention and rolled up: only the first view
+        self.assertEqual(analytics.prune(now=self.now), 1)
+        self.assertEqual(PostView.objects.count(), 2)
+
+    def test_prune_leaves_whole_hours(self):
+        # the retention cutoff falls at 12:30, two days ago
+        hour = analytics.floor_hour(self.now - timedelta(days=2))
+        self.views(self.post, hour - timedelta(minutes=30), '10.0.0.1')
+        self.views(self.post, hour + timedelta(minutes=10), '10.0.0.1')
+        self.views(self.post, hour + timedelta(minutes=40), '10.0.0.2')
+        analytics.rollup(now=self.now)
+        self.assertEqual(analytics.prune(now=self.now), 1)
+        # rolling the range up again keeps both hours' counts
+        analytics.rollup(now=self.now, since=hour - analytics.HOUR)
+        hourly = PostViewRollup.objects.filter(post=self.post, period='hour').order_by('bucket')
+        self.assertEqual([r.views for r in hourly], [1, 2])
+
+    def test_command(self):
+        self.views(self.post, timezone.now() - timedelta(days=5), self.reader)
+        out = StringIO()
+        call_command('rollup_post_views', stdout=out)
+        self.assertIn('Pruned 1 raw views', out.getvalue())
+        self.assertEqual(PostViewRollup.objects.filter(period='day').count(), 1)
+
+    def test_dashboard_chart_reads_rollups_only(self):
+        today = timezone.now() - timedelta(hours=2)
+        self.views(self.post, today, self.reader, '10.0.0.1')
+        self.views(self.other, today, self.reader)
+        call_command('rollup_post_views', '--retention-days=0', stdout=StringIO())
+        self.assertFalse(PostView.objects.exists())
+        self.client.force_login(self.author)
+        chart = self.client.get(reverse('blog:dashboard')).context['chart']
+        self.assertEqual(len(chart), analytics.CHART_DAYS)
+        # the reader saw both posts but is one visitor of the author
+        self.assertEqual((chart[-1]['views'], chart[-1]['visitors']), (3, 2))
+        response = self.client.get(reverse('blog:dashboard'), {'post': self.other.slug})
+        self.assertEqual(response.context['chart'][-1]['views'], 1)
+        self.assertEqual(self.client.get(reverse('blog:dashboard'), {'post': 'missing'}).status_code, 404)
+
+
+@plain_static
+class RenderCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        caches['render'].clear()
+        self.author = User.objects.create_user('author', password='pw')
+
+    def test_sanitize(self):
+        body, text = sanitize(
+            '<p onclick="x()">Hi <script>alert(1)</script><a href="javascript:evil()">there</a>'
+            '<img src="https://example.com/a.png" style="width:10px"><div><b>open'
+        )
+        self.assertEqual(
+            body,
+            '<p>Hi <a>there</a><img src="https://example.com/a.png" style="width:10px">'
+            '<div><b>open</b></div></p>',
+        )
+        self.assertEqual(text, 'Hi there open')
+
+    def test_excerpt_is_plain_text(self):
+        post = make_post(self.author, content='<p>' + 'word &amp; ' * 100 + '</p>')
+        excerpt = post.rendered['excerpt']
+        self.assertEqual(len(excerpt), 140)
+        self.assertTrue(excerpt.startswith('word & word'))
+        self.assertEqual(post.rendered['reading_time'], 1)
+
+    def test_rendered_on_save_and_invalidated(self):
+        post = make_post(self.author, content='<p>first</p>')
+        old_key = render_key(post.pk, post.updated_at)
+        self.assertEqual(caches['render'].get(old_key)['excerpt'], 'first')
+        post.content = '<p>second</p>'
+        post.save()
+        self.assertIsNone(caches['render'].get(old_key))
+        self.assertEqual(Post.objects.get(pk=post.pk).rendered['excerpt'], 'second')
+        key = render_key(post.pk, post.updated_at)
+        post.delete()
+        self.assertIsNone(caches['render'].get(key))
+
+    def test_home_page_uses_cached_excerpts(self):
+        make_post(self.author, content='<p>Broken <em>html</p>')
+        response = self.client.get(reverse('blog:home'))
+        self.assertContains(response, 'Broken html')
+        self.assertNotContains(response, '<em>')
+
+
+@plain_static
+class PageCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.author = User.objects.create_user('author', password='pw')
+        self.reader = User.objects.create_user('reader', password='pw')
+        self.post = make_post(self.author)
+        self.home = reverse('blog:home')
+
+    def get(self, url, **params):
+        return self.client.get(url, params)
+
+    def test_anonymous_pages_are_cached(self):
+        self.assertEqual(self.get(self.home)['X-Page-Cache'], 'miss')
+        with self.assertNumQueries(0):
+            response = self.get(self.home)
+        self.assertEqual(response['X-Page-Cache'], 'hit')
+        self.assertContains(response, self.post.title)
+        self.assertEqual(self.get(self.home, page=1)['X-Page-Cache'], 'miss')
+        self.assertEqual(self.get(self.home, utm_source='x')['X-Page-Cache'], 'hit')
+
+    def test_authenticated_pages_are_not_cached(self):
+        self.client.force_login(self.reader)
+        self.get(self.home)
+        self.assertFalse(self.get(self.home).has_header('X-Page-Cache'))
+
+    def test_comment_invalidates_only_its_post(self):
+        detail = self.post.get_absolute_url()
+        other = make_post(self.author, title='Other')
+        for url in (detail, other.get_absolute_url(), self.home):
+            self.get(url)
+        Comment.objects.create(post=self.post, author=self.reader, body='new comment')
+        response = self.get(detail)
+        self.assertEqual(response['X-Page-Cache'], 'miss')
+        self.assertContains(response, 'new comment')
+        self.assertEqual(self.get(other.get_absolute_url())['X-Page-Cache'], 'hit')
+        self.assertEqual(self.get(self.home)['X-Page-Cache'], 'hit')
+
+    def test_post_changes_invalidate_lists_and_author(self):
+        author_page = reverse('blog:author_profile', args=['author'])
+        self.get(self.home)
+        self.get(author_page)
+        make_post(self.author, title='Brand new')
+        self.assertContains(self.get(self.home), 'Brand new')
+        self.assertContains(self.get(author_page), 'Brand new')
+
+    def test_stale_page_served_while_another_worker_regenerates(self):
+        self.get(self.home)
+        make_post(self.author, title='Brand new')
+        cache.add(page_cache.page_key(RequestFactory().get(self.home)) + ':lock', 1)
+        with self.assertNumQueries(0):
+            response = self.get(self.home)
+        self.assertEqual(response['X-Page-Cache'], 'stale')
+        self.assertNotContains(response, 'Brand new')
+
+    def test_csrf_responses_are_not_stored(self):
+        @page_cache.cache_anonymous_page
+        def view(request):
+            return HttpResponse(get_token(request))
+
+        factory = RequestFactory()
+        for _ in range(2):
+            request = factory.get('/csrf/')
+            request.user = AnonymousUser()
+            self.assertEqual(view(request)['X-Page-Cache'], 'miss')
+
+
+@plain_static
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.author = User.objects.create_user('author', password='pw')
+        self.reader = User.objects.create_user('reader', password='pw')
+        self.post = make_post(self.author)
+        self.client.force_login(self.reader)
+
+    def revalidate(self, url, response):
+        return self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+
+    def test_unchanged_post_is_not_rendered(self):
+        url = self.post.get_absolute_url()
+        response = self.client.get(url)
+        self.assertTrue(response.has_header('Last-Modified'))
+        self.assertIn('private', response['Cache-Control'])
+        self.assertIn('Cookie', response['Vary'])
+        with self.assertTemplateNotUsed('blog/post_detail.html'):
+            again = self.revalidate(url, response)
+        self.assertEqual(again.status_code, 304)
+        Comment.objects.create(post=self.post, author=self.author, body='new')
+        self.assertEqual(self.revalidate(url, response).status_code, 200)
+
+    def test_moderation_changes_validators(self):
+        comment = Comment.objects.create(post=self.post, author=self.author, body='spam')
+        url = self.post.get_absolute_url()
+        response = self.client.get(url)
+        comment.moderated = True
+        comment.save()
+        hidden = self.revalidate(url, response)
+        self.assertEqual(hidden.status_code, 200)
+        self.assertNotEqual(hidden['ETag'], response['ETag'])
+        self.assertNotContains(hidden, 'spam')
+
+    def test_etag_varies_by_viewer(self):
+        url = self.post.get_absolute_url()
+        response = self.client.get(url)
+        Follow.objects.create(follower=self.reader, following=self.author)
+        self.assertEqual(self.revalidate(url, response).status_code, 200)
+        self.client.logout()
+        self.assertEqual(self.revalidate(url, response).status_code, 200)
+
+    def test_home_and_author_pages(self):
+        for i, url in enumerate((reverse('blog:home'), reverse('blog:author_profile', args=['author']))):
+            response = self.client.get(url)
+            self.assertEqual(self.revalidate(url, response).status_code, 304)
+            Follow.objects.create(follower=self.reader, following=self.author)
+            make_post(self.author, title=f'New post {i}')
+            self.assertEqual(self.revalidate(url, response).status_code, 200)
+            Follow.objects.all().delete()
+
+    def test_category_changes_revalidate_lists(self):
+        category = Category.objects.create(name='Python', slug='python')
+        url = reverse('blog:home')
+        response = self.client.get(url)
+        self.assertEqual(self.revalidate(url, response).status_code, 304)
+        category.name = 'Python 3'
+        category.save()
+        renamed = self.revalidate(url, response)
+        self.assertEqual(renamed.status_code, 200)
+        Category.objects.create(name='Django', slug='django')
+        self.assertEqual(self.revalidate(url, renamed).status_code, 200)
+
+    def test_anonymous_cached_page_revalidates_without_queries(self):
+        self.client.logout()
+        url = self.post.get_absolute_url()
+        response = self.client.get(url)
+        self.assertIn('public', response['Cache-Control'])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.revalidate(url, response).status_code, 304)
+
+    def test_missing_post(self):
+        self.assertEqual(self.client.get(reverse('blog:post_detail', args=['missing'])).status_code, 404)
+
+
+@mock.patch('blog.jobs.cloudinary.uploader.destroy', return_value={'result': 'ok'})
+class BackgroundJobTests(TestCase):
+    def setUp(self):
+        self.author = User.objects.create_user('author', password='pw')
+        # a draft, so publishing queues no timeline fan-out
+        self.post = make_post(self.author, published=False)
+        Post.objects.filter(pk=self.post.pk).update(featured_image='posts/old.jpg')
+
+    def image_queries(self, queries):
+        return [q for q in queries if q['sql'].startswith('SELECT "blog_post"."featured_image"')]
+
+    def test_saves_that_keep_the_image_queue_nothing(self, destroy):
+        post = Post.objects.get(pk=self.post.pk)
+        with CaptureQueriesContext(connection) as queries:
+            post.views = 3
+            post.save(update_fields=['views'])
+            post.title = 'Renamed'
+            post.save()
+        self.assertEqual(self.image_queries(queries), [])
+        self.assertFalse(BackgroundJob.objects.exists())
+
+    def test_replaced_image_is_queued_for_deletion(self, destroy):
+        post = Post.objects.get(pk=self.post.pk)
+        post.featured_image = 'posts/new.jpg'
+        post.save()
+        job = BackgroundJob.objects.get(task='cloudinary.destroy')
+        self.assertEqual(job.payload, {'public_id': 'old'})
+        # the new image also gets derivatives (covered by ImageDerivativeTests)
+        BackgroundJob.objects.filter(task='images.derivatives').delete()
+        destroy.assert_not_called()
+        call_command('run_jobs', '--once', stdout=StringIO())
+        destroy.assert_called_once_with('old')
+        self.assertFalse(BackgroundJob.objects.exists())
+
+    def test_deferred_image_is_loaded_only_when_saved(self, destroy):
+        post = Post.objects.defer('featured_image').get(pk=self.post.pk)
+        with CaptureQueriesContext(connection) as queries:
+            post.save(update_fields=['title'])
+        self.assertEqual(self.image_queries(queries), [])
+        post.featured_image = ''
+        with CaptureQueriesContext(connection) as queries:
+            post.save(update_fields=['featured_image'])
+        self.assertEqual(len(self.image_queries(queries)), 1)
+        self.assertEqual(BackgroundJob.objects.get().payload, {'public_id': 'old'})
+
+    def test_deleted_post_queues_image_deletion(self, destroy):
+        Post.objects.get(pk=self.post.pk).delete()
+        destroy.assert_not_called()
+        self.assertEqual(jobs.run_pending(), (1, 0))
+        destroy.assert_called_once_with('old')
+
+    @override_settings(JOB_RETRY_DELAY=60)
+    def test_failures_retry_with_backoff_then_stop(self, destroy):
+        destroy.side_effect = ConnectionError('timeout')
+        job = jobs.enqueue('cloudinary.destroy', max_attempts=2, public_id='x')
+        with self.assertLogs('blog.jobs', 'WARNING'):
+            self.assertEqual(jobs.run_pending(), (0, 1))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (BackgroundJob.QUEUED, 1))
+        self.assertGreater(job.run_at, timezone.now() + timedelta(seconds=45))
+        self.assertIn('timeout', job.last_error)
+        # not due yet
+        self.assertEqual(jobs.run_pending(), (0, 0))
+        BackgroundJob.objects.update(run_at=timezone.now())
+        with self.assertLogs('blog.jobs', 'ERROR'):
+            self.assertEqual(jobs.run_pending(), (0, 1))
+        job.refresh_from_db()
+        self.assertEqual(job.status, BackgroundJob.FAILED)
+
+    def test_jobs_are_claimed_once_and_abandoned_ones_requeued(self, destroy):
+        job = jobs.enqueue('cloudinary.destroy', public_id='x')
+        self.assertEqual(jobs.claim('worker-1').pk, job.pk)
+        self.assertIsNone(jobs.claim('worker-2'))
+        self.assertEqual(jobs.requeue_abandoned(), 0)
+        self.assertEqual(jobs.requeue_abandoned(now=timezone.now() + timedelta(hours=1)), 1)
+        self.assertEqual(jobs.claim('worker-2').locked_by, 'worker-2')
+
+
+def image_upload(name='photo.png', size=(1000, 500), mode='RGB'):
+    out = BytesIO()
+    Image.new(mode, size, 'teal').save(out, 'PNG')
+    return SimpleUploadedFile(name, out.getvalue(), content_type='image/png')
+
+
+@plain_static
+@override_settings(IMAGE_DERIVATIVE_WIDTHS=(320, 640, 1280))
+@mock.patch('blog.jobs.cloudinary.uploader.destroy', return_value={'result': 'ok'})
+class ImageDerivativeTests(TestCase):
+    def setUp(self):
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media)
+        # settings still set DEFAULT_FILE_STORAGE, which makes Django ignore
+        # OPTIONS here, so the location comes from MEDIA_ROOT
+        storages = override_settings(MEDIA_ROOT=self.media, MEDIA_URL='/media/', STORAGES={
+            'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+            'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+        })
+        storages.enable()
+        self.addCleanup(storages.disable)
+        self.author = User.objects.create_user('author', password='pw')
+
+    def render(self, file, **kwargs):
+        template = Template('{% load blog_tags %}{% responsive_image file sizes="50vw" class="card" %}')
+        return template.render(Context({'file': file}))
+
+    def test_upload_queues_derivatives(self, destroy):
+        post = make_post(self.author, published=False, featured_image=image_upload())
+        self.assertEqual(BackgroundJob.objects.get().task, 'images.derivatives')
+        html = self.render(post.featured_image)
+        self.assertIn('loading="lazy"', html)
+        self.assertNotIn('srcset', html)
+
+        self.assertEqual(jobs.run_pending(), (1, 0))
+        post.refresh_from_db()
+        meta = post.featured_image_derivatives
+        self.assertEqual((meta['source'], meta['width'], meta['height']), (post.featured_image.name, 1000, 500))
+        self.assertEqual([w for w, _ in meta['files']['webp']], [320, 640, 1000])
+        storage = post.featured_image.storage
+        with storage.open(meta['files']['jpeg'][0][1]) as f:
+            self.assertEqual(Image.open(f).size, (320, 160))
+        html = self.render(post.featured_image)
+        self.assertIn('<source type="image/webp" srcset="/media/derivatives/posts/', html)
+        self.assertIn('640w', html)
+        self.assertIn('sizes="50vw"', html)
+        self.assertIn('loading="lazy"', html)
+        self.assertIn('class="card"', html)
+
+    def test_replaced_image_cleans_up_old_derivatives(self, destroy):
+        post = make_post(self.author, published=False, featured_image=image_upload(size=(400, 300)))
+        jobs.run_pending()
+        post.refresh_from_db()
+        old = images.derivative_names(post.featured_image_derivatives)
+        post.featured_image = image_upload('other.png', size=(300, 300))
+        post.save()
+        jobs.run_pending()
+        post.refresh_from_db()
+        storage = post.featured_image.storage
+        self.assertFalse(any(storage.exists(name) for name in old))
+        self.assertEqual([w for w, _ in post.featured_image_derivatives['files']['jpeg']], [300])
+
+    def test_avatar_and_transparency(self, destroy):
+        profile = self.author.profile
+        profile.avatar = image_upload('avatar.png', size=(200, 200), mode='RGBA')
+        profile.save()
+        jobs.run_pending()
+        profile.refresh_from_db()
+        self.assertEqual(set(profile.avatar_derivatives['files']), {'webp', 'jpeg'})
+        self.assertIn('srcset', self.render(profile.avatar))
+
+    def test_backfill_command(self, destroy):
+        posts = [make_post(self.author, title=f'Post {i}', published=False, featured_image=image_upload()) for i in range(3)]
+        BackgroundJob.objects.all().delete()
+        out = StringIO()
+        call_command('build_image_derivatives', '--workers=1', stdout=out)
+        self.assertIn('Built derivatives for 3 images', out.getvalue())
+        for post in posts:
+            post.refresh_from_db()
+            self.assertEqual(post.featured_image_derivatives['source'], post.featured_image.name)
+        call_command('build_image_derivatives', '--workers=1', stdout=out)
+        self.assertIn('Built derivatives for 0 images', out.getvalue())
+
+    def test_derivatives_build_in_a_process_pool(self, destroy):
+        posts = [make_post(self.author, title=f'Post {i}', published=False, featured_image=image_upload()) for i in range(2)]
+        items = [('blog.post', str(p.pk), 'featured_image', p.featured_image.name) for p in posts]
+        with ProcessPoolExecutor(max_workers=2) as pool:
+            results = list(pool.map(build_in_worker, items))
+        self.assertEqual([error for _, _, error in results], [None, None])
+        self.assertEqual([meta['source'] for _, meta, _ in results], [p.featured_image.name for p in posts])
+
+
+@plain_static
+@override_settings(TIMELINE_FANOUT_LIMIT=3, TIMELINE_BACKFILL_POSTS=2)
+class TimelineTests(TestCase):
+    def setUp(self):
+        self.reader = User.objects.create_user('reader', password='pw')
+        self.author = User.objects.create_user('author', password='pw')
+        self.star = User.objects.create_user('star', password='pw')
+        Follow.objects.create(follower=self.reader, following=self.author)
+        for i in range(3):
+            fan = User.objects.create_user(f'fan{i}', password='pw')
+            Follow.objects.create(follower=fan if i else self.reader, following=self.star)
+        Follow.objects.create(follower=User.objects.get(username='fan1'), following=self.author)
+
+    def walk(self, per_page):
+        pages, cursor = [], None
+        while True:
+            page = timeline.timeline_page(self.reader, per_page, cursor)
+            pages.append(page)
+            if not page.has_next:
+                return pages
+            cursor = page.next_cursor
+
+    def test_publishing_fans_out_through_the_job_queue(self):
+        post = make_post(self.author)
+        self.assertFalse(TimelineEntry.objects.exists())
+        # publishing also refreshes related posts (blog/related.py)
+        self.assertEqual(set(BackgroundJob.objects.values_list('task', flat=True)), {'timeline.fan_out', 'related.update'})
+        with override_settings(TIMELINE_BATCH_SIZE=1), CaptureQueriesContext(connection) as queries:
+            jobs.run_pending()
+        inserts = [q for q in queries if q['sql'].startswith('INSERT') and '"blog_timelineentry"' in q['sql']]
+        self.assertEqual(len(inserts), 2)
+        self.assertEqual(set(TimelineEntry.objects.values_list('user__username', flat=True)), {'reader', 'fan1'})
+        self.client.force_login(self.reader)
+        response = self.client.get(reverse('blog:feed'))
+        self.assertEqual(list(response.context['posts']), [post])
+
+        post.published = False
+        post.save()
+        jobs.run_pending()
+        self.assertFalse(TimelineEntry.objects.exists())
+
+    def test_popular_authors_are_merged_in_on_read(self):
+        posts = []
+        for i in range(7):
+            posts.append(make_post(self.star if i % 2 else self.author, title=f'Post {i}'))
+        jobs.run_pending()
+        # the star has 3 followers, so only the author's posts were fanned out
+        self.assertEqual(TimelineEntry.objects.filter(user=self.reader).count(), 4)
+        expected = sorted(posts, key=lambda p: (p.created_at, p.pk), reverse=True)
+        pages = self.walk(3)
+        self.assertEqual([post for page in pages for post in page], expected)
+        naive = timeline.naive_timeline_page(self.reader, 7)
+        self.assertEqual(list(naive), expected)
+        # and back again
+        back = timeline.timeline_page(self.reader, 3, pages[-1].previous_cursor)
+        self.assertEqual(list(back), list(pages[1]))
+        with self.assertRaises(InvalidCursor):
+            timeline.timeline_page(self.reader, 3, 'garbage')
+
+    def test_entries_are_not_duplicated_when_an_author_becomes_popular(self):
+        old = make_post(self.author, title='Old')
+        jobs.run_pending()
+        for i in range(2):
+            Follow.objects.create(follower=User.objects.create_user(f'new{i}', password='pw'), following=self.author)
+        new = make_post(self.author, title='New')
+        jobs.run_pending()
+        self.assertFalse(TimelineEntry.objects.filter(post=new).exists())
+        self.assertEqual([post for page in self.walk(10) for post in page], [new, old])
+
+    def test_follow_backfills_and_unfollow_cleans_up(self):
+        posts = [make_post(self.author, title=f'Post {i}') for i in range(3)]
+        jobs.run_pending()
+        Follow.objects.filter(follower=self.reader).delete()
+        self.assertFalse(TimelineEntry.objects.filter(user=self.reader).exists())
+
+        self.client.force_login(self.reader)
+        response = self.client.post(reverse('blog:toggle_follow'), {'username': 'author'})
+        self.assertEqual(response.json()['status'], 'followed')
+        # only the last TIMELINE_BACKFILL_POSTS come back
+        self.assertEqual(list(self.walk(10)[0]), posts[:0:-1])
+        self.client.post(reverse('blog:toggle_follow'), {'username': 'author'})
+        self.assertFalse(TimelineEntry.objects.filter(user=self.reader).exists())
+
+    def test_author_dropping_under_the_limit_is_fanned_out(self):
+        post = make_post(self.star)
+        jobs.run_pending()
+        self.assertFalse(TimelineEntry.objects.exists())
+        Follow.objects.get(follower__username='fan2').delete()
+        jobs.run_pending()
+        self.assertEqual(
+            set(TimelineEntry.objects.filter(post=post).values_list('user__username', flat=True)),
+            {'reader', 'fan1'},
+        )
+
+    @skipUnless(connection.vendor == 'sqlite', 'SQLite query plans')
+    def test_timeline_read_uses_its_index(self):
+        plan = TimelineEntry.objects.filter(user=self.reader).order_by('-created_at', '-post_id')[:11].explain()
+        self.assertIn('USING INDEX timeline_user_idx', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_benchmark_command(self):
+        make_post(self.author)
+        jobs.run_pending()
+        out = StringIO()
+        call_command('benchmark_timeline', '--iterations=3', '--user=reader', stdout=out)
+        self.assertIn('Reader reader follows 2 authors (1 read live)', out.getvalue())
+        self.assertIn('naive join', out.getvalue())
+
+
+@override_settings(LIVE_BACKEND='blog.live.LocalBackend', LIVE_KEEPALIVE=0.05)
+class LiveUpdateTests(TestCase):
+    def setUp(self):
+        self.author = User.objects.create_user('author', password='pw')
+        self.post = make_post(self.author)
+        self.channel = live.post_channel(self.post.pk)
+        self.url = reverse('blog:post_stream', args=[self.post.slug])
+        hub = mock.patch.object(live, 'hub', live.Hub())
+        self.hub = hub.start()
+        self.addCleanup(hub.stop)
+
+    async def open_stream(self):
+        response = await self.async_client.get(self.url)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        stream = aiter(response.streaming_content)
+        self.assertEqual(await anext(stream), live.RETRY)
+        return stream
+
+    async def hang_up(self, stream):
+        # as on a disconnect: the server cancels the task waiting on the stream
+        reader = asyncio.ensure_future(anext(stream))
+        await asyncio.sleep(0)
+        reader.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await reader
+
+    async def next_event(self, stream, timeout=2):
+        while True:
+            chunk = await asyncio.wait_for(anext(stream), timeout)
+            if chunk.startswith(b'event: '):
+                return chunk.decode()
+
+    async def test_stream_pushes_comments_and_views(self):
+        stream = await self.open_stream()
+        self.assertEqual(await anext(stream), live.KEEPALIVE)
+        self.assertEqual(self.hub.count, 1)
+        comment = await Comment.objects.acreate(post=self.post, author=self.author, body='Hi <b>there</b>')
+        await sync_to_async(live.publish_comment)(comment)
+        event = await self.next_event(stream)
+        self.assertTrue(event.startswith('event: comment\ndata: {"id":%d,"author":"author"' % comment.pk))
+        self.assertEqual(self.hub.publish_views({self.post.pk: 12}, now=1000), 1)
+        self.assertEqual(await self.next_event(stream), 'event: views\ndata: {"views":12}\n\n')
+        await self.hang_up(stream)
+        self.assertEqual(self.hub.count, 0)
+
+    def test_wsgi_and_missing_posts(self):
+        self.assertEqual(self.client.get(self.url).status_code, 204)
+        missing = reverse('blog:post_stream', args=['missing'])
+        self.assertEqual(async_to_sync(self.async_client.get)(missing).status_code, 404)
+
+    @override_settings(LIVE_MAX_CONNECTIONS=1, LIVE_SUBSCRIBER_BUFFER=100)
+    async def test_connections_and_buffers_are_bounded(self):
+        first = await self.open_stream()
+        self.assertEqual((await self.async_client.get(self.url)).status_code, 503)
+        # a reader that stops reading is dropped once its buffer is full
+        for n in range(5):
+            self.hub.publish(self.channel, 'test', {'n': n, 'padding': 'x' * 20})
+        with self.assertRaises(StopAsyncIteration):
+            while True:
+                await self.next_event(first)
+        self.assertEqual(self.hub.count, 0)
+
+    def test_view_counts_are_throttled(self):
+        with mock.patch.object(self.hub, 'publish') as publish:
+            self.assertEqual(self.hub.publish_views({'a': 1, 'b': 5}, now=100), 2)
+            self.assertEqual(self.hub.publish_views({'a': 2}, now=101), 0)
+            self.assertEqual(self.hub.publish_views({'a': 3}, now=102), 0)
+            self.assertEqual(self.hub.publish_views({}, now=105), 1)
+        self.assertEqual(publish.call_args_list[-1], mock.call('post:a', 'views', {'views': 3}))
+
+    @override_settings(VIEW_COUNTER_FLUSH_INTERVAL=None, VIEW_DEDUPE_WINDOW=None)
+    def test_flushed_views_and_new_comments_are_published(self):
+        cache.clear()
+        buffer = ViewCounterBuffer()
+        buffer.record(self.post.slug, ip='10.0.0.1')
+        buffer.record(self.post.slug, ip='10.0.0.2')
+        with mock.patch.object(self.hub, 'publish_views') as publish_views:
+            buffer.flush()
+        publish_views.assert_called_once_with({self.post.pk: 2})
+        with mock.patch.object(self.hub, 'publish') as publish, self.captureOnCommitCallbacks(execute=True):
+            Comment.objects.create(post=self.post, author=self.author, body='Hello')
+            Comment.objects.create(post=self.post, author=self.author, body='Spam', moderated=True)
+        publish.assert_called_once()
+        self.assertEqual(publish.call_args.args[:2], (self.channel, 'comment'))
+
+    @override_settings(LIVE_BACKEND='blog.live.DatabaseBackend', LIVE_POLL_INTERVAL=0.01)
+    async def test_database_backend_reaches_other_processes(self):
+        stream = await self.open_stream()
+        await asyncio.sleep(0.05)  # the poller has read the current position
+        await sync_to_async(self.hub.publish)(self.channel, 'test', {'n': 1})
+        self.assertEqual(await LiveEvent.objects.acount(), 1)
+        self.assertEqual(await self.next_event(stream), 'event: test\ndata: {"n":1}\n\n')
+        await self.hang_up(stream)
+        await asyncio.wait_for(self.hub.backend.task, 1)  # stops with the last reader
+
+    @override_settings(LIVE_EVENT_LOOKBACK=10)
+    async def test_database_backend_reads_late_commits(self):
+        backend = live.DatabaseBackend(self.hub)
+        with mock.patch.object(self.hub, 'deliver') as deliver:
+            # pk 2 is still uncommitted in another publisher's transaction
+            await LiveEvent.objects.acreate(pk=1, channel=self.channel, message='one')
+            await LiveEvent.objects.acreate(pk=3, channel=self.channel, message='three')
+            self.assertEqual(await backend.read(now=100), 2)
+            await LiveEvent.objects.acreate(pk=2, channel=self.channel, message='two')
+            self.assertEqual(await backend.read(now=101), 1)
+            self.assertEqual(await backend.read(now=102), 0)
+        self.assertEqual([c.args[1] for c in deliver.call_args_list], ['one', 'three', 'two'])
+        self.assertEqual(backend.gaps, {})
+        await LiveEvent.objects.acreate(pk=5, channel=self.channel, message='five')
+        await backend.read(now=200)
+        await backend.read(now=211)  # a gap is given up after the lookback
+        self.assertEqual(backend.gaps, {})
+
+    @override_settings(LIVE_EVENT_RETENTION=300)
+    def test_database_backend_prunes_when_publishing(self):
+        backend = live.DatabaseBackend(self.hub)
+        old = LiveEvent.objects.create(channel=self.channel, message='old')
+        LiveEvent.objects.filter(pk=old.pk).update(created_at=timezone.now() - timedelta(minutes=10))
+        backend.publish(self.channel, 'new')
+        backend.publish(self.channel, 'newer')  # within PRUNE_INTERVAL: no second delete
+        self.assertEqual(list(LiveEvent.objects.order_by('pk').values_list('message', flat=True)), ['new', 'newer'])
+
+
+@override_settings(LIVE_BACKEND='blog.live.LocalBackend', LIVE_KEEPALIVE=0.05)
+class LiveLoadTestCommandTests(TransactionTestCase):
+    # each simulated connection runs its queries on its own thread and
+    # connection, as under a server, so the post has to be committed
+    def setUp(self):
+        make_post(User.objects.create_user('author', password='pw'))
+        hub = mock.patch.object(live, 'hub', live.Hub())
+        self.hub = hub.start()
+        self.addCleanup(hub.stop)
+
+    @override_settings(LIVE_MAX_CONNECTIONS=40)
+    def test_load_test_command(self):
+        out = StringIO()
+        call_command('live_load_test', '--connections=50', '--events=3', stdout=out)
+        self.assertIn('40 streams open, 10 refused', out.getvalue())
+        self.assertIn('Delivered 120 events', out.getvalue())
+        self.assertEqual(self.hub.count, 0)
+
+
+# the project's routes with the async views, as personal_blog/asgi.py serves them
+urlpatterns = [
+    path('', include((blog_urls.build_urlpatterns(async_views), 'blog'))),
+    *[pattern for pattern in project_urls.urlpatterns if getattr(pattern, 'namespace', None) != 'blog'],
+]
+async_routes = override_settings(ROOT_URLCONF=__name__)
+
+
+@plain_static
+@override_settings(VIEW_COUNTER_FLUSH_INTERVAL=None, VIEW_DEDUPE_WINDOW=None)
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.author = User.objects.create_user('author', password='pw')
+        self.reader = User.objects.create_user('reader', password='pw')
+        self.post = make_post(self.author)
+        Comment.objects.bulk_create([Comment(post=self.post, author=self.reader, body=f'c{i}') for i in range(25)])
+
+    def fetch(self, url, **extra):
+        """GET `url` from the sync views, then the async ones: (response, queries) for each."""
+        results = []
+        for client in (self.client, self.async_client):
+            cache.clear()
+            with async_routes if client is self.async_client else nullcontext():
+                get = async_to_sync(client.get) if client is self.async_client else client.get
+                with CaptureQueriesContext(connection) as queries:
+                    response = get(url, **extra)
+            results.append((response, [q['sql'] for q in queries]))
+        return results
+
+    def test_pages_match_the_sync_views(self):
+        urls = [
+            reverse('blog:home'), reverse('blog:search') + '?q=hello', self.post.get_absolute_url(),
+            reverse('blog:author_profile', args=['author']), reverse('blog:ajax_posts'),
+            reverse('blog:ajax_comments', args=[self.post.slug]),
+        ]
+        for url in urls:
+            with self.subTest(url=url):
+                (expected, expected_queries), (response, queries) = self.fetch(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.content, expected.content)
+                self.assertEqual(response['ETag'] if expected.has_header('ETag') else None, expected.get('ETag'))
+                self.assertEqual(len(queries), len(expected_queries), queries)
+
+    def test_signed_in_pages(self):
+        Follow.objects.create(follower=self.reader, following=self.author)
+        self.client.force_login(self.reader)
+        self.async_client.force_login(self.reader)
+        for url in (self.post.get_absolute_url(), reverse('blog:author_profile', args=['author'])):
+            with self.subTest(url=url):
+                (expected, expected_queries), (response, queries) = self.fetch(url)
+                self.assertTrue(response.context['is_following'])
+                self.assertIn('private', response['Cache-Control'])
+                self.assertNotIn('X-Page-Cache', response)
+                self.assertEqual(len(queries), len(expected_queries), queries)
+
+    def test_page_cache_and_conditional_get(self):
+        url = self.post.get_absolute_url()
+        with async_routes:
+            get = async_to_sync(self.async_client.get)
+            first = get(url)
+            self.assertEqual(first['X-Page-Cache'], 'miss')
+            with self.assertNumQueries(0):
+                self.assertEqual(get(url)['X-Page-Cache'], 'hit')
+            cache.clear()
+            self.assertEqual(get(url, headers={'If-None-Match': first['ETag']}).status_code, 304)
+            self.assertEqual(get(reverse('blog:post_detail', args=['missing'])).status_code, 404)
+            self.assertEqual(get(reverse('blog:home'), {'cursor': 'bogus'}).status_code, 404)
+
+    def test_ajax_writes(self):
+        with async_routes:
+            post = async_to_sync(self.async_client.post)
+            self.assertEqual(post(reverse('blog:toggle_follow'), {'username': 'author'}).status_code, 403)
+            self.async_client.force_login(self.reader)
+            response = post(reverse('blog:toggle_follow'), {'username': 'author'})
+            self.assertEqual(response.json(), {'status': 'followed', 'followers_count': 1})
+            response = post(reverse('blog:ajax_add_comment', args=[self.post.slug]), {'body': 'async'})
+            self.assertEqual(response.json()['comments_count'], 1)  # bulk-created comments are not counted
+            self.assertEqual(response.json()['comment']['body'], 'async')
+            response = post(reverse('blog:increment_post_view'), {'slug': self.post.slug})
+            self.assertEqual(response.json(), {'views': 1})
+
+
+class DatabaseConfigTests(TestCase):
+    def test_persistent_connections_from_url(self):
+        with mock.patch('personal_blog.database.pooling_available', return_value=False):
+            config = database_config('postgres://u:p@db.example.com:6543/blog?sslmode=require', conn_max_age=300)
+            self.assertEqual(config['PORT'], 6543)
+            self.assertEqual(config['OPTIONS'], {'sslmode': 'require'})
+            self.assertEqual(config['CONN_MAX_AGE'], 300)
+            self.assertTrue(config['CONN_HEALTH_CHECKS'])
+            # ASGI runs each request's queries on its own thread
+            self.assertEqual(database_config('postgres://u:p@db/blog', asgi=True)['CONN_MAX_AGE'], 0)
+
+    def test_pooling(self):
+        with mock.patch('personal_blog.database.pooling_available', return_value=True):
+            config = database_config('postgres://u:p@db/blog', pool_min=1, pool_max=4)
+            self.assertEqual(config['OPTIONS']['pool'], {'min_size': 1, 'max_size': 4, 'timeout': 10})
+            self.assertEqual(config['CONN_MAX_AGE'], 0)
+            self.assertNotIn('pool', database_config('postgres://u:p@db/blog', pool_max=0).get('OPTIONS', {}))
+            self.assertNotIn('pool', database_config('sqlite:///blog.sqlite3').get('OPTIONS', {}))
+
+
+@plain_static
+@mock.patch('blog.routers.replica_alias', return_value='replica')
+class ReplicaRoutingTests(TestCase):
+    def setUp(self):
+        self.router = PrimaryReplicaRouter()
+        self.author = User.objects.create_user('author', password='pw')
+        self.post = make_post(self.author)
+
+    def test_reads_go_to_the_replica_only_where_asked(self, alias):
+        self.assertIsNone(self.router.db_for_read(Post))
+        with routers.routing() as state:
+            self.assertIsNone(self.router.db_for_read(Post))
+            state.replica = True
+            self.assertEqual(self.router.db_for_read(Post), 'replica')
+            self.assertIsNone(self.router.db_for_read(Session))
+            # read-after-write within the request
+            self.assertEqual(self.router.db_for_write(Post), 'default')
+            self.assertIsNone(self.router.db_for_read(Post))
+
+    def reads(self, method, url, data=None):
+        """(response, databases the router picked for reads) for one request."""
+        picked = []
+        db_for_read = PrimaryReplicaRouter.db_for_read
+
+        def spy(router, model, **hints):
+            picked.append(db_for_read(router, model, **hints))
+            return None  # the test database has no replica
+
+        with mock.patch.object(PrimaryReplicaRouter, 'db_for_read', spy):
+            response = getattr(self.client, method)(url, data)
+        return response, set(picked)
+
+    def test_writers_read_from_the_primary_for_a_while(self, alias):
+        reader = User.objects.create_user('reader', password='pw')
+        self.client.force_login(reader)
+        response, picked = self.reads('get', self.post.get_absolute_url())
+        self.assertIn('replica', picked)
+        self.assertNotIn(routers.PRIMARY_COOKIE, response.cookies)
+        response, _ = self.reads('post', reverse('blog:ajax_add_comment', args=[self.post.slug]), {'body': 'hi'})
+        self.assertEqual(response.cookies[routers.PRIMARY_COOKIE]['max-age'], 5)
+        response, picked = self.reads('get', self.post.get_absolute_url())
+        self.assertEqual(picked, {None})
+        self.assertContains(response, 'hi')
+
+
+@plain_static
+@override_settings(METRICS_SAMPLE_RATE=1.0, METRICS_TOKEN='secret')
+class MetricsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        metrics.registry.reset()
+        self.author = User.objects.create_user('author', password='pw')
+        self.post = make_post(self.author)
+        self.staff = User.objects.create_user('staff', password='pw', is_staff=True)
+
+    def scrape(self, **headers):
+        return self.client.get(reverse('blog:metrics'), headers=headers)
+
+    def test_requests_are_measured(self):
+        self.client.get(reverse('blog:home'))
+        self.client.get(reverse('blog:home'))
+        text = self.scrape(authorization='Bearer secret').content.decode()
+        self.assertIn('blog_requests_total{view="blog:home",method="GET",status="200"} 2', text)
+        self.assertIn('blog_request_duration_seconds_count{view="blog:home"} 2', text)
+        self.assertIn('blog_request_duration_seconds_bucket{view="blog:home",le="+Inf"} 2', text)
+        # the second request came from the page cache
+        self.assertIn('blog_request_queries_bucket{view="blog:home",le="0"} 1', text)
+        self.assertIn('blog_template_render_seconds_count{template="blog/home.html"} 1', text)
+        self.assertIn('blog_cache_requests_total{cache="page",result="hit"} 1', text)
+        self.assertIn('blog_cache_requests_total{cache="render",result="hit"} 1', text)
+
+    def test_staff_only(self):
+        self.assertEqual(self.scrape().status_code, 403)
+        self.assertEqual(self.scrape(authorization='Bearer wrong').status_code, 403)
+        self.client.force_login(self.author)
+        self.assertEqual(self.scrape().status_code, 403)
+        self.client.force_login(self.staff)
+        response = self.scrape()
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+
+    @override_settings(METRICS_SAMPLE_RATE=0)
+    def test_unsampled_requests_are_only_timed(self):
+        with mock.patch.object(connection, 'execute_wrapper') as execute_wrapper:
+            self.client.get(self.post.get_absolute_url())
+        execute_wrapper.assert_not_called()
+        text = self.scrape(authorization='Bearer secret').content.decode()
+        self.assertIn('blog_request_duration_seconds_count{view="blog:post_detail"} 1', text)
+        self.assertNotIn('blog_request_queries_count', text)
+
+    @override_settings(METRICS_SLOW_REQUEST=0)
+    def test_slow_requests_are_logged_with_their_queries(self):
+        with self.assertLogs('blog.metrics', 'WARNING') as logs:
+            self.client.get(self.post.get_absolute_url())
+        self.assertIn('Slow request: GET /post/hello-world/ (blog:post_detail)', logs.output[0])
+        self.assertIn('FROM "blog_post"', logs.output[0])
+
+    def test_other_workers_are_added_up(self):
+        self.client.get(reverse('blog:home'))
+        labels = (('view', 'blog:home'), ('method', 'GET'), ('status', 200))
+        cache.set(metrics.worker_key(1), {'blog_requests_total': {labels: 5}})
+        cache.set(metrics.WORKERS_KEY, [1, *cache.get(metrics.WORKERS_KEY)])
+        text = self.scrape(authorization='Bearer secret').content.decode()
+        self.assertIn('blog_requests_total{view="blog:home",method="GET",status="200"} 6', text)
+        # a worker that stopped publishing drops out
+        cache.delete(metrics.worker_key(1))
+        text = self.scrape(authorization='Bearer secret').content.decode()
+        self.assertIn('blog_requests_total{view="blog:home",method="GET",status="200"} 1', text)
+
+
+@plain_static
+class CategoryFeedTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.author = User.objects.create_user('author', password='pw')
+        self.python = Category.objects.create(name='Python', slug='python')
+        self.django = Category.objects.create(name='Django', slug='django')
+        self.post = make_post(self.author, title='Snakes', category=self.python)
+        make_post(self.author, title='Ponies', category=self.django)
+        self.draft = make_post(self.author, title='Draft snakes', category=self.python, published=False)
+        self.url = reverse('blog:home') + '?category=python'
+
+    def cached(self):
+        return cache.get(stats.CATEGORY_COUNTS_KEY) is not None
+
+    def test_filter_and_counts(self):
+        response = self.client.get(self.url)
+        self.assertEqual([post.title for post in response.context['posts']], ['Snakes'])
+        self.assertEqual(response.context['category']['name'], 'Python')
+        self.assertEqual(
+            [(c['slug'], c['post_count']) for c in response.context['categories']], [('django', 1), ('python', 1)],
+        )
+        self.assertEqual(self.client.get(reverse('blog:home') + '?category=missing').status_code, 404)
+        results = self.client.get(reverse('blog:search'), {'q': 'ponies', 'category': 'python'})
+        self.assertEqual(list(results.context['posts']), [])
+
+    def test_counts_are_invalidated_only_when_they_change(self):
+        stats.category_counts()
+        self.draft.category = self.django
+        self.draft.save()
+        self.post.title = 'Snakes again'
+        self.post.save()
+        self.assertTrue(self.cached())
+        self.post.category = self.django
+        self.post.save()
+        self.assertFalse(self.cached())
+        stats.category_counts()
+        self.draft.published = True
+        self.draft.save()
+        self.assertFalse(self.cached())
+        self.assertEqual({c['slug']: c['post_count'] for c in stats.category_counts()}, {'django': 3, 'python': 0})
+        self.python.delete()
+        self.assertFalse(self.cached())
+
+    def test_page_cache_and_conditional_get(self):
+        self.assertEqual(self.client.get(self.url)['X-Page-Cache'], 'miss')
+        self.assertEqual(self.client.get(reverse('blog:home'))['X-Page-Cache'], 'miss')
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url)
+        self.assertEqual(response['X-Page-Cache'], 'hit')
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        make_post(self.author, title='More snakes', category=self.python)
+        response = self.client.get(self.url)
+        self.assertEqual(response['X-Page-Cache'], 'miss')
+        self.assertContains(response, 'More snakes')
+
+    def test_async_view(self):
+        expected = self.client.get(self.url)
+        cache.clear()
+        with async_routes:
+            response = async_to_sync(self.async_client.get)(self.url)
+            self.assertEqual(async_to_sync(self.async_client.get)(reverse('blog:home') + '?category=x').status_code, 404)
+        self.assertEqual(response.content, expected.content)
+
+
+@override_settings(VIEW_COUNTER_FLUSH_INTERVAL=None, VIEW_DEDUPE_WINDOW=None)
+class TrendingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.author = User.objects.create_user('author', password='pw')
+        self.old = make_post(self.author, title='Old news')
+        self.new = make_post(self.author, title='Fresh news')
+        self.board = trending.Leaderboard()
+        self.now = 1_700_000_000
+
+    def ranking(self, now=None):
+        return [(entry['title'], entry['score']) for entry in self.board.top(now=now or self.now)]
+
+    def test_scores_decay(self):
+        half_life = trending.half_life()
+        self.board.record(self.old.pk, 10, now=self.now)
+        self.board.record_many({self.new.pk: 4}, now=self.now + 2 * half_life)
+        self.board.flush(self.now + 2 * half_life)
+        # ten views two half-lives ago are worth 2.5 now
+        self.assertEqual(self.ranking(self.now + 2 * half_life), [('Fresh news', 4.0), ('Old news', 2.5)])
+        self.assertEqual(self.ranking(self.now + 3 * half_life), [('Fresh news', 2.0), ('Old news', 1.25)])
+        self.board.record(self.old.pk, 5, now=self.now + 2 * half_life)
+        self.board.flush(self.now + 2 * half_life)
+        self.assertEqual(self.ranking(self.now + 2 * half_life), [('Old news', 7.5), ('Fresh news', 4.0)])
+
+    def test_capacity_drafts_and_limit(self):
+        draft = make_post(self.author, title='Draft', published=False)
+        with override_settings(TRENDING_CAPACITY=2):
+            self.board.record_many({self.old.pk: 1, self.new.pk: 3, draft.pk: 2}, now=self.now)
+            self.assertEqual(self.board.flush(self.now), 3)
+        # the lowest score was dropped, and drafts are never listed
+        self.assertEqual(set(self.board.load_table()), {self.new.pk, draft.pk})
+        self.assertEqual(self.ranking(), [('Fresh news', 3.0)])
+        self.assertEqual(self.board.flush(), 0)
+
+    def test_checkpoint_and_reload(self):
+        self.board.record_many({self.old.pk: 1, self.new.pk: 2}, now=self.now)
+        self.board.flush(self.now)
+        self.assertEqual(TrendingScore.objects.count(), 2)
+        self.old.delete()
+        cache.clear()
+        # the cache lost the scores: they come back from the checkpoint
+        with self.assertNumQueries(2):
+            self.assertEqual(self.ranking(), [('Fresh news', 2.0)])
+        with self.assertNumQueries(0):
+            self.board.top()
+        self.board.record(self.new.pk, 1, now=self.now)
+        with override_settings(TRENDING_CHECKPOINT_INTERVAL=0):
+            self.board.flush(self.now)
+        self.assertEqual(list(TrendingScore.objects.values_list('post_id', flat=True)), [self.new.pk])
+        self.assertAlmostEqual(trending.current_score(TrendingScore.objects.get().score, self.now), 3.0)
+
+    def test_busy_lock_keeps_events(self):
+        self.board.record(self.new.pk, 1, now=self.now)
+        cache.add(trending.LOCK_KEY, 1)
+        self.assertIsNone(self.board.flush(self.now))
+        cache.delete(trending.LOCK_KEY)
+        self.assertEqual(self.board.flush(self.now), 1)
+        self.assertEqual(self.ranking(), [('Fresh news', 1.0)])
+
+    def test_views_and_comments_count(self):
+        buffer = ViewCounterBuffer()
+        for _ in range(3):
+            buffer.record(self.old.slug)
+        buffer.record(self.new.slug)
+        buffer.flush()
+        self.assertEqual([entry['title'] for entry in trending.leaderboard.top()], ['Old news', 'Fresh news'])
+        # the inserts and the comment counter: no trending work on the request
+        with self.assertNumQueries(3), self.captureOnCommitCallbacks(execute=True):
+            Comment.objects.create(post=self.new, author=self.author, body='Hot take')
+            Comment.objects.create(post=self.old, author=self.author, body='Hidden', moderated=True)
+        # recorded on commit, published by the next periodic flush
+        self.assertEqual([entry['title'] for entry in trending.leaderboard.top()], ['Old news', 'Fresh news'])
+        buffer.flush()
+        self.assertEqual([entry['title'] for entry in trending.leaderboard.top()], ['Fresh news', 'Old news'])
+
+    def test_listed_posts_edited_or_deleted(self):
+        trending.leaderboard.record_many({self.old.pk: 2, self.new.pk: 1})
+        trending.leaderboard.flush()
+        with mock.patch.object(trending.page_cache, 'invalidate') as invalidate, self.captureOnCommitCallbacks(execute=True):
+            self.new.title = 'Fresher news'
+            self.new.slug = 'fresher-news'
+            self.new.save()
+        invalidate.assert_any_call('trending')
+        self.assertEqual([(entry['title'], entry['url']) for entry in trending.leaderboard.top()],
+                         [('Old news', self.old.get_absolute_url()), ('Fresher news', self.new.get_absolute_url())])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.old.delete()
+        self.assertEqual([entry['title'] for entry in trending.leaderboard.top()], ['Fresher news'])
+
+    @plain_static
+    def test_sidebar_and_endpoint(self):
+        trending.leaderboard.record_many({self.old.pk: 2, self.new.pk: 1})
+        trending.leaderboard.flush()
+        response = self.client.get(reverse('blog:home'))
+        self.assertEqual([entry['title'] for entry in response.context['trending']], ['Old news', 'Fresh news'])
+        self.assertContains(response, 'Trending')
+        etag = response['ETag']
+        self.assertEqual(self.client.get(reverse('blog:home'))['X-Page-Cache'], 'hit')
+        # a new order invalidates the cached page and its ETag
+        trending.leaderboard.record(self.new.pk, 5)
+        trending.leaderboard.flush()
+        response = self.client.get(reverse('blog:home'))
+        self.assertEqual(response['X-Page-Cache'], 'miss')
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual([entry['title'] for entry in response.context['trending']], ['Fresh news', 'Old news'])
+
+        url = reverse('blog:trending')
+        with self.assertNumQueries(0):
+            posts = self.client.get(url, {'limit': 1}).json()['posts']
+        self.assertEqual([(post['id'], post['url']) for post in posts], [(str(self.new.pk), self.new.get_absolute_url())])
+        self.assertEqual(len(self.client.get(url, {'limit': 100}).json()['posts']), 2)
+        self.assertEqual(self.client.get(url, {'limit': 'x'}).status_code, 400)
+        with async_routes:
+            self.assertEqual(async_to_sync(self.async_client.get)(url, {'limit': 1}).json()['posts'][0]['id'],
+                             str(self.new.pk))
+            response = async_to_sync(self.async_client.get)(reverse('blog:home'))
+        self.assertContains(response, self.new.get_absolute_url())
+
+    def test_benchmark_command(self):
+        out = StringIO()
+        call_command('benchmark_trending', events=100, flushes=2, batch=10, reads=5, stdout=out)
+        self.assertIn('ns/event', out.getvalue())
+        # the site's scores are left alone
+        self.assertFalse(TrendingScore.objects.exists())
+        self.assertIsNone(cache.get(trending.TOP_KEY))
+
+
+class RelatedPostTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.author = User.objects.create_user('author', password='pw')
+        self.python = Category.objects.create(name='Python', slug='python')
+        self.cooking = Category.objects.create(name='Cooking', slug='cooking')
+        self.orm = make_post(self.author, title='Django ORM queries', category=self.python,
+                             content='<p>Speed up <strong>Django</strong> ORM queries with select_related and indexes.</p>')
+        self.indexes = make_post(self.author, title='Database indexes', category=self.python,
+                                 content='<p>Indexes make ORM queries fast; read the query plan.</p>')
+        self.pasta = make_post(self.author, title='Fresh pasta', category=self.cooking,
+                               content='<p>Flour, eggs and patience make fresh pasta.</p>')
+        self.sauce = make_post(self.author, title='Tomato sauce for pasta', category=self.cooking,
+                               content='<p>Simmer tomatoes slowly; toss the pasta in the sauce.</p>')
+        self.draft = make_post(self.author, title='Django ORM draft', published=False,
+                               content='<p>Django ORM queries, indexes and select_related.</p>')
+        BackgroundJob.objects.all().delete()
+
+    def listed(self, post):
+        return [item.related.title for item in related.related_posts(post)]
+
+    def rows(self):
+        return sorted(RelatedPost.objects.values_list('post__title', 'related__title', 'rank'))
+
+    def test_similar_posts_come_first(self):
+        call_command('build_related_posts', stdout=StringIO())
+        self.assertEqual(self.listed(self.orm), ['Database indexes'])
+        self.assertEqual(self.listed(self.pasta), ['Tomato sauce for pasta', 'Database indexes'])
+        self.assertFalse(RelatedPost.objects.filter(post=self.draft).exists())
+        self.assertFalse(RelatedPost.objects.filter(related=self.draft).exists())
+        # a shared category lifts a post with no words in common
+        make_post(self.author, title='Release notes', category=self.python, content='<p>Version two ships today.</p>')
+        related.rebuild()
+        self.assertEqual(self.listed(self.orm), ['Database indexes', 'Release notes'])
+        with override_settings(RELATED_POSTS_CATEGORY_WEIGHT=0):
+            related.rebuild()
+        self.assertEqual(self.listed(self.orm), ['Database indexes'])
+
+    def test_blocks_match_a_single_pass(self):
+        related.rebuild()
+        expected = self.rows()
+        with override_settings(RELATED_POSTS_MEMORY=1):
+            corpus = related.Corpus.load(chunk_size=2)
+            self.assertEqual(corpus.block_size(), 1)
+            related.rebuild(corpus)
+        self.assertEqual(self.rows(), expected)
+
+    def test_changes_update_the_lists_they_affect(self):
+        related.rebuild()
+        post = make_post(self.author, title='Pasta water', category=self.cooking,
+                         content='<p>Salt the pasta water; save some for the sauce.</p>')
+        self.assertTrue(BackgroundJob.objects.filter(task='related.update').exists())
+        jobs.run_pending()
+        self.assertIn('Pasta water', self.listed(self.sauce))
+        self.assertIn('Tomato sauce for pasta', self.listed(post))
+        # comment-only saves and draft edits queue nothing
+        post.views = 5
+        post.save(update_fields=['views'])
+        self.draft.title = 'Still a draft'
+        self.draft.save()
+        self.assertFalse(BackgroundJob.objects.exists())
+        # unpublishing takes the post out of the lists that named it
+        post.published = False
+        post.save()
+        self.assertTrue(BackgroundJob.objects.filter(task='related.update').exists())
+        jobs.run_pending()
+        self.assertNotIn('Pasta water', self.listed(self.sauce))
+        self.assertFalse(RelatedPost.objects.filter(post=post).exists())
+        # as does deleting it, after a full rebuild
+        related.rebuild()
+        self.sauce.delete()
+        self.assertEqual(jobs.run_pending(), (1, 0))
+        self.assertNotIn('Tomato sauce for pasta', [title for _, title, _ in self.rows()])
+        related.update([self.orm.pk])
+        expected = self.rows()
+        related.rebuild()
+        self.assertEqual(self.rows(), expected)
+
+    def test_queued_updates_share_one_corpus_load(self):
+        related.rebuild()
+        for post in (self.orm, self.pasta, self.sauce):
+            post.title += ' revisited'
+            post.save()
+        self.assertEqual(BackgroundJob.objects.filter(task='related.update').count(), 3)
+        with mock.patch.object(related.Corpus, 'load', wraps=related.Corpus.load) as load, \
+                mock.patch.object(related, 'update', wraps=related.update) as update:
+            self.assertEqual(jobs.run_pending(), (1, 0))
+        load.assert_called_once()
+        self.assertCountEqual(update.call_args.args[0], [str(p.pk) for p in (self.orm, self.pasta, self.sauce)])
+        self.assertFalse(BackgroundJob.objects.exists())
+
+    @plain_static
+    def test_detail_page(self):
+        related.rebuild()
+        url = self.orm.get_absolute_url()
+        response = self.client.get(url)
+        self.assertContains(response, 'Related posts')
+        self.assertContains(response, self.indexes.get_absolute_url())
+        etag = response['ETag']
+        self.assertEqual(self.client.get(url)['X-Page-Cache'], 'hit')
+        # a new list invalidates the cached page and its ETag
+        related.store([(self.orm.pk, [(self.pasta.pk, 0.5)])])
+        response = self.client.get(url)
+        self.assertEqual(response['X-Page-Cache'], 'miss')
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertContains(response, self.pasta.get_absolute_url())
+        self.assertNotContains(response, self.indexes.get_absolute_url())
+        expected = response.content
+        cache.clear()
+        with async_routes:
+            response = async_to_sync(self.async_client.get)(url)
+        self.assertEqual(response.content, expected)
+
+
+class FollowSuggestionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.users = {name: User.objects.create_user(name, password='pw') for name in 'rabcdex'}
+        for follower, following in ['ra', 'rb', 'ac', 'bc', 'ad', 'xa', 'xb', 'xe']:
+            self.follow(follower, following)
+
+    def follow(self, follower, following):
+        return Follow.objects.create(follower=self.users[follower], following=self.users[following])
+
+    def listed(self, name):
+        user = self.users.get(name) or User.objects.get(username=name)
+        return [(item.suggested.username, item.mutual) for item in suggestions.suggestions_for(user)]
+
+    def rows(self):
+        return sorted(FollowSuggestion.objects.values_list('user__username', 'suggested__username', 'rank'))
+
+    def stale(self):
+        return set(Profile.objects.filter(suggestions_stale=True).values_list('user__username', flat=True))
+
+    def test_friends_of_friends_then_co_followers(self):
+        self.assertEqual(suggestions.refresh(), 7)
+        # c is followed by both authors r follows, d by one; x follows what r does, and e
+        self.assertEqual(self.listed('r'), [('c', 2), ('d', 1), ('e', 0)])
+        with override_settings(FOLLOW_SUGGESTIONS_CO_FOLLOWER_WEIGHT=2):
+            suggestions.refresh(everyone=True)
+        self.assertEqual([name for name, _ in self.listed('r')], ['c', 'e', 'd'])
+        # with no follows, the most followed authors
+        self.assertEqual({name for name, _ in self.listed('e')[:3]}, {'a', 'b', 'c'})
+
+    def test_only_stale_users_are_refreshed(self):
+        suggestions.refresh()
+        self.assertEqual(self.stale(), set())
+        self.assertEqual(suggestions.refresh(), 0)
+        # a's friends of friends changed, and so did those of r and x, who follow a
+        self.follow('a', 'e')
+        self.assertEqual(self.stale(), {'a', 'r', 'x'})
+        self.assertEqual(suggestions.refresh(), 3)
+        self.assertEqual(self.listed('r')[:2], [('c', 2), ('e', 1)])
+        Follow.objects.get(follower=self.users['x'], following=self.users['e']).delete()
+        self.assertEqual(self.stale(), {'x'})
+        # new users have nothing stored yet
+        User.objects.create_user('newcomer', password='pw')
+        self.assertEqual(self.stale(), {'x', 'newcomer'})
+        self.assertEqual(suggestions.refresh(), 2)
+        self.assertEqual(self.listed('newcomer')[0][1], 0)
+
+    def test_failed_run_leaves_users_stale(self):
+        with mock.patch.object(suggestions.Graph, 'suggest', side_effect=MemoryError):
+            with self.assertRaises(MemoryError):
+                suggestions.refresh()
+        self.assertEqual(len(self.stale()), 7)
+        self.assertFalse(FollowSuggestion.objects.exists())
+        # an empty graph is loaded once, not for every batch
+        Follow.objects.all().delete()
+        with mock.patch.object(suggestions.Graph, 'load', wraps=suggestions.Graph.load) as load:
+            self.assertEqual(suggestions.refresh(batch_size=2), 7)
+        load.assert_called_once()
+        self.assertEqual(self.stale(), set())
+
+    def test_blocks_match_a_single_pass(self):
+        suggestions.refresh()
+        expected = self.rows()
+        with override_settings(FOLLOW_SUGGESTIONS_MEMORY=1):
+            graph = suggestions.Graph.load(chunk_size=3)
+            self.assertEqual(graph.block_size(), 1)
+            suggestions.refresh(everyone=True, graph=graph, batch_size=2)
+        self.assertEqual(self.rows(), expected)
+        out = StringIO()
+        call_command('build_follow_suggestions', '--all', stdout=out)
+        self.assertIn('Refreshed suggestions for 7 users', out.getvalue())
+        self.assertEqual(self.rows(), expected)
+
+    def test_followed_authors_drop_out_at_once(self):
+        suggestions.refresh()
+        self.follow('r', 'c')
+        with self.assertNumQueries(1):
+            self.assertEqual(self.listed('r'), [('d', 1), ('e', 0)])
+
+    @plain_static
+    def test_pages(self):
+        suggestions.refresh()
+        self.client.force_login(self.users['r'])
+        response = self.client.get(reverse('blog:dashboard'))
+        self.assertContains(response, 'Who to follow')
+        self.assertContains(response, 'followed by 2 authors you follow')
+        # not the author being viewed
+        url = reverse('blog:author_profile', args=['c'])
+        response = self.client.get(url)
+        self.assertEqual([item.suggested.username for item in response.context['suggestions']], ['d', 'e'])
+        etag = response['ETag']
+        self.follow('r', 'd')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item.suggested.username for item in response.context['suggestions']], ['e'])
+        self.async_client.force_login(self.users['r'])
+        with async_routes:
+            response = async_to_sync(self.async_client.get)(url)
+        self.assertEqual([item.suggested.username for item in response.context['suggestions']], ['e'])
+        self.client.logout()
+        self.assertNotContains(self.client.get(url), 'Who to follow')
+
+
+class BenchmarkTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_generated_data_is_consistent(self):
+        counts = benchmark.generate(users=10, posts=30, comments=60, follows=15, views=200, seed=3)
+        self.assertEqual(counts, {'users': 10, 'posts': 30, 'comments': 60, 'follows': 15, 'views': 200})
+        self.assertEqual(Profile.objects.count(), 10)
+        self.assertEqual(Comment.objects.count(), 60)
+        self.assertEqual(PostSearchDocument.objects.count(), 30)
+        self.assertEqual(sum(Post.objects.values_list('views', flat=True)), PostView.objects.count())
+        for post in Post.objects.annotate(n=Count('comments')):
+            self.assertEqual(post.comment_count, post.n)
+        self.assertTrue(Post.objects.filter(content__contains='<ul><li>').exists())
+        # dates are spread out, not all "now"
+        self.assertGreater(Post.objects.dates('created_at', 'day').count(), 10)
+        # a second run adds to the first
+        benchmark.generate(users=5, posts=5, comments=5, follows=5, views=5, seed=4)
+        self.assertEqual(User.objects.count(), 15)
+
+    @plain_static
+    def test_every_endpoint_is_measured(self):
+        benchmark.generate(users=10, posts=20, comments=20, follows=10, views=50)
+        reported = []
+        results = benchmark.run(requests=3, report=lambda name, result: reported.append(name))
+        self.assertEqual(list(results), list(benchmark.ENDPOINTS))
+        self.assertEqual(reported, list(benchmark.ENDPOINTS))
+        for name, result in results.items():
+            self.assertEqual(result['errors'], 0, name)
+            self.assertLessEqual(result['p50'], result['p99'])
+        # warm anonymous pages come from the page cache
+        self.assertEqual(results['home (anonymous)']['queries'], 0)
+        self.assertGreater(results['home']['queries'], 0)
+        self.assertEqual(Comment.objects.filter(body__startswith='Benchmark comment').count(), 8)
+
+
+class TransferTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        benchmark.generate(users=10, posts=30, comments=60, follows=12, views=0, seed=5)
+        BackgroundJob.objects.all().delete()
+
+    def export(self):
+        path = f'{self.dir}/blog.jsonl'
+        out = StringIO()
+        call_command('export_blog', path, stdout=out)
+        self.assertIn('Exported 8 categories, 30 posts, 60 comments, 12 follows', out.getvalue())
+        return path
+
+    def load(self, path, **options):
+        out = StringIO()
+        call_command('import_blog', path, stdout=out, **options)
+        return out.getvalue()
+
+    def snapshot(self):
+        return (
+            sorted(Post.objects.values_list('pk', 'author__username', 'title', 'slug', 'content', 'category__slug',
+                                            'published', 'created_at', 'updated_at', 'views', 'comment_count')),
+            sorted(Comment.objects.values_list('post_id', 'author__username', 'body', 'created_at')),
+            sorted(Follow.objects.values_list('follower__username', 'following__username', 'created_at')),
+            sorted(Profile.objects.values_list('user__username', 'followers_count', 'following_count',
+                                               'published_posts_count')),
+        )
+
+    def test_round_trip(self):
+        expected = self.snapshot()
+        path = self.export()
+        Post.objects.all().delete()
+        Follow.objects.all().delete()
+        Category.objects.all().delete()
+        User.objects.filter(username='bench7').delete()
+        BackgroundJob.objects.all().delete()
+        output = self.load(path, batch_size=7)
+        self.assertIn('Imported 8 categories, 30 posts, 60 comments and 12 follows', output)
+        self.assertEqual(self.snapshot(), expected)
+        self.assertEqual(PostSearchDocument.objects.count(), 30)
+        # signals did not run per row: the followers' timelines are refilled by one job per author
+        tasks = list(BackgroundJob.objects.values_list('task', flat=True))
+        self.assertEqual(set(tasks), {'timeline.fan_out_author'})
+        self.assertLessEqual(len(tasks), 8)
+        jobs.run_pending()
+        follow = Follow.objects.filter(following__posts__published=True).first()
+        self.assertTrue(TimelineEntry.objects.filter(user=follow.follower, author=follow.following).exists())
+        # a missing author comes back as a user who cannot sign in
+        self.assertFalse(User.objects.get(username='bench7').has_usable_password())
+
+    def test_import_again_and_slug_clashes(self):
+        path = self.export()
+        expected = self.snapshot()
+        output = self.load(path)
+        self.assertIn('Imported 0 categories, 0 posts, 0 comments and 12 follows', output)
+        self.assertIn('skipped 30 posts, 60 comments', output)
+        self.assertEqual(self.snapshot(), expected)
+        # the same posts under new ids clash with every slug, and with each other within a batch
+        clashing = f'{self.dir}/clashing.jsonl'
+        with open(clashing, 'w', encoding='utf-8') as out:
+            for copy in range(2):
+                for post in Post.objects.order_by('slug')[:3]:
+                    out.write(json.dumps({'type': 'post', 'id': str(uuid.uuid4()), 'author': post.author.username,
+                                          'title': post.title, 'slug': post.slug}) + '\n')
+        self.assertIn('renamed 6 clashing slugs', self.load(clashing, batch_size=4))
+        slugs = list(Post.objects.order_by('slug').values_list('slug', flat=True))
+        self.assertEqual(len(slugs), len(set(slugs)))
+        first = Post.objects.order_by('slug').first().slug
+        self.assertEqual(Post.objects.filter(slug__in=[first, f'{first}-2', f'{first}-3']).count(), 3)
+
+    def test_caches_are_invalidated_on_commit(self):
+        path = self.export()
+        Post.objects.all().delete()
+        author = User.objects.get(username='bench0')
+        with mock.patch.object(transfer.page_cache, 'invalidate') as invalidate, \
+                mock.patch.object(transfer, 'invalidate_category_counts') as category_counts:
+            with self.captureOnCommitCallbacks() as callbacks:
+                self.load(path)
+            # a request during the import would cache the old pages again
+            invalidate.assert_not_called()
+            category_counts.assert_not_called()
+            for callback in callbacks:
+                callback()
+        category_counts.assert_called_once()
+        tags = set(invalidate.call_args.args)
+        self.assertIn('post-list', tags)
+        self.assertIn(f'author:{author.pk}', tags)
+
+    def test_queries_per_batch_not_per_row(self):
+        path = self.export()
+        Post.objects.all().delete()
+        Follow.objects.all().delete()
+        with CaptureQueriesContext(connection) as queries:
+            self.load(path, batch_size=1000)
+        # the same file needs no more queries for five times as many rows
+        with open(path, encoding='utf-8') as source:
+            lines = source.readlines()
+        bigger = f'{self.dir}/bigger.jsonl'
+        with open(bigger, 'w', encoding='utf-8') as out:
+            for copy in range(5):
+                for line in lines:
+                    record = json.loads(line)
+                    if record['type'] == 'post':
+                        record['id'] = str(uuid.UUID(int=uuid.UUID(record['id']).int ^ copy))
+                    elif record['type'] == 'comment':
+                        record['post'] = str(uuid.UUID(int=uuid.UUID(record['post']).int ^ copy))
+                    out.write(json.dumps(record) + '\n')
+        Post.objects.all().delete()
+        Follow.objects.all().delete()
+        with CaptureQueriesContext(connection) as more:
+            output = self.load(bigger, batch_size=1000)
+        self.assertIn('150 posts, 300 comments', output)
+        self.assertLessEqual(len(more), len(queries) + 5)
+
+    def test_bad_line_rolls_back(self):
+        path = self.export()
+        with open(path, 'a', encoding='utf-8') as out:
+            out.write('{"type": "comment", "post": "x"}\n')
+        Post.objects.all().delete()
+        with self.assertRaisesMessage(CommandError, 'Line 111: comment without author, body.'):
+            self.load(path)
+        self.assertFalse(Post.objects.exists())
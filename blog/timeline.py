@@ -0,0 +1,157 @@
+"""
+Timelines: the published posts of the authors a reader follows.
+
+Joining Follow to Post on every read means, for a reader following
+thousands of authors, merging thousands of index ranges before the first
+page can be cut. Instead a post is copied into each follower's timeline as
+a TimelineEntry when it is published (fan-out on write), so a page is one
+range scan of ``timeline_user_idx``. The ``timeline.fan_out`` job writes the
+entries in batches of ``TIMELINE_BATCH_SIZE``; unpublishing a post removes
+them with ``timeline.retract``.
+
+Authors with ``TIMELINE_FANOUT_LIMIT`` followers or more are not fanned out,
+since every post would cost that many rows. Their posts are read live
+(fan-in on read) and merged with the reader's entries, each side a keyset
+range scan (``MergedKeysetPaginator``). An author who drops back under the
+limit has their recent posts fanned out again.
+
+Following an author copies their last ``TIMELINE_BACKFILL_POSTS`` posts into
+the reader's timeline; unfollowing deletes that author's entries.
+"""
+from itertools import islice
+
+from django.conf import settings
+
+from . import jobs
+from .models import Follow, Post, Profile, TimelineEntry
+from .pagination import KeysetPaginator, MergedKeysetPaginator
+
+ENTRY_ORDERING = ('-created_at', '-post_id')
+POST_ORDERING = ('-created_at', '-pk')
+
+
+def fanout_limit():
+    return getattr(settings, 'TIMELINE_FANOUT_LIMIT', 5000)
+
+
+def batch_size():
+    return getattr(settings, 'TIMELINE_BATCH_SIZE', 1000)
+
+
+def backfill_posts():
+    return getattr(settings, 'TIMELINE_BACKFILL_POSTS', 50)
+
+
+def is_popular(followers_count):
+    return followers_count >= fanout_limit()
+
+
+def popular_following(user):
+    """Ids of the authors `user` follows whose posts are read live."""
+    return list(
+        Follow.objects.filter(follower=user, following__profile__followers_count__gte=fanout_limit())
+        .values_list('following_id', flat=True)
+    )
+
+
+def timeline_page(user, per_page, cursor=None):
+    """
+    A keyset page of `user`'s timeline as posts, newest first. Raises
+    InvalidCursor for a bad cursor.
+    """
+    # an unpublished post's entries may outlive it until its retract job runs
+    entries = TimelineEntry.objects.filter(user=user, post__published=True).select_related('post__author')
+    sources = [(entries, ENTRY_ORDERING)]
+    popular = popular_following(user)
+    if popular:
+        live = Post.objects.filter(author_id__in=popular, published=True).select_related('author')
+        sources.append((live, POST_ORDERING))
+    page = MergedKeysetPaginator(sources, per_page).page(cursor)
+    page.object_list = [row.post if isinstance(row, TimelineEntry) else row for row in page.object_list]
+    return page
+
+
+def naive_timeline_page(user, per_page, cursor=None):
+    """The same page straight from Post joined to Follow, for comparison."""
+    following = Follow.objects.filter(follower=user).values('following_id')
+    qs = Post.objects.filter(author_id__in=following, published=True).select_related('author')
+    return KeysetPaginator(qs, per_page, POST_ORDERING).page(cursor)
+
+
+def write_entries(pairs):
+    """Insert an entry for each (user id, post) pair, in batches. Returns rows offered."""
+    rows = (
+        TimelineEntry(user_id=user_id, post_id=post.pk, author_id=post.author_id, created_at=post.created_at)
+        for user_id, post in pairs
+    )
+    written = 0
+    while batch := list(islice(rows, batch_size())):
+        # entries already there (a backfill racing a fan-out) are skipped
+        TimelineEntry.objects.bulk_create(batch, ignore_conflicts=True)
+        written += len(batch)
+    return written
+
+
+def follower_ids(author_id):
+    return Follow.objects.filter(following_id=author_id).values_list('follower_id', flat=True)
+
+
+def recent_posts(author_id):
+    return list(
+        Post.objects.filter(author_id=author_id, published=True)
+        .order_by(*POST_ORDERING).only('pk', 'author_id', 'created_at')[:backfill_posts()]
+    )
+
+
+def followers_count(author_id):
+    return Profile.objects.filter(user_id=author_id).values_list('followers_count', flat=True).first() or 0
+
+
+# Signal hooks (blog/signals.py)
+
+def post_published(post):
+    jobs.enqueue('timeline.fan_out', post=str(post.pk))
+
+
+def post_unpublished(post):
+    jobs.enqueue('timeline.retract', post=str(post.pk))
+
+
+def follow_added(follower_id, author_id):
+    if not is_popular(followers_count(author_id)):
+        write_entries((follower_id, post) for post in recent_posts(author_id))
+
+
+def follow_removed(follower_id, author_id):
+    TimelineEntry.objects.filter(user_id=follower_id, author_id=author_id).delete()
+    if followers_count(author_id) == fanout_limit() - 1:
+        # just dropped under the limit: their recent posts were never fanned out
+        jobs.enqueue('timeline.fan_out_author', author=author_id)
+
+
+# Tasks
+
+@jobs.task('timeline.fan_out')
+def fan_out(post):
+    post = Post.objects.filter(pk=post, published=True).only('pk', 'author_id', 'created_at').first()
+    if post is None or is_popular(followers_count(post.author_id)):
+        return
+    # follower ids are streamed, so memory stays at one batch
+    followers = follower_ids(post.author_id).iterator(chunk_size=batch_size())
+    write_entries((user_id, post) for user_id in followers)
+
+
+@jobs.task('timeline.fan_out_author')
+def fan_out_author(author):
+    if is_popular(followers_count(author)):
+        return
+    for post in recent_posts(author):
+        followers = follower_ids(author).iterator(chunk_size=batch_size())
+        write_entries((user_id, post) for user_id in followers)
+
+
+@jobs.task('timeline.retract')
+def retract(post):
+    # republished before the job ran: its entries are wanted again
+    if not Post.objects.filter(pk=post, published=True).exists():
+        TimelineEntry.objects.filter(post_id=post).delete()
@@ -0,0 +1,324 @@
+"""
+Streaming export and import of the blog's content as JSON Lines.
+
+``manage.py export_blog`` writes one JSON object per line: the categories,
+then the posts, comments and follows, each with a ``type`` key. Users are
+named by username, categories by slug and posts by id, so a file can be
+loaded into another site. Rows are read with ``iterator()`` and written as
+they come, so memory stays flat however large the tables are.
+
+``manage.py import_blog`` reads such a file line by line and inserts a
+batch of each type at a time with ``bulk_create``. Bulk inserts send no
+save signals, so none of the per-row handlers run: no image cleanup
+query, no counter bumps, no fan-out or related-post jobs per row. Instead
+authors and categories are looked up in dictionaries loaded once. A
+batch's slugs are checked against the database in one query. Clashes get
+the next free ``-2``, ``-3``... suffix, counted per slug in memory. At the
+end the import does once what the signals would have done row by row:
+
+* counters are recounted (``manage.py recount``);
+* search documents are written with each batch of posts;
+* the timelines of followers of every imported author are refilled
+  (``timeline.fan_out_author`` jobs);
+* followers of imported follows are marked for new suggestions;
+* the cached counts and the anonymous pages that show the new rows are
+  invalidated once the import commits, so a request made while it runs
+  cannot put the old ones back in the cache for good.
+
+Related posts and follow suggestions are batch jobs of their own; run
+``build_related_posts`` and ``build_follow_suggestions`` afterwards.
+
+Posts keep their ids. A post whose id is already in the database is
+skipped together with its comments, so an imported file can be imported
+again. Unknown usernames become users with unusable passwords.
+"""
+import io
+import json
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.text import slugify
+
+from . import jobs, page_cache, search, suggestions
+from .models import Category, Comment, Follow, Post
+from .stats import invalidate_category_counts, invalidate_dashboard_stats, invalidate_published_post_count
+
+BATCH_SIZE = 1000
+PROGRESS_EVERY = 100000
+# written in this order, so a file read front to back meets what rows refer to first
+TYPES = ('category', 'post', 'comment', 'follow')
+REQUIRED = {
+    'category': ('name', 'slug'),
+    'post': ('id', 'author', 'title'),
+    'comment': ('post', 'author', 'body'),
+    'follow': ('follower', 'following'),
+}
+PLURALS = {'category': 'categories', 'post': 'posts', 'comment': 'comments', 'follow': 'follows'}
+# flushed before a batch of the type, so the rows it refers to are in the database
+DEPENDS_ON = {'category': (), 'post': ('category',), 'comment': ('post',), 'follow': ()}
+
+
+def isoformat(value):
+    return value.isoformat() if value else None
+
+
+def export_records(chunk_size=2000):
+    """Yield every category, post, comment and follow as a dict, one query per type."""
+    for row in Category.objects.order_by('pk').values('name', 'slug').iterator(chunk_size=chunk_size):
+        yield {'type': 'category', **row}
+    posts = Post.objects.order_by().values_list(
+        'pk', 'author__username', 'title', 'slug', 'content', 'featured_image', 'category__slug', 'published',
+        'created_at', 'updated_at', 'views',
+    )
+    for pk, author, title, slug, content, image, category, published, created, updated, views in posts.iterator(
+        chunk_size=chunk_size,
+    ):
+        yield {
+            'type': 'post', 'id': str(pk), 'author': author, 'title': title, 'slug': slug, 'content': content,
+            'featured_image': image or None, 'category': category, 'published': published,
+            'created_at': isoformat(created), 'updated_at': isoformat(updated), 'views': views,
+        }
+    comments = Comment.objects.order_by().values_list('post_id', 'author__username', 'body', 'created_at', 'moderated')
+    for post, author, body, created, moderated in comments.iterator(chunk_size=chunk_size):
+        yield {
+            'type': 'comment', 'post': str(post), 'author': author, 'body': body,
+            'created_at': isoformat(created), 'moderated': moderated,
+        }
+    follows = Follow.objects.order_by().values_list('follower__username', 'following__username', 'created_at')
+    for follower, following, created in follows.iterator(chunk_size=chunk_size):
+        yield {'type': 'follow', 'follower': follower, 'following': following, 'created_at': isoformat(created)}
+
+
+def write_records(records, out):
+    """Write `records` to the text stream `out` as JSON Lines; returns a Counter of rows per kind."""
+    counts = Counter()
+    for record in records:
+        out.write(json.dumps(record, ensure_ascii=False) + '\n')
+        counts[PLURALS[record['type']]] += 1
+    return counts
+
+
+def read_records(lines):
+    """Parse JSON Lines into dicts; raises ValueError naming the line of a bad record."""
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as exc:
+            raise ValueError(f'Line {number}: {exc}') from None
+        kind = record.get('type') if isinstance(record, dict) else None
+        if kind not in REQUIRED:
+            raise ValueError(f'Line {number}: unknown record type {kind!r}.')
+        missing = [name for name in REQUIRED[kind] if record.get(name) in (None, '')]
+        if missing:
+            raise ValueError(f'Line {number}: {kind} without {", ".join(missing)}.')
+        yield record
+
+
+@contextmanager
+def stored_dates():
+    """Let bulk inserts keep the dates in the file instead of stamping auto_now(_add) fields with now."""
+    fields = [
+        model._meta.get_field(name)
+        for model, name in ((Post, 'created_at'), (Post, 'updated_at'), (Comment, 'created_at'), (Follow, 'created_at'))
+    ]
+    saved = [(field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, (auto_now, auto_now_add) in zip(fields, saved):
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+def numbered(slug, n, max_length):
+    suffix = f'-{n}'
+    return slug[:max_length - len(suffix)] + suffix
+
+
+class Importer:
+    """Buffers records by type and writes each full batch with one bulk insert."""
+
+    def __init__(self, batch_size=BATCH_SIZE, log=None):
+        self.batch_size = batch_size
+        self.log = log or (lambda message: None)
+        self.now = timezone.now()
+        self.slug_length = Post._meta.get_field('slug').max_length
+        self.users = dict(User.objects.values_list('username', 'pk').iterator(chunk_size=10000))  # username -> id
+        self.categories = dict(Category.objects.values_list('slug', 'pk'))  # slug -> id
+        self.pending = {kind: [] for kind in TYPES}
+        self.writers = {
+            'category': self.write_categories, 'post': self.write_posts,
+            'comment': self.write_comments, 'follow': self.write_follows,
+        }
+        self.suffixes = {}  # clashing slug -> next number to try
+        self.existing_posts = set()  # ids of posts already in the database; their comments are skipped
+        self.authors = set()  # users whose recent posts go into their followers' timelines
+        self.stale_stats = set()  # users whose cached dashboard stats are dropped on commit
+        self.stale_pages = {'post-list'}  # page cache tags invalidated on commit
+        self.counts = Counter()
+        self.read = 0
+        self.started = time.monotonic()
+
+    def add(self, record):
+        kind = record['type']
+        self.pending[kind].append(record)
+        self.read += 1
+        if len(self.pending[kind]) >= self.batch_size:
+            self.flush(kind)
+        if self.read % PROGRESS_EVERY == 0:
+            self.log(f'{self.read} records read ({self.read / (time.monotonic() - self.started):.0f}/s)')
+
+    def flush(self, kind):
+        for dependency in DEPENDS_ON[kind]:
+            self.flush(dependency)
+        batch, self.pending[kind] = self.pending[kind], []
+        if batch:
+            self.writers[kind](batch)
+
+    def date(self, record, name):
+        value = record.get(name)
+        return parse_datetime(value) if value else self.now
+
+    def user_ids(self, usernames):
+        """username -> id for `usernames`, creating the users not seen before."""
+        missing = set(usernames) - self.users.keys()
+        if missing:
+            User.objects.bulk_create([User(username=name, password=make_password(None)) for name in missing])
+            self.users.update(User.objects.filter(username__in=missing).values_list('username', 'pk'))
+            self.counts['users'] += len(missing)
+        return self.users
+
+    def free_slugs(self, records):
+        """A slug for each record that no post has: a clash gets the next free -2, -3... suffix."""
+        wanted = [
+            (record.get('slug') or slugify(record['title']) or 'post')[:self.slug_length] for record in records
+        ]
+        slugs = list(wanted)
+        clashing = range(len(slugs))
+        while clashing:
+            taken = set(Post.objects.filter(slug__in=[slugs[i] for i in clashing]).values_list('slug', flat=True))
+            seen, clashing = set(), []
+            for i, slug in enumerate(slugs):
+                if slug in taken or slug in seen:
+                    n = self.suffixes.get(wanted[i], 2)
+                    self.suffixes[wanted[i]] = n + 1
+                    slugs[i] = numbered(wanted[i], n, self.slug_length)
+                    clashing.append(i)
+                seen.add(slugs[i])
+        self.counts['renamed'] += sum(slug != want for slug, want in zip(slugs, wanted))
+        return slugs
+
+    def write_categories(self, records):
+        new = {record['slug']: record['name'] for record in records if record['slug'] not in self.categories}
+        # a name already used under another slug is left out
+        Category.objects.bulk_create(
+            [Category(name=name, slug=slug) for slug, name in new.items()], ignore_conflicts=True,
+        )
+        found = dict(Category.objects.filter(slug__in=new).values_list('slug', 'pk'))
+        self.categories.update(found)
+        self.counts['categories'] += len(found)
+
+    def write_posts(self, records):
+        by_id = {}
+        for record in records:
+            by_id.setdefault(uuid.UUID(record['id']), record)
+        existing = set(Post.objects.filter(pk__in=by_id).values_list('pk', flat=True))
+        self.existing_posts |= existing
+        fresh = [(post_id, record) for post_id, record in by_id.items() if post_id not in existing]
+        self.counts['skipped posts'] += len(records) - len(fresh)
+        users = self.user_ids(record['author'] for _, record in fresh)
+        slugs = self.free_slugs([record for _, record in fresh])
+        posts = [
+            Post(
+                id=post_id, author_id=users[record['author']], title=record['title'], slug=slug,
+                content=record.get('content') or '', featured_image=record.get('featured_image') or None,
+                category_id=self.categories.get(record.get('category')), published=bool(record.get('published')),
+                created_at=self.date(record, 'created_at'),
+                updated_at=self.date(record, 'updated_at' if record.get('updated_at') else 'created_at'),
+                views=record.get('views') or 0,
+            )
+            for (post_id, record), slug in zip(fresh, slugs)
+        ]
+        Post.objects.bulk_create(posts)
+        search.index_posts(posts)
+        author_ids = {post.author_id for post in posts}
+        self.authors |= {post.author_id for post in posts if post.published}
+        self.stale_stats |= author_ids
+        self.stale_pages.update(f'author:{author_id}' for author_id in author_ids)
+        self.counts['posts'] += len(posts)
+
+    def write_comments(self, records):
+        wanted = {uuid.UUID(record['post']) for record in records}
+        # comments on posts missing from the database, or there before the import, are skipped
+        posts = dict(Post.objects.filter(pk__in=wanted - self.existing_posts).values_list('pk', 'author_id'))
+        kept = [record for record in records if uuid.UUID(record['post']) in posts]
+        users = self.user_ids(record['author'] for record in kept)
+        Comment.objects.bulk_create([
+            Comment(
+                post_id=uuid.UUID(record['post']), author_id=users[record['author']], body=record['body'],
+                created_at=self.date(record, 'created_at'), moderated=bool(record.get('moderated')),
+            )
+            for record in kept
+        ])
+        self.stale_stats.update(posts.values())
+        self.stale_pages.update(f'post:{post_id}' for post_id in posts)
+        self.counts['comments'] += len(kept)
+        self.counts['skipped comments'] += len(records) - len(kept)
+
+    def write_follows(self, records):
+        users = self.user_ids(name for record in records for name in (record['follower'], record['following']))
+        pairs = {}
+        for record in records:
+            pair = (users[record['follower']], users[record['following']])
+            if pair[0] != pair[1]:
+                pairs.setdefault(pair, self.date(record, 'created_at'))
+        # pairs already following are ignored
+        Follow.objects.bulk_create(
+            [Follow(follower_id=a, following_id=b, created_at=created) for (a, b), created in pairs.items()],
+            ignore_conflicts=True,
+        )
+        followers = {a for a, _ in pairs}
+        followed = {b for _, b in pairs}
+        suggestions.mark_stale(*followers)
+        self.authors |= followed
+        self.stale_stats |= followed
+        self.stale_pages.update(f'author:{user_id}' for user_id in followers | followed)
+        self.counts['follows'] += len(pairs)
+        self.counts['skipped follows'] += len(records) - len(pairs)
+
+    def finish(self):
+        """Write what is still buffered and rebuild what the signals would have maintained."""
+        for kind in TYPES:
+            self.flush(kind)
+        call_command('recount', stdout=io.StringIO())
+        jobs.enqueue_many('timeline.fan_out_author', ({'author': author_id} for author_id in sorted(self.authors)))
+        # at once outside a transaction; otherwise when the import commits
+        transaction.on_commit(self.invalidate_caches)
+        self.counts['records'] = self.read
+        return self.counts
+
+    def invalidate_caches(self):
+        invalidate_published_post_count()
+        invalidate_category_counts()
+        invalidate_dashboard_stats(*self.stale_stats)
+        page_cache.invalidate(*self.stale_pages)
+
+
+def import_records(records, batch_size=BATCH_SIZE, log=None):
+    """Insert `records` (dicts as ``read_records`` yields them); returns a Counter of rows per kind."""
+    importer = Importer(batch_size=batch_size, log=log)
+    with stored_dates():
+        for record in records:
+            importer.add(record)
+        return importer.finish()
@@ -0,0 +1,220 @@
+"""
+Trending posts: a time-decayed popularity score per post.
+
+Every view and comment adds to its post's score, and the score halves every
+``TRENDING_HALF_LIFE`` seconds. Scores use forward decay: an event at time t
+adds ``weight * exp(λ t)`` and nothing is ever rescaled, since the decay of
+all scores at a common time keeps their order. They are kept as logarithms
+(``log Σ weight * exp(λ t)``), which cannot overflow; the current value is
+``exp(log_score - λ now)``.
+
+Events are recorded per process in O(1): views as ``view_counter`` drains
+them (blog/view_counter.py), comments when they commit. ``flush``, run by
+the view counter's periodic flush rather than on any request, merges them
+under a cache lock into a shared table of at most ``TRENDING_CAPACITY`` scores, trimmed
+to the highest, and stores the top ``TRENDING_SIZE`` published posts as a
+ready-made list. The sidebar and ``/ajax/trending/`` read that list: one
+cache get, O(K), no query. Editing, unpublishing or deleting a listed post
+drops the list (blog/signals.py), and the next read builds it again.
+
+The table is checkpointed to TrendingScore every
+``TRENDING_CHECKPOINT_INTERVAL`` seconds and reloaded from it when the cache
+has lost it (a restart or eviction).
+"""
+import heapq
+import math
+import threading
+import time
+from collections import defaultdict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from . import page_cache
+from .models import Post, TrendingScore
+
+TABLE_KEY = 'trending:table'
+TOP_KEY = 'trending:top'
+LOCK_KEY = 'trending:lock'
+CHECKPOINT_KEY = 'trending:checkpoint'
+LOCK_TIMEOUT = 60
+
+
+def half_life():
+    return getattr(settings, 'TRENDING_HALF_LIFE', 6 * 3600)
+
+
+def decay_rate():
+    return math.log(2) / half_life()
+
+
+def add_logs(a, b):
+    """log(exp(a) + exp(b)) without overflow."""
+    if a < b:
+        a, b = b, a
+    if b == -math.inf:
+        return a
+    return a + math.log1p(math.exp(b - a))
+
+
+def current_score(log_score, now):
+    return math.exp(log_score - decay_rate() * now)
+
+
+class Leaderboard:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = defaultdict(lambda: -math.inf)  # post id -> log of forward-decayed weight
+
+    @property
+    def cache(self):
+        return caches[getattr(settings, 'TRENDING_CACHE', 'default')]
+
+    @property
+    def size(self):
+        return getattr(settings, 'TRENDING_SIZE', 20)
+
+    @property
+    def sidebar_size(self):
+        return getattr(settings, 'TRENDING_SIDEBAR_SIZE', 5)
+
+    def record(self, post_id, weight=1.0, now=None):
+        """Add an event of `weight` to the post's score; buffered until the next flush."""
+        if weight <= 0:
+            return
+        value = math.log(weight) + decay_rate() * (time.time() if now is None else now)
+        with self._lock:
+            self._pending[post_id] = add_logs(self._pending[post_id], value)
+
+    def record_many(self, weights, now=None):
+        """record() for each post id -> weight."""
+        now = time.time() if now is None else now
+        rate = decay_rate()
+        with self._lock:
+            for post_id, weight in weights.items():
+                if weight > 0:
+                    self._pending[post_id] = add_logs(self._pending[post_id], math.log(weight) + rate * now)
+
+    def flush(self, now=None):
+        """
+        Merge this process's events into the shared table. Returns the number
+        of posts updated, or None if another process holds the lock (the
+        events stay buffered for the next flush).
+        """
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(lambda: -math.inf)
+        if not pending:
+            return 0
+        cache = self.cache
+        if not cache.add(LOCK_KEY, 1, timeout=LOCK_TIMEOUT):
+            self._restore(pending)
+            return None
+        try:
+            now = time.time() if now is None else now
+            table = self.load_table()
+            for post_id, value in pending.items():
+                table[post_id] = add_logs(table.get(post_id, -math.inf), value)
+            capacity = getattr(settings, 'TRENDING_CAPACITY', 1000)
+            if len(table) > capacity:
+                table = dict(heapq.nlargest(capacity, table.items(), key=lambda item: item[1]))
+            cache.set(TABLE_KEY, table, timeout=None)
+            top = self.build_top(table)
+            previous = cache.get(TOP_KEY) or []
+            cache.set(TOP_KEY, top, timeout=None)
+            if self.ids(top[:self.sidebar_size]) != self.ids(previous[:self.sidebar_size]):
+                page_cache.invalidate('trending')
+            if now - (cache.get(CHECKPOINT_KEY) or 0) >= getattr(settings, 'TRENDING_CHECKPOINT_INTERVAL', 300):
+                self.checkpoint(table)
+                cache.set(CHECKPOINT_KEY, now, timeout=None)
+            return len(pending)
+        except Exception:
+            self._restore(pending)
+            raise
+        finally:
+            cache.delete(LOCK_KEY)
+
+    def _restore(self, pending):
+        with self._lock:
+            for post_id, value in pending.items():
+                self._pending[post_id] = add_logs(self._pending[post_id], value)
+
+    def load_table(self):
+        table = self.cache.get(TABLE_KEY)
+        if table is None:
+            # lost from the cache: start from the last checkpoint
+            table = dict(TrendingScore.objects.values_list('post_id', 'score'))
+        return table
+
+    def build_top(self, table):
+        """The top published posts of `table`, with what the sidebar shows of them."""
+        # a few spare candidates in case some are drafts or gone
+        candidates = heapq.nlargest(self.size * 2, table.items(), key=lambda item: item[1])
+        if not candidates:
+            return []
+        posts = Post.objects.filter(pk__in=[post_id for post_id, _ in candidates], published=True).only('title', 'slug')
+        posts = {post.pk: post for post in posts}
+        return [
+            {'id': str(post_id), 'title': posts[post_id].title, 'url': posts[post_id].get_absolute_url(),
+             'log_score': log_score}
+            for post_id, log_score in candidates if post_id in posts
+        ][:self.size]
+
+    @staticmethod
+    def ids(entries):
+        return [entry['id'] for entry in entries]
+
+    def checkpoint(self, table):
+        """Write the table to TrendingScore, replacing the previous checkpoint."""
+        existing = set(Post.objects.filter(pk__in=list(table)).values_list('pk', flat=True))
+        with transaction.atomic():
+            TrendingScore.objects.exclude(post_id__in=existing).delete()
+            TrendingScore.objects.bulk_create(
+                [TrendingScore(post_id=post_id, score=table[post_id]) for post_id in existing],
+                update_conflicts=True, unique_fields=['post'], update_fields=['score', 'updated_at'],
+                batch_size=500,
+            )
+
+    def with_scores(self, entries, limit, now):
+        now = time.time() if now is None else now
+        return [
+            {'id': entry['id'], 'title': entry['title'], 'url': entry['url'],
+             'score': round(current_score(entry['log_score'], now), 2)}
+            for entry in entries[:limit]
+        ]
+
+    def top(self, limit=None, now=None):
+        """The trending posts, highest first, with their current scores."""
+        entries = self.cache.get(TOP_KEY)
+        if entries is None:
+            # rebuilt from the last checkpoint; a flush under way wins
+            entries = self.build_top(self.load_table())
+            self.cache.add(TOP_KEY, entries, timeout=None)
+        return self.with_scores(entries, limit or self.size, now)
+
+    async def atop(self, limit=None, now=None):
+        entries = await self.cache.aget(TOP_KEY)
+        if entries is None:
+            return await sync_to_async(self.top)(limit, now)
+        return self.with_scores(entries, limit or self.size, now)
+
+    def sidebar(self):
+        return self.top(self.sidebar_size)
+
+    async def asidebar(self):
+        return await self.atop(self.sidebar_size)
+
+    def post_changed(self, post_id):
+        """Drop the ready-made list if it shows this post, so its title and url are read again."""
+        entries = self.cache.get(TOP_KEY)
+        if entries and str(post_id) in self.ids(entries):
+            self.cache.delete(TOP_KEY)
+            page_cache.invalidate('trending')
+
+    def comment_added(self, post_id):
+        """Count a committed comment; the next periodic flush publishes it."""
+        self.record(post_id, getattr(settings, 'TRENDING_COMMENT_WEIGHT', 5))
+
+
+leaderboard = Leaderboard()
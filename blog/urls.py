@@ -1,25 +1,36 @@
+from django.conf import settings
 from django.urls import path
-from . import views
+from . import async_views, views
 
 
 app_name = 'blog'
 
-urlpatterns = [
-    path('', views.HomeView.as_view(), name='home'),
-    path('search/', views.SearchResultsView.as_view(), name='search'),
-    path('post/create/', views.PostCreateView.as_view(), name='post_create'),
-    path('post/<slug:slug>/', views.PostDetailView.as_view(), name='post_detail'),
-    path('post/<slug:slug>/edit/', views.PostUpdateView.as_view(), name='post_edit'),
-    path('post/<slug:slug>/delete/', views.PostDeleteView.as_view(), name='post_delete'),
-    path('author/<str:username>/', views.AuthorProfileView.as_view(), name='author_profile'),
-    path('profile/edit/', views.ProfileUpdateView.as_view(), name='profile_edit'),
-    path('dashboard/', views.DashboardView.as_view(), name='dashboard'),
-    
 
-    # AJAX endpoints
-    path('ajax/toggle-follow/', views.toggle_follow, name='toggle_follow'),
-    path('ajax/post-view/', views.increment_post_view, name='increment_post_view'),
-    path('ajax/add-comment/<slug:slug>/', views.ajax_add_comment, name='ajax_add_comment'),
+def build_urlpatterns(reads):
+    """The app's routes, with the read-heavy pages and AJAX endpoints taken from `reads`."""
+    return [
+        path('', reads.HomeView.as_view(), name='home'),
+        path('search/', reads.SearchResultsView.as_view(), name='search'),
+        path('post/create/', views.PostCreateView.as_view(), name='post_create'),
+        path('post/<slug:slug>/', reads.PostDetailView.as_view(), name='post_detail'),
+        path('post/<slug:slug>/edit/', views.PostUpdateView.as_view(), name='post_edit'),
+        path('post/<slug:slug>/delete/', views.PostDeleteView.as_view(), name='post_delete'),
+        path('author/<str:username>/', reads.AuthorProfileView.as_view(), name='author_profile'),
+        path('profile/edit/', views.ProfileUpdateView.as_view(), name='profile_edit'),
+        path('dashboard/', views.DashboardView.as_view(), name='dashboard'),
+        path('feed/', views.FeedView.as_view(), name='feed'),
 
-   
-]
+        # AJAX endpoints
+        path('ajax/posts/', reads.ajax_posts, name='ajax_posts'),
+        path('ajax/toggle-follow/', reads.toggle_follow, name='toggle_follow'),
+        path('ajax/post-view/', reads.increment_post_view, name='increment_post_view'),
+        path('ajax/add-comment/<slug:slug>/', reads.ajax_add_comment, name='ajax_add_comment'),
+        path('ajax/comments/<slug:slug>/', reads.ajax_comments, name='ajax_comments'),
+        path('ajax/trending/', reads.trending_posts, name='trending'),
+        path('stream/post/<slug:slug>/', views.post_stream, name='post_stream'),
+        path('metrics', views.metrics_view, name='metrics'),
+    ]
+
+
+# the ASGI entry point serves the async versions (blog/async_views.py)
+urlpatterns = build_urlpatterns(async_views if settings.ASYNC_VIEWS else views)
@@ -0,0 +1,270 @@
+"""
+Write-behind buffer for post view counting.
+
+increment_post_view records hits in a process-local buffer and answers with an
+approximate count; nothing is written to the database on the request path.
+A background thread periodically moves the local buffer into a shared batch
+log kept in the Django cache, and whichever process holds the flush lock
+drains that log into the database as one bulk insert of PostView rows plus
+one grouped ``UPDATE ... views = views + n`` per distinct increment.
+
+Configure ``VIEW_COUNTER_CACHE`` to point at a cache shared by every worker
+(Redis, Memcached, database cache) so that ``manage.py flush_post_views``
+drains batches published by all of them.
+
+Slugs are resolved to post ids once per process. A post renamed or deleted
+here drops its slugs at once (blog/signals.py); one changed by another
+worker is noticed at the next flush, when the stored counts are re-read.
+
+Repeat views by the same visitor within ``VIEW_DEDUPE_WINDOW`` are dropped
+before they reach the buffer (blog/view_dedupe.py).
+
+Totals written by a drain are pushed to readers of the posts (blog/live.py),
+and the views count towards the posts' trending scores (blog/trending.py);
+each flush also publishes the trending events this process recorded.
+"""
+import atexit
+import logging
+import threading
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections, transaction
+from django.db.models import F
+from django.dispatch import receiver
+from django.test.signals import setting_changed
+
+from . import live
+from .models import Post, PostView
+from .trending import leaderboard
+from .view_dedupe import SeenSet
+
+logger = logging.getLogger(__name__)
+
+SEQ_KEY = 'viewcounter:seq'
+HEAD_KEY = 'viewcounter:head'
+LOCK_KEY = 'viewcounter:lock'
+BATCH_TIMEOUT = 60 * 60 * 24
+LOCK_TIMEOUT = 60
+# a batch slot that is still missing after this many drains is assumed evicted
+MAX_HOLE_RETRIES = 3
+
+
+def batch_key(n):
+    return f'viewcounter:batch:{n}'
+
+
+class ViewCounterBuffer:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._known = {}  # slug -> post id
+        self._base = {}  # post id -> views in the database when last read
+        self._pending = Counter()  # post id -> views not yet published
+        self._rows = []  # (post id, user id, ip) not yet published
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._seen = None
+
+    @property
+    def cache(self):
+        return caches[getattr(settings, 'VIEW_COUNTER_CACHE', 'default')]
+
+    @property
+    def flush_interval(self):
+        return getattr(settings, 'VIEW_COUNTER_FLUSH_INTERVAL', 10)
+
+    @property
+    def max_pending(self):
+        return getattr(settings, 'VIEW_COUNTER_MAX_PENDING', 1000)
+
+    @property
+    def seen(self):
+        # built on first use so settings overrides apply; None when disabled
+        if self._seen is None:
+            self._seen = SeenSet.from_settings() or False
+        return self._seen or None
+
+    def is_repeat(self, post_id, user_id, ip):
+        visitor = f'user:{user_id}' if user_id else (f'ip:{ip}' if ip else None)
+        if visitor is None or self.seen is None:
+            return False
+        return self.seen.seen(f'{post_id}:{visitor}')
+
+    def record(self, slug, user_id=None, ip=None):
+        """
+        Buffer one view of the post with this slug and return its approximate
+        view count, or None if no such post exists. Repeat views by the same
+        visitor within the dedupe window are not counted.
+        """
+        post_id = self._known.get(slug)
+        if post_id is None:
+            row = Post.objects.filter(slug=slug).values_list('pk', 'views').first()
+            if row is None:
+                return None
+            post_id, views = row
+            with self._lock:
+                self._known[slug] = post_id
+                self._base.setdefault(post_id, views)
+        if self.is_repeat(post_id, user_id, ip):
+            with self._lock:
+                return self._base.get(post_id, 0) + self._pending[post_id]
+        with self._lock:
+            self._pending[post_id] += 1
+            self._rows.append((post_id, user_id, ip))
+            views = self._base.get(post_id, 0) + self._pending[post_id]
+            full = len(self._rows) >= self.max_pending
+        self.ensure_started()
+        if full:
+            self._wakeup.set()
+        return views
+
+    def forget(self, *slugs):
+        """Look these slugs up again on their next view."""
+        with self._lock:
+            for slug in slugs:
+                self._known.pop(slug, None)
+
+    def publish(self):
+        """
+        Move everything buffered in this process into the shared batch log.
+        Returns the number of views published.
+        """
+        cache = self.cache
+        if self.seen is not None:
+            self.seen.sync(cache)
+        with self._lock:
+            pending, self._pending = self._pending, Counter()
+            rows, self._rows = self._rows, []
+        if not pending:
+            return 0
+        cache.add(SEQ_KEY, 0, timeout=None)
+        n = cache.incr(SEQ_KEY)
+        cache.set(batch_key(n), {'counts': dict(pending), 'rows': rows}, timeout=BATCH_TIMEOUT)
+        return sum(pending.values())
+
+    def drain(self):
+        """
+        Write every batch in the shared log to the database. Returns the number
+        of views written, or None if another process is already draining.
+        """
+        cache = self.cache
+        if not cache.add(LOCK_KEY, 1, timeout=LOCK_TIMEOUT):
+            return None
+        try:
+            head = cache.get(HEAD_KEY) or {'seq': 0, 'holes': {}}
+            seq = cache.get(SEQ_KEY) or 0
+            wanted = [*head['holes'], *range(head['seq'] + 1, seq + 1)]
+            found = cache.get_many([batch_key(n) for n in wanted])
+            counts, rows, holes = Counter(), [], {}
+            for n in wanted:
+                batch = found.get(batch_key(n))
+                if batch is None:
+                    # allocated but not written yet, or evicted from the cache
+                    retries = head['holes'].get(n, 0) + 1
+                    if retries < MAX_HOLE_RETRIES:
+                        holes[n] = retries
+                    else:
+                        logger.warning('View counter batch %s was lost', n)
+                    continue
+                counts.update(batch['counts'])
+                rows.extend(batch['rows'])
+            written = self._write(counts, rows) if counts else 0
+            cache.delete_many(list(found))
+            cache.set(HEAD_KEY, {'seq': max(seq, head['seq']), 'holes': holes}, timeout=None)
+            # push the new totals to open pages; also releases ones held back earlier
+            fresh = dict(Post.objects.filter(pk__in=counts).values_list('pk', 'views')) if counts else {}
+            live.hub.publish_views(fresh)
+            if fresh:
+                leaderboard.record_many({post_id: counts[post_id] for post_id in fresh})
+            return written
+        finally:
+            cache.delete(LOCK_KEY)
+
+    def flush(self):
+        """
+        Publish this process's buffer and drain the shared log, then merge the
+        trending events recorded here (drained views, committed comments).
+        """
+        with self._flush_lock:
+            self.publish()
+            written = self.drain()
+            self._refresh()
+            leaderboard.flush()
+            return written
+
+    def _write(self, counts, rows):
+        with transaction.atomic():
+            existing = set(Post.objects.filter(pk__in=counts).values_list('pk', flat=True))
+            PostView.objects.bulk_create(
+                [PostView(post_id=post_id, user_id=user_id, ip_address=ip)
+                 for post_id, user_id, ip in rows if post_id in existing],
+                batch_size=500,
+            )
+            by_amount = defaultdict(list)
+            for post_id, n in counts.items():
+                if post_id in existing:
+                    by_amount[n].append(post_id)
+            for n, post_ids in by_amount.items():
+                Post.objects.filter(pk__in=post_ids).update(views=F('views') + n)
+        return sum(counts[post_id] for post_id in existing)
+
+    def _refresh(self):
+        """Re-read the stored counts and slugs of posts this process has seen."""
+        with self._lock:
+            post_ids = list(self._base)
+        fresh = {
+            pk: (views, slug)
+            for pk, views, slug in Post.objects.filter(pk__in=post_ids).values_list('pk', 'views', 'slug')
+        } if post_ids else {}
+        gone = set(post_ids) - set(fresh)
+        with self._lock:
+            for post_id, (views, _) in fresh.items():
+                self._base[post_id] = views
+            for post_id in gone:
+                self._base.pop(post_id, None)
+            # drop slugs another process has deleted, renamed or given to another post
+            self._known = {
+                slug: post_id for slug, post_id in self._known.items()
+                if post_id not in gone and fresh.get(post_id, (None, slug))[1] == slug
+            }
+
+    def ensure_started(self):
+        """Start the periodic flush in this process, unless it runs already or is disabled."""
+        if self._thread is not None or not self.flush_interval:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='view-counter-flush', daemon=True)
+            self._thread.start()
+        atexit.register(self.shutdown)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Flushing buffered post views failed')
+            finally:
+                connections.close_all()
+
+    def shutdown(self):
+        """Flush whatever is still buffered; registered with atexit."""
+        try:
+            self.flush()
+        except Exception:
+            logger.exception('Flushing buffered post views on shutdown failed')
+
+
+view_counter = ViewCounterBuffer()
+
+
+@receiver(setting_changed)
+def reset_seen_set(setting, **kwargs):
+    # the seen set is sized from settings when first used
+    if setting.startswith('VIEW_DEDUPE_'):
+        view_counter._seen = None
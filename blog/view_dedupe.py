@@ -0,0 +1,147 @@
+"""
+Deduplication of post views.
+
+A view is a repeat when the same visitor (the user, or the IP address for
+anonymous readers) already viewed the same post within the last
+``VIEW_DEDUPE_WINDOW`` seconds; repeats are neither buffered nor counted
+(blog/view_counter.py).
+
+Seen (post, visitor) pairs live in a time-bucketed Bloom filter: the window
+is cut into ``VIEW_DEDUPE_BUCKETS`` slices, each a fixed-size filter, a pair
+is looked up in every live slice and added to the current one, and a slice
+is dropped whole once it falls out of the window. Memory is therefore fixed
+by the settings, whatever the traffic. A slice that has taken its capacity
+stops accepting pairs, so under a flood the filter lets views through
+(over-counting) rather than letting its false-positive rate climb.
+
+Slices are mirrored in ``VIEW_COUNTER_CACHE`` each time the view counter
+publishes: every process ORs its slices into the shared copy and adopts the
+result, so a reload served by another worker is still recognised. Writes
+race, but each sync rewrites everything the process has seen, so bits lost
+to a concurrent write come back on the next one.
+"""
+import hashlib
+import math
+import threading
+import time
+
+from django.conf import settings
+
+
+def slice_key(index):
+    return f'viewdedupe:slice:{index}'
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    @property
+    def full(self):
+        return self.count >= self.capacity
+
+    @property
+    def nbytes(self):
+        return len(self.bits)
+
+    def positions(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        size = self.size
+        h1 = int.from_bytes(digest[:8], 'big') % size
+        h2 = (int.from_bytes(digest[8:], 'big') | 1) % size
+        return [(h1 + i * h2) % size for i in range(self.hashes)]
+
+    def contains(self, positions):
+        bits = self.bits
+        for p in positions:
+            if not bits[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+    def add(self, positions):
+        bits = self.bits
+        for p in positions:
+            bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def merge(self, data):
+        """OR another copy of this filter's bits into it."""
+        if len(data) != len(self.bits):
+            return
+        merged = int.from_bytes(self.bits, 'big') | int.from_bytes(data, 'big')
+        self.bits = bytearray(merged.to_bytes(len(self.bits), 'big'))
+        # estimate how many pairs the union holds from how many bits are set
+        ones = merged.bit_count()
+        if ones < self.size:
+            estimate = -self.size / self.hashes * math.log(1 - ones / self.size)
+        else:
+            estimate = self.capacity
+        self.count = max(self.count, round(estimate))
+
+
+class SeenSet:
+    def __init__(self, window, buckets=6, capacity=20000, error_rate=0.001, clock=time.time):
+        self.window = window
+        self.buckets = buckets
+        self.width = window / buckets
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.clock = clock
+        self._slices = {}  # slice index -> BloomFilter
+        self._index = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls):
+        window = getattr(settings, 'VIEW_DEDUPE_WINDOW', 1800)
+        if not window:
+            return None
+        return cls(
+            window,
+            buckets=getattr(settings, 'VIEW_DEDUPE_BUCKETS', 6),
+            capacity=getattr(settings, 'VIEW_DEDUPE_CAPACITY', 20000),
+            error_rate=getattr(settings, 'VIEW_DEDUPE_ERROR_RATE', 0.001),
+        )
+
+    @property
+    def nbytes(self):
+        return sum(f.nbytes for f in self._slices.values())
+
+    def _current(self):
+        """Index of the current slice; drops slices that left the window."""
+        index = int(self.clock() // self.width)
+        if index != self._index:
+            self._index = index
+            # a pair is remembered for at least the window and at most one slice longer
+            for old in [i for i in self._slices if i < index - self.buckets]:
+                del self._slices[old]
+            self._slices.setdefault(index, BloomFilter(self.capacity, self.error_rate))
+        return self._slices[index]
+
+    def seen(self, key):
+        """True if key was seen within the window; otherwise remember it."""
+        with self._lock:
+            current = self._current()
+            positions = current.positions(key)
+            for f in self._slices.values():
+                if f.contains(positions):
+                    return True
+            if not current.full:
+                current.add(positions)
+            return False
+
+    def sync(self, cache):
+        """Merge the live slices with the shared copies in the cache."""
+        with self._lock:
+            self._current()
+            slices = {slice_key(i): f for i, f in self._slices.items()}
+        shared = cache.get_many(list(slices))
+        with self._lock:
+            for key, data in shared.items():
+                slices[key].merge(data)
+            updates = {key: bytes(f.bits) for key, f in slices.items()}
+        cache.set_many(updates, timeout=math.ceil(self.window + 2 * self.width))
@@ -2,49 +2,98 @@ from django.shortcuts import render, get_object_or_404, redirect
 from django.views.generic import TemplateView, ListView, DetailView, CreateView, UpdateView, DeleteView
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 from django.urls import reverse_lazy
-from django.http import JsonResponse, HttpResponseForbidden
-from .models import Post, Category, Comment, Follow, Profile, PostView
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, JsonResponse, HttpResponseForbidden, Http404, StreamingHttpResponse
+from .models import Post, Comment, Follow, Profile
 from .forms import PostForm, CommentForm, ProfileForm, CustomUserCreationForm, CustomLoginForm
+from .view_counter import view_counter
+from . import search
+from . import analytics
+from . import live
+from . import metrics
+from . import timeline
+from .related import related_posts
+from .suggestions import suggestions_for
+from .pagination import InvalidCursor, KeysetPaginator
+from .stats import category_counts, dashboard_stats, find_category, published_post_count
+from .trending import leaderboard
+from .rendering import prefetch_rendered
+from .routers import replica_reads
+from . import page_cache
+from .page_cache import cache_anonymous_page
+from . import conditional
+from .conditional import conditional_page
 from django.contrib.auth.models import User
-from django.db.models import Count, F, Q
 from django.utils import timezone
 from django.contrib.auth.decorators import login_required
+from django.utils.crypto import constant_time_compare
 from django.utils.html import strip_tags
+from django.utils.decorators import method_decorator
 
+@method_decorator(replica_reads, name='dispatch')
+@method_decorator(cache_anonymous_page, name='dispatch')
+@method_decorator(conditional_page(conditional.list_etag), name='dispatch')
 class HomeView(ListView):
     model = Post
     template_name = 'blog/home.html'
     context_object_name = 'posts'
     paginate_by = 10
+    sidebar = True  # the template lists the categories
 
     def get_queryset(self):
         qs = Post.objects.filter(published=True).select_related('author', 'category')
+        self.category = selected_category(self.request)
+        if self.category:
+            qs = qs.filter(category_id=self.category['id'])
         q = self.request.GET.get('q')
         if q:
-            qs = qs.filter(Q(title__icontains=q) | Q(content__icontains=q))
+            qs = search.search_posts(qs, q)
         return qs
 
+    def paginate_queryset(self, queryset, page_size):
+        # search results are ordered by rank, so they keep numbered pages
+        if self.request.GET.get('q'):
+            return super().paginate_queryset(queryset, page_size)
+        page = keyset_page(queryset, page_size, self.request.GET.get('cursor'))
+        return None, page, page.object_list, page.has_other_pages
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['q'] = self.request.GET.get('q', '')
-        context['categories'] = Category.objects.all()
-        context['total_posts'] = Post.objects.filter(published=True).count()
+        prefetch_rendered(context['object_list'])
+        page_cache.tag(self.request, 'post-list')
+        context['category'] = self.category
+        context['categories'] = category_counts() if self.sidebar else []
+        context['trending'] = leaderboard.sidebar() if self.sidebar else []
+        if self.sidebar:
+            page_cache.tag(self.request, 'trending')
+        context['total_posts'] = published_post_count()
         return context
 
 
 class SearchResultsView(HomeView):
     template_name = 'blog/search_results.html'
+    sidebar = False
 
+@method_decorator(replica_reads, name='dispatch')
+@method_decorator(cache_anonymous_page, name='dispatch')
+@method_decorator(conditional_page(conditional.post_etag, conditional.post_last_modified), name='dispatch')
 class PostDetailView(DetailView):
-    model = Post
+    queryset = Post.objects.select_related('author')
     template_name = 'blog/post_detail.html'
     context_object_name = 'post'
+    comments_per_page = 20
 
     def get_context_data(self, **kwargs):
         ctx = super().get_context_data(**kwargs)
         ctx['comment_form'] = CommentForm()
         ctx['is_following'] = False
         ctx['stripped_content'] = strip_tags(self.object.content)
+        # the first page; the rest is loaded from ajax_comments
+        ctx['comments'] = comments_page(self.object, self.comments_per_page, None)
+        ctx['related_posts'] = related_posts(self.object)
+        page_cache.tag(self.request, f'post:{self.object.pk}')
         user = self.request.user
         if user.is_authenticated:
             ctx['is_following'] = Follow.objects.filter(follower=user, following=self.object.author).exists()
@@ -93,22 +142,41 @@ class PostDeleteView(LoginRequiredMixin, UserPassesTestMixin, DeleteView):
     def test_func(self):
         return self.get_object().author == self.request.user
 
+@method_decorator(cache_anonymous_page, name='dispatch')
+@method_decorator(conditional_page(conditional.author_etag), name='dispatch')
 class AuthorProfileView(TemplateView):
     template_name = 'blog/author_profile.html'
+    paginate_by = 20
 
     def get(self, request, username, *args, **kwargs):
-        user = get_object_or_404(User, username=username)
-        posts = Post.objects.filter(author=user, published=True)
-        followers = Follow.objects.filter(following=user).count()
-        following = Follow.objects.filter(follower=user).count()
+        user = get_object_or_404(User.objects.select_related('profile'), username=username)
+        posts = keyset_page(Post.objects.filter(author=user, published=True), self.paginate_by, request.GET.get('cursor'))
+        followers = user.profile.followers_count
+        following = user.profile.following_count
         is_following = False
+        suggestions = []
         if request.user.is_authenticated:
             is_following = Follow.objects.filter(follower=request.user, following=user).exists()
+            suggestions = suggestions_for(request.user, exclude=user)
+        page_cache.tag(request, f'author:{user.pk}')
         return render(request, self.template_name, {
-            'author': user, 'posts': posts, 'followers': followers, 'following': following,
-            'is_following': is_following
+            'author': user, 'posts': posts, 'page_obj': posts, 'followers': followers, 'following': following,
+            'is_following': is_following, 'suggestions': suggestions,
         })
     
+class FeedView(LoginRequiredMixin, TemplateView):
+    """Posts by the authors the user follows (blog/timeline.py)."""
+    template_name = 'blog/feed.html'
+    paginate_by = 10
+
+    def get(self, request, *args, **kwargs):
+        try:
+            posts = timeline.timeline_page(request.user, self.paginate_by, request.GET.get('cursor'))
+        except InvalidCursor:
+            raise Http404('Invalid cursor.')
+        prefetch_rendered(posts)
+        return render(request, self.template_name, {'posts': posts, 'page_obj': posts})
+
 class ProfileUpdateView(LoginRequiredMixin, UpdateView):
     model = Profile
     form_class = ProfileForm
@@ -125,22 +193,94 @@ class ProfileUpdateView(LoginRequiredMixin, UpdateView):
 class DashboardView(LoginRequiredMixin, TemplateView):
     template_name = 'blog/dashboard.html'
 
+    paginate_by = 20
+
     def get(self, request, *args, **kwargs):
         user = request.user
-        posts = Post.objects.filter(author=user)
-        total_posts = posts.count()
-        total_views = posts.aggregate(total=Count('views'))['total'] or 0
-        total_comments = posts.aggregate(total=Count('comments'))['total'] or 0
-        total_followers = Follow.objects.filter(following=user).count()
+        page = keyset_page(Post.objects.filter(author=user), self.paginate_by, request.GET.get('cursor'))
+        chart_post = None
+        if request.GET.get('post'):
+            chart_post = get_object_or_404(Post.objects.only('pk', 'title', 'slug'), author=user, slug=request.GET['post'])
+        # drawn from the hourly/daily rollups, never the raw PostView rows
+        chart = analytics.view_chart(user, chart_post)
         return render(request, self.template_name, {
-            'posts': posts, 'total_posts': total_posts, 'total_views': total_views,
-            'total_followers': total_followers,'total_comments':total_comments
+            'posts': page, 'page_obj': page, **dashboard_stats(user),
+            'chart': chart, 'chart_post': chart_post, 'chart_totals': analytics.chart_totals(chart),
+            'suggestions': suggestions_for(user),
         })
 
+def selected_category(request):
+    """The category picked with ?category=<slug>, from the cached category list."""
+    slug = request.GET.get('category')
+    if not slug:
+        return None
+    category = find_category(category_counts(), slug)
+    if category is None:
+        raise Http404('No such category.')
+    return category
+
+def keyset_page(queryset, per_page, cursor):
+    try:
+        return KeysetPaginator(queryset, per_page).page(cursor)
+    except InvalidCursor:
+        raise Http404('Invalid cursor.')
+
+COMMENT_ORDERING = ('created_at', 'pk')
+
+
+def comments_page(post, per_page, cursor):
+    """A keyset page of the post's comments, oldest first, without moderated ones."""
+    qs = post.comments.filter(moderated=False).select_related('author')
+    try:
+        return KeysetPaginator(qs, per_page, COMMENT_ORDERING).page(cursor)
+    except InvalidCursor:
+        raise Http404('Invalid cursor.')
+
+
+def comment_cursor(comment):
+    """Cursor continuing after `comment`."""
+    return KeysetPaginator(Comment.objects.none(), 1, COMMENT_ORDERING).encode_cursor(comment, 'next')
+
+
 # AJAX endpoints
 from django.views.decorators.http import require_POST
 from django.views.decorators.csrf import csrf_exempt
 
+def ajax_posts(request):
+    """JSON variant of the feed and author post lists, paged by cursor."""
+    qs = Post.objects.filter(published=True).select_related('author')
+    username = request.GET.get('author')
+    if username:
+        qs = qs.filter(author__username=username)
+    page = keyset_page(qs, HomeView.paginate_by, request.GET.get('cursor'))
+    prefetch_rendered(page)
+    return JsonResponse({
+        'posts': [{
+            'title': post.title,
+            'url': post.get_absolute_url(),
+            'author': post.author.username,
+            'created_at': post.created_at.isoformat(),
+            'excerpt': post.rendered['excerpt'],
+        } for post in page],
+        'next_cursor': page.next_cursor,
+        'previous_cursor': page.previous_cursor,
+    })
+
+def trending_limit(request):
+    """The ?limit of a trending request, at most TRENDING_SIZE; None if invalid."""
+    try:
+        limit = int(request.GET.get('limit', leaderboard.size))
+    except ValueError:
+        return None
+    return min(limit, leaderboard.size) if limit > 0 else None
+
+def trending_posts(request):
+    """The trending posts with their current scores, highest first."""
+    limit = trending_limit(request)
+    if limit is None:
+        return JsonResponse({'error': 'invalid limit'}, status=400)
+    return JsonResponse({'posts': leaderboard.top(limit)})
+
 @require_POST
 def toggle_follow(request):
     if not request.user.is_authenticated:
@@ -154,22 +294,62 @@ def toggle_follow(request):
     obj, created = Follow.objects.get_or_create(follower=request.user, following=target)
     if not created:
         obj.delete()
-        return JsonResponse({'status':'unfollowed', 'followers_count': Follow.objects.filter(following=target).count()})
-    return JsonResponse({'status':'followed', 'followers_count': Follow.objects.filter(following=target).count()})
+    # counters are kept up to date by signals, so read the stored value
+    followers_count = Profile.objects.filter(user=target).values_list('followers_count', flat=True).first() or 0
+    return JsonResponse({'status': 'followed' if created else 'unfollowed', 'followers_count': followers_count})
+
+def metrics_view(request):
+    """Request metrics in the Prometheus text format (blog/metrics.py)."""
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    bearer = request.headers.get('Authorization', '')
+    if not (request.user.is_staff or (token and constant_time_compare(bearer, f'Bearer {token}'))):
+        return HttpResponseForbidden()
+    return HttpResponse(
+        metrics.render_prometheus(metrics.registry.collect()),
+        content_type='text/plain; version=0.0.4; charset=utf-8',
+    )
+
+async def post_stream(request, slug):
+    """Server-Sent Events with new comments and view counts (blog/live.py)."""
+    if not isinstance(request, ASGIRequest):
+        # streaming would tie up a WSGI worker per reader; 204 stops EventSource
+        return HttpResponse(status=204)
+    post = await Post.objects.filter(slug=slug, published=True).only('pk').afirst()
+    if post is None:
+        raise Http404('No Post matches the given query.')
+    if not live.hub.has_room():
+        return HttpResponse(status=503, headers={'Retry-After': '30'})
+    response = StreamingHttpResponse(
+        live.hub.stream(live.post_channel(post.pk), getattr(settings, 'LIVE_KEEPALIVE', 15)),
+        content_type='text/event-stream',
+    )
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # nginx: pass events through as they are written
+    return response
+
+def ajax_comments(request, slug):
+    """Comments after the `after` cursor, one page at a time."""
+    post = get_object_or_404(Post.objects.only('pk'), slug=slug)
+    page = comments_page(post, PostDetailView.comments_per_page, request.GET.get('after'))
+    return JsonResponse({
+        'comments': [comment.as_json() for comment in page],
+        'next': page.next_cursor,
+    })
 
 @require_POST
 def increment_post_view(request):
     slug = request.POST.get('slug')
     if not slug:
         return JsonResponse({'error':'slug required'}, status=400)
-    post = get_object_or_404(Post, slug=slug)
-    # create PostView record (optional dedupe by user or ip)
-    ip = request.META.get('REMOTE_ADDR')
-    PostView.objects.create(post=post, user=(request.user if request.user.is_authenticated else None), ip_address=ip)
-    post.views = F('views') + 1
-    post.save(update_fields=['views'])
-    post.refresh_from_db()
-    return JsonResponse({'views': post.views})
+    # buffered; PostView rows and the views column are written in batches
+    views = view_counter.record(
+        slug,
+        user_id=(request.user.pk if request.user.is_authenticated else None),
+        ip=request.META.get('REMOTE_ADDR'),
+    )
+    if views is None:
+        raise Http404('No Post matches the given query.')
+    return JsonResponse({'views': views})
 
 @require_POST
 def ajax_add_comment(request, slug):
@@ -180,15 +360,13 @@ def ajax_add_comment(request, slug):
     if not body:
         return JsonResponse({'error':'empty comment'}, status=400)
     comment = Comment.objects.create(post=post, author=request.user, body=body)
-    # respond with basic HTML or JSON
     return JsonResponse({
         'status':'ok',
-        'comment': {
-            'author': request.user.username,
-            'body': comment.body,
-            'created_at': comment.created_at.strftime('%Y-%m-%d %H:%M')
-        },
-        'comments_count': post.comments.count()
+        'comment': comment.as_json(),
+        'cursor': comment_cursor(comment),
+        # the signal has added this comment to the count loaded above; no
+        # need to read it back (concurrent comments show on the next load)
+        'comments_count': post.comment_count + 1,
     })
 
 
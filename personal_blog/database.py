@@ -0,0 +1,42 @@
+"""
+DATABASES entries built from database URLs (dj-database-url).
+
+Connections are reused instead of opened, TLS handshake included, for every
+request:
+
+* with Django 5.1+ and psycopg 3 (with psycopg_pool) installed, each process
+  keeps a pool of ``pool_min``..``pool_max`` PostgreSQL connections;
+* otherwise a connection is kept open by its thread for ``conn_max_age``
+  seconds. Under ASGI each request runs its queries on its own thread, so
+  kept connections would pile up there; they are closed after each request
+  instead (pooling still applies).
+
+Health checks make a reused connection that the server dropped reconnect
+instead of failing the request.
+"""
+import importlib.util
+
+import django
+import dj_database_url
+
+
+def pooling_available():
+    return (
+        django.VERSION >= (5, 1)
+        and importlib.util.find_spec('psycopg') is not None
+        and importlib.util.find_spec('psycopg_pool') is not None
+    )
+
+
+def database_config(url, conn_max_age=600, pool_min=2, pool_max=10, pool_timeout=10, asgi=False, test=None):
+    """The DATABASES entry for `url`."""
+    config = dj_database_url.parse(url, conn_health_checks=True, test_options=test)
+    postgres = config['ENGINE'] == 'django.db.backends.postgresql'
+    if postgres and pool_max and pooling_available():
+        # Django's pool hands a connection back after each request; it must
+        # not also be held open by CONN_MAX_AGE
+        config.setdefault('OPTIONS', {})['pool'] = {'min_size': pool_min, 'max_size': pool_max, 'timeout': pool_timeout}
+        config['CONN_MAX_AGE'] = 0
+    else:
+        config['CONN_MAX_AGE'] = 0 if asgi else conn_max_age
+    return config
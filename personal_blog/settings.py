@@ -12,10 +12,9 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 
 from pathlib import Path
 from decouple import config
-# import dj_database_url # type: ignore
 import os
 from dotenv import load_dotenv # type: ignore
-from urllib.parse import urlparse, parse_qsl
+from personal_blog.database import database_config
 import cloudinary # type: ignore
 import cloudinary.uploader # type: ignore
 import cloudinary.api # type: ignore
@@ -57,6 +56,8 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     "whitenoise.middleware.WhiteNoiseMiddleware",
+    'blog.metrics.MetricsMiddleware',
+    'blog.routers.PrimaryAfterWriteMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -69,7 +70,8 @@ ROOT_URLCONF = 'personal_blog.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # Django's backend, timing renders for the metrics (blog/metrics.py)
+        'BACKEND': 'blog.metrics.DjangoTemplates',
         'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -92,6 +94,13 @@ DEFAULT_FILE_STORAGE = 'cloudinary_storage.storage.MediaCloudinaryStorage'
 WSGI_APPLICATION = 'personal_blog.wsgi.application'
 
 
+# Async views (blog/async_views.py) for the read-heavy pages and AJAX
+# endpoints; personal_blog/asgi.py turns them on, so
+# `uvicorn personal_blog.asgi:application` serves them while gunicorn on
+# personal_blog.wsgi keeps the synchronous views.
+ASYNC_VIEWS = config('ASYNC_VIEWS', default=False, cast=bool)
+
+
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
@@ -102,20 +111,42 @@ WSGI_APPLICATION = 'personal_blog.wsgi.application'
 #     }
 # }
 
-# Replace the DATABASES section of your settings.py with this
-tmpPostgres = urlparse(os.getenv("DATABASE_URL"))
-
+# Built by personal_blog/database.py: persistent or pooled connections with
+# health checks. DATABASE_REPLICA_URL adds a read replica (the `replica`
+# alias) that blog/routers.py sends the public pages' reads to.
+DATABASE_OPTIONS = {
+    'conn_max_age': config('DB_CONN_MAX_AGE', default=600, cast=int),  # seconds; without pooling
+    'pool_min': config('DB_POOL_MIN_SIZE', default=2, cast=int),  # per process, with pooling
+    'pool_max': config('DB_POOL_MAX_SIZE', default=10, cast=int),  # 0 disables pooling
+    'pool_timeout': config('DB_POOL_TIMEOUT', default=10, cast=int),  # seconds to wait for a free connection
+    'asgi': ASYNC_VIEWS,
+}
 DATABASES = {
+    'default': database_config(config('DATABASE_URL', default=f'sqlite:///{BASE_DIR / "db.sqlite3"}'), **DATABASE_OPTIONS),
+}
+if config('DATABASE_REPLICA_URL', default=''):
+    DATABASES['replica'] = database_config(
+        config('DATABASE_REPLICA_URL'), **DATABASE_OPTIONS, test={'MIRROR': 'default'},
+    )
+DATABASE_ROUTERS = ['blog.routers.PrimaryReplicaRouter']
+DATABASE_REPLICA_LAG = 5  # seconds a client that wrote reads from the primary only
+
+
+# Caches
+# The `render` cache holds sanitized post bodies (blog/rendering.py); switch it
+# to django.core.cache.backends.filebased.FileBasedCache or
+# django.core.cache.backends.redis.RedisCache through the environment.
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql',
-        'NAME': tmpPostgres.path.replace('/', ''),
-        'USER': tmpPostgres.username,
-        'PASSWORD': tmpPostgres.password,
-        'HOST': tmpPostgres.hostname,
-        'PORT': 5432,
-        'OPTIONS': dict(parse_qsl(tmpPostgres.query)),
-    }
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'render': {
+        'BACKEND': os.getenv('RENDER_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('RENDER_CACHE_LOCATION', 'post-render'),
+        'TIMEOUT': 60 * 60 * 24 * 7,
+    },
 }
+POST_RENDER_CACHE = 'render'
 
 
 # Password validation
@@ -228,3 +259,87 @@ EMAIL_USE_TLS = True
 EMAIL_HOST_USER = config('EMAIL_HOST_USER')
 EMAIL_HOST_PASSWORD = config('EMAIL_HOST_PASSWORD')
 
+
+# Post view counting (blog/view_counter.py). Views are buffered in memory and
+# written in batches; point VIEW_COUNTER_CACHE at a cache shared by all workers
+# so `manage.py flush_post_views` can drain every worker's batches.
+VIEW_COUNTER_CACHE = 'default'
+VIEW_COUNTER_FLUSH_INTERVAL = 10  # seconds; None disables the background flush
+VIEW_COUNTER_MAX_PENDING = 1000  # flush early once this many views are buffered
+VIEW_DEDUPE_WINDOW = 1800  # seconds a visitor's repeat views of a post are ignored; None disables
+VIEW_DEDUPE_BUCKETS = 6  # slices the window is cut into; one expires at a time
+VIEW_DEDUPE_CAPACITY = 20000  # distinct (post, visitor) pairs per slice before it stops filtering
+VIEW_DEDUPE_ERROR_RATE = 0.001  # chance a first view is mistaken for a repeat
+
+# Background jobs (blog/jobs.py), run by `manage.py run_jobs`
+JOB_MAX_ATTEMPTS = 5
+JOB_RETRY_DELAY = 30  # seconds before the first retry; doubles on each failure
+JOB_MAX_RETRY_DELAY = 3600
+JOB_LOCK_TIMEOUT = 600  # seconds before a job held by a silent worker is run again
+
+# Responsive image derivatives (blog/images.py), built by the job queue
+IMAGE_DERIVATIVE_WIDTHS = (320, 640, 960, 1280, 1920)
+
+# Following timelines (blog/timeline.py), written by the job queue
+TIMELINE_FANOUT_LIMIT = 5000  # authors with this many followers are read live instead of fanned out
+TIMELINE_BATCH_SIZE = 1000  # entries per INSERT when fanning out
+TIMELINE_BACKFILL_POSTS = 50  # recent posts copied into a timeline on follow
+
+# Live updates over Server-Sent Events (blog/live.py); needs the ASGI server.
+# LocalBackend reaches readers in this process only; with several ASGI
+# workers use 'blog.live.DatabaseBackend'.
+LIVE_BACKEND = 'blog.live.LocalBackend'
+LIVE_MAX_CONNECTIONS = 5000  # open streams per process; more get a 503
+LIVE_SUBSCRIBER_BUFFER = 64 * 1024  # bytes of unsent events before a slow reader is dropped
+LIVE_KEEPALIVE = 15  # seconds between keepalives on an idle stream
+LIVE_VIEWS_INTERVAL = 5  # seconds between view count pushes for a post
+LIVE_POLL_INTERVAL = 1  # DatabaseBackend: seconds between polls for new events
+LIVE_EVENT_RETENTION = 300  # DatabaseBackend: seconds before publishers delete an event
+LIVE_EVENT_LOOKBACK = 10  # DatabaseBackend: seconds a poller re-reads skipped event ids, for publishers that commit late
+
+# Request metrics (blog/metrics.py), served to staff at /metrics; a scraper
+# can send `Authorization: Bearer <METRICS_TOKEN>` instead of signing in
+METRICS_TOKEN = config('METRICS_TOKEN', default='')
+METRICS_SAMPLE_RATE = 0.1  # share of requests whose queries and templates are timed
+METRICS_SLOW_REQUEST = 1.0  # seconds; slower requests are logged, with their queries if sampled
+METRICS_CACHE = 'default'  # shared by the workers so /metrics adds them all up
+METRICS_PUBLISH_INTERVAL = 15  # seconds between a worker's snapshots
+
+# Full-text search (blog/search.py); text search configuration used on PostgreSQL
+SEARCH_CONFIG = 'english'
+
+# Dashboard totals cache (blog/stats.py)
+DASHBOARD_STATS_TIMEOUT = 300  # seconds; totals are also invalidated by post/comment/follow signals
+PUBLISHED_COUNT_TIMEOUT = 300  # seconds the feed's published post count is cached
+CATEGORY_COUNTS_TIMEOUT = 3600  # seconds the category list is cached; also dropped by post/category signals
+
+# Trending posts (blog/trending.py): views and comments, decayed over time
+TRENDING_CACHE = 'default'  # shared by every worker, like VIEW_COUNTER_CACHE
+TRENDING_HALF_LIFE = 6 * 3600  # seconds for a score to halve
+TRENDING_COMMENT_WEIGHT = 5  # a comment counts as this many views
+TRENDING_CAPACITY = 1000  # posts whose scores are kept; the lowest are dropped
+TRENDING_SIZE = 20  # posts in the ready-made list (and the most /ajax/trending/ returns)
+TRENDING_SIDEBAR_SIZE = 5  # posts in the home page sidebar
+TRENDING_CHECKPOINT_INTERVAL = 300  # seconds between writes of the scores to the database
+
+# Related posts (blog/related.py, `manage.py build_related_posts`)
+RELATED_POSTS_COUNT = 5  # posts listed under each post
+RELATED_POSTS_MIN_SCORE = 0.05  # weaker matches are not listed
+RELATED_POSTS_CATEGORY_WEIGHT = 0.1  # added to the similarity of posts in the same category
+RELATED_POSTS_MEMORY = 64 * 1024 * 1024  # bytes of scores computed at once
+
+# "Who to follow" suggestions (blog/suggestions.py, `manage.py build_follow_suggestions`)
+FOLLOW_SUGGESTIONS_COUNT = 10  # stored per user
+FOLLOW_SUGGESTIONS_SHOWN = 5  # listed on the dashboard and author pages
+FOLLOW_SUGGESTIONS_CO_FOLLOWER_WEIGHT = 1.0  # weight of readers with similar follows against friends of friends
+FOLLOW_SUGGESTIONS_NEIGHBOURS = 50  # most similar readers whose follows count for each user
+FOLLOW_SUGGESTIONS_MEMORY = 256 * 1024 * 1024  # bytes of scores computed at once
+
+# View analytics rollups (blog/analytics.py, `manage.py rollup_post_views`)
+VIEW_ROLLUP_DELAY = 300  # seconds after an hour ends before it is rolled up
+VIEW_ROLLUP_RETENTION_DAYS = 30  # raw PostView rows are pruned after this
+
+# Anonymous whole-page cache (blog/page_cache.py)
+PAGE_CACHE_ALIAS = 'default'
+PAGE_CACHE_TIMEOUT = 300  # seconds a page is served without re-checking the database
+PAGE_CACHE_STALE_TIMEOUT = 3600  # extra seconds a stale page may be served while it regenerates
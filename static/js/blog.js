@@ -50,6 +50,71 @@ document.addEventListener("DOMContentLoaded", function () {
       });
   }
 
+  // comments: built with textContent so comment bodies are never parsed as HTML
+  const commentList = document.getElementById("comment-list");
+  function appendComment(comment) {
+    if (commentList.querySelector('[data-id="' + comment.id + '"]')) return false;
+    const item = document.createElement("li");
+    item.className = "bg-gray-50 p-3 rounded";
+    item.dataset.id = comment.id;
+    const meta = document.createElement("p");
+    meta.className = "text-sm";
+    const author = document.createElement("strong");
+    author.textContent = comment.author;
+    const date = document.createElement("span");
+    date.className = "text-xs text-gray-500";
+    date.textContent = comment.created_at;
+    meta.append(author, " · ", date);
+    const body = document.createElement("p");
+    body.className = "mt-1";
+    body.textContent = comment.body;
+    item.append(meta, body);
+    commentList.appendChild(item);
+    return true;
+  }
+
+  // load further pages of comments
+  const loadMore = document.getElementById("load-more-comments");
+  if (loadMore) {
+    loadMore.addEventListener("click", function () {
+      loadMore.disabled = true;
+      fetch(
+        "/ajax/comments/" + window.BLOG.postSlug + "/?after=" +
+          encodeURIComponent(loadMore.dataset.cursor)
+      )
+        .then((r) => r.json())
+        .then((data) => {
+          data.comments.forEach(appendComment);
+          if (data.next) {
+            loadMore.dataset.cursor = data.next;
+          } else {
+            loadMore.classList.add("hidden");
+          }
+        })
+        .finally(() => {
+          loadMore.disabled = false;
+        });
+    });
+  }
+
+  // live comments and view counts; the stream answers 204 (and EventSource
+  // gives up) unless the site runs under ASGI
+  if (window.BLOG && window.BLOG.streamUrl && window.EventSource) {
+    const source = new EventSource(window.BLOG.streamUrl);
+    source.addEventListener("comment", function (e) {
+      // with pages still to load, it arrives with the last one
+      if (loadMore && !loadMore.classList.contains("hidden")) return;
+      if (appendComment(JSON.parse(e.data))) {
+        const commentCountSpan = document.querySelector(".comment-count");
+        commentCountSpan.textContent = parseInt(commentCountSpan.textContent, 10) + 1;
+      }
+    });
+    source.addEventListener("views", function (e) {
+      const vc = document.getElementById("view-count");
+      if (vc) vc.textContent = "Views: " + JSON.parse(e.data).views;
+    });
+  }
+
   // comment AJAX
   const commentForm = document.getElementById("comment-form");
   if (commentForm) {
@@ -69,21 +134,9 @@ document.addEventListener("DOMContentLoaded", function () {
         .then((r) => r.json())
         .then((data) => {
           if (data.status === "ok") {
-            // Add new comment to list
-            const list = document.getElementById("comment-list");
-            const item = document.createElement("li");
-            item.className = "bg-gray-50 p-3 rounded";
-            item.innerHTML =
-              '<p class="text-sm"><strong>' +
-              data.comment.author +
-              '</strong> · <span class="text-xs text-gray-500">' +
-              data.comment.created_at +
-              '</span></p><p class="mt-1">' +
-              data.comment.body +
-              "</p>";
-            list.appendChild(item);
+            // shown now; "load more" skips it when it reaches it
+            appendComment(data.comment);
             const commentCountSpan = document.querySelector(".comment-count");
-            console.log("Before update:", commentCountSpan.textContent);
             commentCountSpan.textContent = data.comments_count;
             document.getElementById("comment-body").value = "";
           } else {